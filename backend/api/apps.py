@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class ApiConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'api'
+
+    def ready(self):
+        # Connect the devices_changed receivers; fleet_stats first so live
+        # deltas carry the refreshed stats
+        from api.services import fleet_stats  # noqa: F401
+        from api.services import live_updates  # noqa: F401
+        from api.services import geofences  # noqa: F401
+        from api.services import vector_tiles  # noqa: F401
@@ -1,5 +1,8 @@
 from django.core.management.base import BaseCommand
 from api.models import DeviceData
+from api.services.fleet_stats import refresh_fleet_stats
+from api.services.live_updates import publish_resync
+from api.services.vector_tiles import clear_device_tiles
 
 class Command(BaseCommand):
     help = 'Clear all device data from the database'
@@ -27,6 +30,9 @@ class Command(BaseCommand):
 
         # Delete all records
         DeviceData.objects.all().delete()
+        refresh_fleet_stats()
+        clear_device_tiles()
+        publish_resync()
         
         self.stdout.write(
             self.style.SUCCESS(f'Successfully deleted {count} DeviceData records.')
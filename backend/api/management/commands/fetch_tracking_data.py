@@ -1,14 +1,12 @@
 import os
-import csv
-import json
-from datetime import datetime
-from collections import defaultdict
+import asyncio
 
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
 
 class Command(BaseCommand):
     help = 'Fetch tracking data from ProTrack365 API for all IMEIs'
+    # progress(**fields) callback, passed by background jobs through call_command
+    stealth_options = ('progress',)
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -23,12 +21,30 @@ class Command(BaseCommand):
             type=str,
             help='Custom folder name to save results (default: auto-generated timestamp)',
         )
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Process and write each batch as soon as it arrives instead of after the whole fetch',
+        )
+        parser.add_argument(
+            '--load',
+            action='store_true',
+            help='Load processed records straight into the database as batches arrive',
+        )
+        parser.add_argument(
+            '--no-archive',
+            action='store_true',
+            help='With --load, skip writing the run archive to response_logs',
+        )
         
     def handle(self, *args, **options):
         try:
             # Import services
             from scripts.utils.load_imei import get_imeis_from_csv
             from api.services.protrack_service import get_token, get_track_info, process_tracking_data
+            from api.services.concurrency import AdaptiveConcurrencyLimiter
+            from api.services.quarantine import get_quarantined_imeis, quarantined_batch, update_quarantine
+            from api.services.protrack_service import TRACK_ENDPOINT
             
             self.stdout.write(self.style.SUCCESS('🚀 Starting ProTrack365 Data Collection'))
             
@@ -40,16 +56,46 @@ class Command(BaseCommand):
             token = get_token()
             self.stdout.write(self.style.SUCCESS('✅ Authentication token obtained'))
             
+            if options['load']:
+                self.fetch_and_load(imeis, options)
+                return
+
             # Step 2: Fetch tracking data
             self.stdout.write('🌐 Fetching tracking data from API...')
-            endpoint = "https://api.protrack365.com/api/track"
-            raw_data = get_track_info(imei_list=imeis, token=token, endpoint=endpoint)
+            endpoint = TRACK_ENDPOINT
+            quarantined = get_quarantined_imeis()
+            active_imeis = [imei for imei in imeis if imei not in quarantined]
+            if len(active_imeis) < len(imeis):
+                self.stdout.write(self.style.WARNING(f'🚧 Skipping {len(imeis) - len(active_imeis)} quarantined IMEIs'))
+
+            limiter = AdaptiveConcurrencyLimiter()
+            skipped = [imei for imei in imeis if imei in quarantined]
+
+            if options['stream']:
+                # Steps 2-4 overlapped: each batch is processed and written as it arrives
+                run_folder = self.create_run_folder(options['save_to'])
+                self.stdout.write(f'📁 Streaming to: {run_folder}')
+                count, quarantine_stats = self.fetch_streaming(
+                    active_imeis, skipped, token, endpoint, limiter, run_folder, options.get('progress')
+                )
+                self.report_fetch_stats(limiter.snapshot(), quarantine_stats)
+                self.stdout.write(self.style.SUCCESS(f'✅ Processed and saved {count} records'))
+                return
+
+            raw_data = get_track_info(imei_list=active_imeis, token=token, endpoint=endpoint, limiter=limiter)
             self.stdout.write(self.style.SUCCESS(f'✅ Fetched {len(raw_data)} batches'))
+
+            quarantine_stats = update_quarantine(raw_data)
+            if skipped:
+                raw_data.append(quarantined_batch(skipped))
+            self.report_fetch_stats(limiter.snapshot(), quarantine_stats)
             
             # Step 3: Process data
             self.stdout.write('⚙️ Processing raw data...')
             data = process_tracking_data(raw_data, imeis)
             self.stdout.write(self.style.SUCCESS(f'✅ Processed {len(data)} records'))
+            if options.get('progress'):
+                options['progress'](batches_done=len(raw_data), records_processed=len(data), total=len(imeis))
             
             # Step 4: Save results
             run_folder = self.create_run_folder(options['save_to'])
@@ -61,46 +107,97 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'❌ Error: {str(e)}'))
             raise CommandError(f'Command failed: {str(e)}')
 
+    def report_fetch_stats(self, stats, quarantine_stats):
+        self.stdout.write(
+            f"📶 Concurrency settled at {stats['concurrency']} "
+            f"(peak {stats['peak_concurrency']}, p95 {stats['p95_latency']}s, throttled {stats['throttled']})"
+        )
+        if quarantine_stats['quarantined'] or quarantine_stats['released']:
+            self.stdout.write(
+                f"🚧 Quarantined {quarantine_stats['quarantined']} IMEIs, released {quarantine_stats['released']}"
+            )
+
+    def fetch_and_load(self, imeis, options):
+        """Fetch, process and load into DeviceData in one pass; the archive is written in the background"""
+        from api.services.refresh_pipeline import run_refresh
+
+        run_folder = None if options['no_archive'] else self.create_run_folder(options['save_to'])
+        self.stdout.write('🌐 Fetching tracking data and loading into database...')
+        stats = run_refresh(
+            imeis,
+            archive_folder=run_folder,
+            progress=lambda processed, total, batches: self.report_load_progress(processed, total, batches, options),
+        )
+
+        if stats['skipped']:
+            self.stdout.write(self.style.WARNING(f"🚧 Skipped {stats['skipped']} quarantined IMEIs"))
+        self.report_fetch_stats(stats['fetch_stats'], stats)
+        if run_folder:
+            self.stdout.write(f'💾 Saved run archive in {run_folder}')
+        self.stdout.write(self.style.SUCCESS(f"✅ Created: {stats['created']} records"))
+        self.stdout.write(self.style.SUCCESS(f"🔄 Updated: {stats['updated']} records"))
+        self.stdout.write(f"⏭️ Unchanged: {stats['unchanged']} records (skipped)")
+        self.stdout.write(f"🔁 Changed: {stats['changed']} devices")
+        self.stdout.write(f"📍 History: {stats['appended']} new positions")
+        if stats['errors']:
+            self.stdout.write(self.style.WARNING(f"⚠️ Errors: {stats['errors']} records"))
+        self.stdout.write(self.style.SUCCESS(f"🎯 Loaded {stats['records']} records in {stats['elapsed']}s"))
+        return stats
+
+    def report_load_progress(self, processed, total, batches, options):
+        self.stdout.write(f'📊 Loaded {processed}/{total} records...')
+        if options.get('progress'):
+            options['progress'](batches_done=batches, records_loaded=processed, total=total)
+
+    def fetch_streaming(self, active_imeis, skipped, token, endpoint, limiter, run_folder, progress=None):
+        """Fetch, process and write records batch by batch; returns (record count, quarantine stats)"""
+        from api.services.protrack_service import process_batch, stream_tracking_records
+        from api.services.archive_writer import TrackingRunWriter
+        from api.services.quarantine import apply_quarantine_changes, collect_quarantine_changes, quarantined_batch
+        from api.services.refresh_pipeline import run_in_thread
+
+        failing, returned = {}, set()
+        batches_done = 0
+
+        async def consume():
+            nonlocal batches_done
+            with TrackingRunWriter(run_folder) as writer:
+                async for batch, records in stream_tracking_records(active_imeis, token, endpoint, limiter=limiter):
+                    if batch is not None:
+                        batches_done += 1
+                        collect_quarantine_changes([batch], failing, returned)
+                    writer.write(records)
+                    if progress:
+                        # Off the event loop: the callback may write to the DB
+                        await run_in_thread(
+                            progress, batches_done=batches_done, records_processed=writer.count, total=len(active_imeis)
+                        )
+                if skipped:
+                    writer.write(process_batch(quarantined_batch(skipped), set()))
+            return writer.count, writer.filenames
+
+        count, filenames = asyncio.run(consume())
+        quarantine_stats = apply_quarantine_changes(failing, returned)
+        self.stdout.write(f'💾 Saved: {", ".join(os.path.basename(name) for name in filenames)}')
+        return count, quarantine_stats
+
     def create_run_folder(self, custom_name=None):
         """Create timestamped folder for results"""
-        if custom_name:
-            folder_name = custom_name
-        else:
-            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            folder_name = f'tracking_run_{timestamp}'
-        
-        run_folder = os.path.join(settings.BASE_DIR, 'response_logs', folder_name)
-        os.makedirs(run_folder, exist_ok=True)
-        os.makedirs(os.path.join(settings.BASE_DIR, 'response_logs'), exist_ok=True)
-        return run_folder
+        from api.services.archive_writer import create_run_folder
+        return create_run_folder(custom_name)
 
     def save_all_data(self, data, imeis, run_folder):
         """Save all data files and return statistics"""
-        # Updated fieldnames to include hearttime_unix
-        fieldnames = [
-            "imei", "latitude", "longitude", "coordinates", 
-            "datastatus", "datastatus_description", 
-            "hearttime_date", "hearttime_time",
-            "hearttime_unix", "TimeSinceUpdate", "TimeAgo", "status"
-        ]
+        from api.services.archive_writer import RECORD_FIELDNAMES
          
         # Save JSON and CSV
-        self.save_main_files(data, run_folder, fieldnames)
+        self.save_main_files(data, run_folder, RECORD_FIELDNAMES)
                     
     def save_main_files(self, data, run_folder, fieldnames):
         """Save main JSON and CSV files"""
-        # JSON
-        json_filename = os.path.join(run_folder, "all_records.json")
-        with open(json_filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
-        # CSV
-        csv_filename = os.path.join(run_folder, "all_records.csv")
-        with open(csv_filename, "w", newline='', encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for row in data:
-                writer.writerow({field: row.get(field, "") for field in fieldnames})
+        from api.services.archive_writer import TrackingRunWriter
+
+        with TrackingRunWriter(run_folder, fieldnames) as writer:
+            writer.write(data)
         
-        self.stdout.write(f'💾 Saved: {os.path.basename(json_filename)} & {os.path.basename(csv_filename)}')
-    
\ No newline at end of file
+        self.stdout.write(f'💾 Saved: {", ".join(os.path.basename(name) for name in writer.filenames)}')
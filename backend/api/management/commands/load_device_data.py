@@ -1,22 +1,27 @@
-import json
 import os
-from datetime import datetime
-from django.utils import timezone
-from decimal import Decimal
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 from api.models import DeviceData
+from api.services.archive_writer import load_run_records
+from api.services.device_loader import (
+    bulk_load_device_data, device_max_lengths, load_device_state, new_changes, notify_devices_changed,
+)
+from api.services.fleet_stats import refresh_fleet_stats
+from api.services.live_updates import publish_resync
+from api.services.snapshot_archive import read_device_rows
+from api.services.vector_tiles import clear_device_tiles
 
 
 class Command(BaseCommand):
     help = 'Load device data from JSON file into database'
+    # progress(**fields) callback, passed by background jobs through call_command
+    stealth_options = ('progress',)
 
     def add_arguments(self, parser):
         parser.add_argument(
             'json_file',
             type=str,
-            help='Path to JSON file containing device data'
+            help='Path to the run archive (all_records.snap or all_records.json) containing device data'
         )
         parser.add_argument(
             '--clear-existing',
@@ -30,25 +35,33 @@ class Command(BaseCommand):
 
         # Check if file exists
         if not os.path.exists(json_file):
-            raise CommandError(f'JSON file not found: {json_file}')
+            raise CommandError(f'Archive file not found: {json_file}')
 
         try:
-            # Load JSON data
+            # Load archived records
             self.stdout.write(f'📂 Loading data from: {json_file}')
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            if json_file.endswith('.snap'):
+                # Run snapshots go straight from typed columns to DB rows, no string round trip
+                rows, data = read_device_rows(json_file, device_max_lengths())
+            else:
+                rows, data = [], load_run_records(json_file)
             
-            self.stdout.write(self.style.SUCCESS(f'✅ Loaded {len(data)} records from JSON'))
+            self.stdout.write(self.style.SUCCESS(
+                f'✅ Loaded {len(rows) + len(data)} records from {os.path.basename(json_file)}'
+            ))
 
             # Clear existing data if requested
             if clear_existing:
                 self.stdout.write('🗑️ Clearing existing device data...')
                 deleted_count = DeviceData.objects.all().delete()[0]
+                refresh_fleet_stats()
+                clear_device_tiles()
+                publish_resync()
                 self.stdout.write(self.style.WARNING(f'🗑️ Deleted {deleted_count} existing records'))
 
             # Load data into database
             self.stdout.write('📊 Loading data into database...')
-            self.load_data_to_db(data)
+            self.load_data_to_db(data, options.get('progress'), rows)
             
             # Show final statistics
             total_records = DeviceData.objects.count()
@@ -58,107 +71,39 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'❌ Error: {str(e)}'))
             raise CommandError(f'Command failed: {str(e)}')
 
-    def load_data_to_db(self, data):
-        """Load data into database with ranking"""
-        created_count = 0
-        updated_count = 0
-        error_count = 0
-
-        # Process in batches for better performance
-        batch_size = 100
-        for i in range(0, len(data), batch_size):
-            batch = data[i:i + batch_size]
-            
-            with transaction.atomic():
-                for record in batch:
-                    try:
-                        # Parse date and time
-                        hearttime_date = None
-                        hearttime_time = None
-                        
-                        if record.get('hearttime_date'):
-                            try:
-                                hearttime_date = datetime.strptime(record['hearttime_date'], '%Y-%m-%d').date()
-                            except ValueError:
-                                pass
-                        
-                        if record.get('hearttime_time'):
-                            try:
-                                hearttime_time = datetime.strptime(record['hearttime_time'], '%H:%M:%S').time()
-                            except ValueError:
-                                pass
-
-                        # Create or update device data
-                        # Note: ranking_id is AutoField and will be assigned automatically
-                        # Prefer hearttime_unix to compute last update datetimes so UI/CSV match DB
-                        last_update_detailed_db = None
-                        last_update_relative_db = None
-
-                        # If hearttime_unix provided, convert it to an aware UTC datetime
-                        heart_unix_val = record.get('hearttime_unix')
-                        if heart_unix_val not in [None, '', '0']:
-                            try:
-                                ts = int(heart_unix_val)
-                                last_dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-                                last_update_detailed_db = last_dt
-                                last_update_relative_db = last_dt
-                            except Exception:
-                                last_update_detailed_db = None
-                                last_update_relative_db = None
-
-                        # If not set from hearttime_unix, fall back to any provided fields or now
-                        if not last_update_detailed_db:
-                            if record.get('last_update_detailed_db'):
-                                try:
-                                    last_update_detailed_db = datetime.fromisoformat(record['last_update_detailed_db'])
-                                except Exception:
-                                    last_update_detailed_db = timezone.now()
-                            else:
-                                last_update_detailed_db = timezone.now()
-
-                        if not last_update_relative_db:
-                            if record.get('last_update_relative_db'):
-                                try:
-                                    last_update_relative_db = datetime.fromisoformat(record['last_update_relative_db'])
-                                except Exception:
-                                    last_update_relative_db = timezone.now()
-                            else:
-                                last_update_relative_db = timezone.now()
-
-                        device_data, created = DeviceData.objects.update_or_create(
-                            imei=record.get('imei'),
-                            defaults={
-                                'latitude': Decimal(str(record.get('latitude', 0))),
-                                'longitude': Decimal(str(record.get('longitude', 0))),
-                                'coordinates': record.get('coordinates', ''),
-                                'datastatus': int(record.get('datastatus', 0)),
-                                'datastatus_description': record.get('datastatus_description', ''),
-                                'hearttime_date': hearttime_date,
-                                'hearttime_time': hearttime_time,
-                                'hearttime_unix': int(record.get('hearttime_unix', 0)),
-                                'status': record.get('status', ''),
-                                'last_update_detailed_db': last_update_detailed_db,
-                                'last_update_relative_db': last_update_relative_db,
-                            }
-                        )
-                        
-                        if created:
-                            created_count += 1
-                        else:
-                            updated_count += 1
-                            
-                    except Exception as e:
-                        error_count += 1
-                        self.stdout.write(
-                            self.style.WARNING(f'⚠️ Error processing record {record.get("imei", "unknown")}: {str(e)}')
-                        )
-            
-            # Progress update
-            processed = min(i + batch_size, len(data))
-            self.stdout.write(f'📊 Processed {processed}/{len(data)} records...')
+    def load_data_to_db(self, data, progress=None, rows=None):
+        """Load data into database with ranking (``rows``: already prepared DeviceData values)"""
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': 0, 'appended': 0}
+        # One index of the stored state shared by both passes
+        state = load_device_state()
+        changes = new_changes()
+        for items, prepared in ((rows or [], True), (data, False)):
+            if not items and prepared:
+                continue
+            loaded = bulk_load_device_data(
+                items,
+                progress=lambda processed, total: self.report_progress(processed, total, progress),
+                warn=lambda message: self.stdout.write(self.style.WARNING(f'⚠️ {message}')),
+                prepared=prepared,
+                state=state,
+                changes=changes,
+            )
+            for key in counts:
+                counts[key] += loaded[key]
+        notify_devices_changed(changes)
 
         # Final statistics
-        self.stdout.write(self.style.SUCCESS(f'✅ Created: {created_count} records'))
-        self.stdout.write(self.style.SUCCESS(f'🔄 Updated: {updated_count} records'))
-        if error_count > 0:
-            self.stdout.write(self.style.WARNING(f'⚠️ Errors: {error_count} records'))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS(f'✅ Created: {counts["created"]} records'))
+        self.stdout.write(self.style.SUCCESS(f'🔄 Updated: {counts["updated"]} records'))
+        self.stdout.write(f'⏭️ Unchanged: {counts["unchanged"]} records (skipped)')
+        self.stdout.write(f'🔁 Changed: {counts["created"] + counts["updated"]} devices')
+        self.stdout.write(f'📍 History: {counts["appended"]} new positions')
+        if counts['errors'] > 0:
+            self.stdout.write(self.style.WARNING(f'⚠️ Errors: {counts["errors"]} records'))
+
+        return counts
+
+    def report_progress(self, processed, total, progress=None):
+        self.stdout.write(f'📊 Processed {processed}/{total} records...')
+        if progress:
+            progress(records_loaded=processed, total=total)
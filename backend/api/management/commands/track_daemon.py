@@ -0,0 +1,154 @@
+import asyncio
+import signal
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Continuously poll ProTrack365 on a fixed cadence and load the results into the database'
+
+    # Records buffered from the stream before each DB load
+    load_chunk_size = 1000
+
+    # Monotonic clock the cycle ticks are scheduled against
+    clock = staticmethod(time.monotonic)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=60.0,
+            help='Seconds between cycle starts (default: 60)',
+        )
+        parser.add_argument(
+            '--imei-file',
+            type=str,
+            default='MAIN.csv',
+            help='CSV file containing IMEIs (default: MAIN.csv). Send SIGHUP to reload it.',
+        )
+        parser.add_argument(
+            '--max-cycles',
+            type=int,
+            default=0,
+            help='Stop after this many cycles (default: 0, run until SIGTERM)',
+        )
+        parser.add_argument(
+            '--endpoint',
+            type=str,
+            default=None,
+            help='Track API endpoint (default: ProTrack365 /api/track)',
+        )
+        parser.add_argument(
+            '--archive',
+            action='store_true',
+            help='Also write each cycle to response_logs like fetch_tracking_data',
+        )
+
+    def handle(self, *args, **options):
+        if options['interval'] <= 0:
+            raise CommandError('--interval must be positive')
+        try:
+            asyncio.run(self.run_daemon(options))
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'❌ Error: {str(e)}'))
+            raise CommandError(f'Command failed: {str(e)}')
+
+    def load_imeis(self, imei_file):
+        from scripts.utils.load_imei import get_imeis_from_csv
+        return get_imeis_from_csv(imei_file)
+
+    async def run_daemon(self, options):
+        from api.services.protrack_service import create_track_session
+        from api.services.token_manager import get_token_manager
+        from api.services.concurrency import AdaptiveConcurrencyLimiter
+        from api.services.refresh_pipeline import run_in_thread
+
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        reload_imeis = asyncio.Event()
+
+        def request_stop(signame):
+            if not stop.is_set():
+                self.stdout.write(self.style.WARNING(f'🛑 {signame} received, stopping after the current cycle...'))
+            stop.set()
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, request_stop, sig.name)
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, reload_imeis.set)
+
+        interval = options['interval']
+        imeis = await run_in_thread(self.load_imeis, options['imei_file'])
+        self.stdout.write(self.style.SUCCESS(f'🚀 Tracking daemon started: {len(imeis)} IMEIs every {interval:g}s'))
+
+        # Kept for the life of the daemon: token, learned concurrency and open connections
+        token_manager = get_token_manager()
+        limiter = AdaptiveConcurrencyLimiter()
+
+        async with create_track_session(limiter.max_limit) as session:
+            cycle = 0
+            next_tick = self.clock()
+            while not stop.is_set():
+                if reload_imeis.is_set():
+                    reload_imeis.clear()
+                    imeis = await run_in_thread(self.load_imeis, options['imei_file'])
+                    self.stdout.write(f'📋 Reloaded {len(imeis)} IMEIs')
+
+                cycle += 1
+                started = self.clock()
+                try:
+                    await self.run_cycle(cycle, imeis, session, token_manager, limiter, options)
+                except Exception as e:
+                    # A failed cycle must not kill the daemon; the next tick retries
+                    self.stdout.write(self.style.ERROR(f'❌ Cycle {cycle} failed: {e}'))
+                elapsed = self.clock() - started
+
+                if options['max_cycles'] and cycle >= options['max_cycles']:
+                    break
+
+                # Schedule against absolute ticks so cycle time does not accumulate as drift.
+                # Cycles never overlap: an overrunning cycle skips the ticks it missed.
+                next_tick += interval
+                now = self.clock()
+                if now >= next_tick:
+                    missed = int((now - next_tick) // interval) + 1
+                    next_tick += missed * interval
+                    self.stdout.write(self.style.WARNING(
+                        f'⏱️ Cycle {cycle} took {elapsed:.1f}s (> {interval:g}s), skipped {missed} tick(s)'
+                    ))
+                await self.wait_for_tick(stop, next_tick - now)
+
+        self.stdout.write(self.style.SUCCESS(f'👋 Tracking daemon stopped after {cycle} cycle(s)'))
+
+    async def wait_for_tick(self, stop, timeout):
+        """Sleep until the next tick, returning early once a stop is requested"""
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_cycle(self, cycle, imeis, session, token_manager, limiter, options):
+        from api.services.archive_writer import create_run_folder
+        from api.services.protrack_service import TRACK_ENDPOINT
+        from api.services.refresh_pipeline import refresh_tracking_data_async
+
+        # Batches are loaded as they arrive, so the DB writes overlap the remaining fetches
+        stats = await refresh_tracking_data_async(
+            imeis,
+            endpoint=options['endpoint'] or TRACK_ENDPOINT,
+            session=session,
+            token_manager=token_manager,
+            limiter=limiter,
+            archive_folder=create_run_folder() if options['archive'] else None,
+            load_chunk_size=self.load_chunk_size,
+        )
+
+        self.stdout.write(
+            f'🔁 [{datetime.now():%Y-%m-%d %H:%M:%S}] Cycle {cycle}: {stats["records"]} records '
+            f'({stats["changed"]} changed: created {stats["created"]}, updated {stats["updated"]}; '
+            f'unchanged {stats["unchanged"]}, errors {stats["errors"]}, '
+            f'new positions {stats["appended"]}), '
+            f'total {stats["elapsed"]:.1f}s, concurrency {limiter.limit}'
+        )
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_devicedata_last_update_relative_db'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuarantinedIMEI',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('imei', models.CharField(max_length=20, unique=True)),
+                ('reason', models.CharField(blank=True, max_length=255)),
+                ('failure_count', models.IntegerField(default=1)),
+                ('quarantined_until', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:49
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+# PostgreSQL: range-partitioned by month on hearttime_unix. The primary key and
+# unique constraint include the partition key, as partitioned tables require;
+# rows outside the pre-created monthly partitions land in the DEFAULT one.
+POSTGRES_CREATE = """
+CREATE SEQUENCE api_positionhistory_id_seq;
+CREATE TABLE api_positionhistory (
+    id bigint NOT NULL DEFAULT nextval('api_positionhistory_id_seq'),
+    imei varchar(20) NOT NULL,
+    hearttime_unix bigint NOT NULL,
+    latitude numeric(9, 6) NOT NULL,
+    longitude numeric(9, 6) NOT NULL,
+    datastatus smallint NOT NULL,
+    recorded_at timestamp with time zone NOT NULL,
+    PRIMARY KEY (id, hearttime_unix),
+    CONSTRAINT unique_position_per_heartbeat UNIQUE (imei, hearttime_unix)
+) PARTITION BY RANGE (hearttime_unix);
+ALTER SEQUENCE api_positionhistory_id_seq OWNED BY api_positionhistory.id;
+CREATE TABLE api_positionhistory_default PARTITION OF api_positionhistory DEFAULT;
+CREATE INDEX api_positionhistory_hearttime_brin ON api_positionhistory USING brin (hearttime_unix);
+"""
+
+POSTGRES_DROP = "DROP TABLE IF EXISTS api_positionhistory CASCADE;"
+
+
+def create_position_history(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_CREATE.split(';'):
+            if statement.strip():
+                schema_editor.execute(statement, params=None)
+    else:
+        schema_editor.create_model(apps.get_model('api', 'PositionHistory'))
+
+
+def drop_position_history(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_DROP, params=None)
+    else:
+        schema_editor.delete_model(apps.get_model('api', 'PositionHistory'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_job'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='PositionHistory',
+                    fields=[
+                        ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                        ('imei', models.CharField(max_length=20)),
+                        ('hearttime_unix', models.BigIntegerField()),
+                        ('latitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                        ('longitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                        ('datastatus', models.SmallIntegerField()),
+                        ('recorded_at', models.DateTimeField(default=django.utils.timezone.now)),
+                    ],
+                    options={
+                        'constraints': [models.UniqueConstraint(fields=('imei', 'hearttime_unix'), name='unique_position_per_heartbeat')],
+                    },
+                ),
+            ],
+        ),
+        migrations.RunPython(create_position_history, drop_position_history),
+    ]
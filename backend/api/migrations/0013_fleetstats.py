@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_positionhistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_devices', models.IntegerField(default=0)),
+                ('with_coordinates', models.IntegerField(default=0)),
+                ('status_counts', models.JSONField(blank=True, default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
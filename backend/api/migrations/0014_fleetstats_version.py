@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_fleetstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fleetstats',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_fleetstats_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnapshotDelta',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField()),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_snapshotdelta'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicedata',
+            index=models.Index(fields=['datastatus', 'hearttime_unix', 'ranking_id'], name='devicedata_status_heart_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='devicedata',
+            index=models.Index(fields=['hearttime_unix', 'ranking_id'], name='devicedata_heart_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='devicedata',
+            index=models.Index(condition=models.Q(('latitude', 0), ('longitude', 0)), fields=['hearttime_unix', 'ranking_id'], name='devicedata_no_coords_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:13
+
+from django.db import migrations, models
+
+BACKFILL_BATCH = 2000
+
+
+def backfill_grid_cells(apps, schema_editor):
+    from api.services.spatial import grid_cell
+
+    DeviceData = apps.get_model('api', 'DeviceData')
+    batch = []
+    rows = DeviceData.objects.values_list('ranking_id', 'latitude', 'longitude').iterator(chunk_size=BACKFILL_BATCH)
+    for ranking_id, latitude, longitude in rows:
+        batch.append(DeviceData(ranking_id=ranking_id, grid_cell=grid_cell(latitude, longitude)))
+        if len(batch) == BACKFILL_BATCH:
+            DeviceData.objects.bulk_update(batch, ['grid_cell'])
+            batch = []
+    DeviceData.objects.bulk_update(batch, ['grid_cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_devicedata_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicedata',
+            name='grid_cell',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_grid_cells, migrations.RunPython.noop),
+    ]
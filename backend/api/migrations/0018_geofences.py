@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:17
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_devicedata_grid_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Geofence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('polygon', 'Polygon'), ('circle', 'Circle')], max_length=10)),
+                ('points', models.JSONField(blank=True, default=list)),
+                ('center_latitude', models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True)),
+                ('center_longitude', models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True)),
+                ('radius_m', models.FloatField(blank=True, null=True)),
+                ('active', models.BooleanField(default=True)),
+                ('evaluated_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GeofenceEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('imei', models.CharField(max_length=20)),
+                ('event', models.CharField(choices=[('enter', 'Enter'), ('exit', 'Exit')], max_length=10)),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('hearttime_unix', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('geofence', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='api.geofence')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['geofence', 'created_at'], name='geofence_event_fence_idx'), models.Index(fields=['imei', 'created_at'], name='geofence_event_imei_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='GeofenceMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('imei', models.CharField(max_length=20)),
+                ('entered_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('geofence', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='api.geofence')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('geofence', 'imei'), name='unique_geofence_membership')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_geofences'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceTile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.SmallIntegerField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('data', models.BinaryField()),
+                ('features', models.IntegerField(default=0)),
+                ('version', models.BigIntegerField(db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('zoom', 'x', 'y'), name='unique_device_tile')],
+            },
+        ),
+    ]
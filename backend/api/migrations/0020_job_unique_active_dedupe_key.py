@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_device_tiles'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running']), models.Q(('dedupe_key', ''), _negated=True)), fields=('dedupe_key',), name='unique_active_job_dedupe_key'),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.utils import timezone
 
@@ -19,6 +21,9 @@ class DeviceData(models.Model):
     
     status = models.CharField(max_length=20)
 
+    # Grid cell of latitude/longitude, written by the loader (see api.services.spatial)
+    grid_cell = models.IntegerField(null=True, blank=True, db_index=True)
+
     # Detailed timestamp used by imports and ranking; keep non-null for integrity
     last_update_detailed_db = models.DateTimeField(default=timezone.now)
 
@@ -31,6 +36,218 @@ class DeviceData(models.Model):
 
     class Meta:
         ordering = ['ranking_id']
+        # Backing the filters of /api/devices/query/ and the export (api.services.device_query).
+        # ranking_id comes last so the query's (hearttime_unix, ranking_id) keyset seeks on them
+        indexes = [
+            models.Index(fields=['datastatus', 'hearttime_unix', 'ranking_id'], name='devicedata_status_heart_idx'),
+            models.Index(fields=['hearttime_unix', 'ranking_id'], name='devicedata_heart_idx'),
+            # Devices without a position are the rare case worth finding quickly
+            models.Index(
+                fields=['hearttime_unix', 'ranking_id'], condition=models.Q(latitude=0, longitude=0),
+                name='devicedata_no_coords_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"IMEI: {self.imei} - {self.status}"
+
+
+class QuarantinedIMEI(models.Model):
+    """IMEIs isolated as failing on their own; skipped by fetches until the hold expires"""
+    imei = models.CharField(max_length=20, unique=True)
+    reason = models.CharField(max_length=255, blank=True)
+    failure_count = models.IntegerField(default=1)
+    quarantined_until = models.DateTimeField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"IMEI: {self.imei} - quarantined until {self.quarantined_until}"
+
+
+class Job(models.Model):
+    """Background fetch/load run started from the API; polled via /api/jobs/<id>/"""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = [STATUS_QUEUED, STATUS_RUNNING]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=50)
+    # Jobs with the same kind and key share one active run; a non-empty key is shared across kinds
+    dedupe_key = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    params = models.JSONField(default=dict, blank=True)
+    progress = models.JSONField(default=dict, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)  # heartbeat while running
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'dedupe_key'],
+                condition=models.Q(status__in=['queued', 'running']),
+                name='unique_active_job',
+            ),
+            models.UniqueConstraint(
+                fields=['dedupe_key'],
+                condition=models.Q(status__in=['queued', 'running']) & ~models.Q(dedupe_key=''),
+                name='unique_active_job_dedupe_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.kind}) - {self.status}"
+
+
+class PositionHistory(models.Model):
+    """Append-only track history: one row per IMEI per new heartbeat.
+
+    On PostgreSQL the table is range-partitioned by month on hearttime_unix
+    with a BRIN index on hearttime_unix (see migration 0012 and
+    api.services.position_history); elsewhere it is a plain table.
+    """
+    id = models.BigAutoField(primary_key=True)
+    imei = models.CharField(max_length=20)
+    hearttime_unix = models.BigIntegerField()
+    latitude = models.DecimalField(max_digits=9, decimal_places=6)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6)
+    datastatus = models.SmallIntegerField()
+    recorded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            # Also the (imei, hearttime_unix) index used for per-device history
+            models.UniqueConstraint(fields=['imei', 'hearttime_unix'], name='unique_position_per_heartbeat'),
+        ]
+
+    def __str__(self):
+        return f"IMEI: {self.imei} @ {self.hearttime_unix}"
+
+
+class FleetStats(models.Model):
+    """Single-row dashboard summary of DeviceData, refreshed by the loader (see api.services.fleet_stats)"""
+    # Bumped on every refresh; read endpoints key their caches and ETags on it
+    version = models.BigIntegerField(default=0)
+    total_devices = models.IntegerField(default=0)
+    with_coordinates = models.IntegerField(default=0)
+    status_counts = models.JSONField(default=dict, blank=True)  # datastatus_description -> devices
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Fleet stats: {self.total_devices} devices @ {self.updated_at}"
+
+
+class SnapshotDelta(models.Model):
+    """Changes committed by one load, pushed to live dashboards (see api.services.live_updates)"""
+    id = models.BigAutoField(primary_key=True)  # also the SSE event id
+    version = models.BigIntegerField()  # FleetStats.version after the load
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Delta {self.id} (snapshot v{self.version})"
+
+
+class Geofence(models.Model):
+    """Depot or zone checked against every device after each load (see api.services.geofences)"""
+    KIND_POLYGON = 'polygon'
+    KIND_CIRCLE = 'circle'
+    KIND_CHOICES = [
+        (KIND_POLYGON, 'Polygon'),
+        (KIND_CIRCLE, 'Circle'),
+    ]
+
+    name = models.CharField(max_length=100)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Polygon vertices as [[latitude, longitude], ...]; the ring closes implicitly
+    points = models.JSONField(default=list, blank=True)
+    center_latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    center_longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    radius_m = models.FloatField(null=True, blank=True)
+    active = models.BooleanField(default=True)
+    # Set by the first evaluation, which records who is inside without emitting events
+    evaluated_at = models.DateTimeField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Geofence {self.name} ({self.kind})"
+
+
+class GeofenceMembership(models.Model):
+    """Devices currently inside a geofence; the previous state each evaluation is diffed against"""
+    geofence = models.ForeignKey(Geofence, on_delete=models.CASCADE, related_name='memberships')
+    imei = models.CharField(max_length=20)
+    entered_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['geofence', 'imei'], name='unique_geofence_membership'),
+        ]
+
+    def __str__(self):
+        return f"IMEI: {self.imei} in {self.geofence_id}"
+
+
+class GeofenceEvent(models.Model):
+    """A device entering or leaving a geofence, as seen by one evaluation"""
+    EVENT_ENTER = 'enter'
+    EVENT_EXIT = 'exit'
+    EVENT_CHOICES = [
+        (EVENT_ENTER, 'Enter'),
+        (EVENT_EXIT, 'Exit'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    geofence = models.ForeignKey(Geofence, on_delete=models.CASCADE, related_name='events')
+    imei = models.CharField(max_length=20)
+    event = models.CharField(max_length=10, choices=EVENT_CHOICES)
+    # Device position and heartbeat at the evaluation that saw the transition
+    latitude = models.DecimalField(max_digits=9, decimal_places=6)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6)
+    hearttime_unix = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['geofence', 'created_at'], name='geofence_event_fence_idx'),
+            models.Index(fields=['imei', 'created_at'], name='geofence_event_imei_idx'),
+        ]
+
+    def __str__(self):
+        return f"IMEI: {self.imei} {self.event} {self.geofence_id}"
+
+
+class DeviceTile(models.Model):
+    """One Mapbox Vector Tile of the device layer (see api.services.vector_tiles)"""
+    zoom = models.SmallIntegerField()
+    x = models.IntegerField()
+    y = models.IntegerField()
+    data = models.BinaryField()
+    features = models.IntegerField(default=0)
+    # Snapshot version the tile was last encoded at: its ETag, and the pyramid version is the highest
+    version = models.BigIntegerField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['zoom', 'x', 'y'], name='unique_device_tile'),
+        ]
+
+    def __str__(self):
+        return f"Tile {self.zoom}/{self.x}/{self.y} (v{self.version})"
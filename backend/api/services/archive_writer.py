@@ -0,0 +1,175 @@
+import csv
+import json
+import os
+import queue
+import textwrap
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.conf import settings
+
+from .snapshot_archive import SNAPSHOT_FILENAME, SnapshotWriter, read_records
+
+# Columns of all_records.csv
+RECORD_FIELDNAMES = [
+    "imei", "latitude", "longitude", "coordinates",
+    "datastatus", "datastatus_description",
+    "hearttime_date", "hearttime_time",
+    "hearttime_unix", "TimeSinceUpdate", "TimeAgo", "status"
+]
+
+FORMAT_SNAPSHOT = "snapshot"
+FORMAT_JSON = "json"
+FORMAT_CSV = "csv"
+
+# Files written per run. The compact snapshot replaces the pretty-printed JSON by
+# default; set ARCHIVE_FORMATS=snapshot,json,csv to keep writing all_records.json too.
+ARCHIVE_FORMATS = [
+    name.strip() for name in os.getenv("ARCHIVE_FORMATS", "snapshot,csv").split(",") if name.strip()
+]
+
+
+def create_run_folder(custom_name: Optional[str] = None) -> str:
+    """Create (if needed) and return response_logs/<custom_name or tracking_run_<timestamp>>"""
+    if custom_name:
+        folder_name = custom_name
+    else:
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        folder_name = f'tracking_run_{timestamp}'
+
+    run_folder = os.path.join(settings.BASE_DIR, 'response_logs', folder_name)
+    os.makedirs(run_folder, exist_ok=True)
+    return run_folder
+
+
+class TrackingRunWriter:
+    """Write a run's archive files chunk by chunk.
+
+    Formats: all_records.snap (compact columnar snapshot), all_records.json
+    and all_records.csv. The JSON file is byte-for-byte what
+    ``json.dump(data, indent=2)`` would produce for the concatenated chunks,
+    without holding them all in memory.
+    """
+
+    def __init__(self, run_folder: str, fieldnames: List[str] = RECORD_FIELDNAMES,
+                 formats: Optional[List[str]] = None):
+        formats = formats or ARCHIVE_FORMATS
+        self.fieldnames = fieldnames
+        self.count = 0
+        self.json_filename = os.path.join(run_folder, "all_records.json") if FORMAT_JSON in formats else None
+        self.csv_filename = os.path.join(run_folder, "all_records.csv") if FORMAT_CSV in formats else None
+        self.snapshot_filename = os.path.join(run_folder, SNAPSHOT_FILENAME) if FORMAT_SNAPSHOT in formats else None
+        self._closed = False
+        self._json_file = open(self.json_filename, "w", encoding="utf-8") if self.json_filename else None
+        self._csv_file = None
+        if self.csv_filename:
+            self._csv_file = open(self.csv_filename, "w", newline='', encoding="utf-8")
+            self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=fieldnames)
+            self._csv_writer.writeheader()
+        self._snapshot = SnapshotWriter(self.snapshot_filename) if self.snapshot_filename else None
+
+    @property
+    def filenames(self) -> List[str]:
+        return [name for name in (self.snapshot_filename, self.json_filename, self.csv_filename) if name]
+
+    def write(self, records: Iterable[Dict[str, Any]]):
+        records = list(records)
+        for row in records:
+            if self._json_file:
+                self._json_file.write("[\n" if self.count == 0 else ",\n")
+                self._json_file.write(textwrap.indent(json.dumps(row, ensure_ascii=False, indent=2), "  "))
+            if self._csv_file:
+                self._csv_writer.writerow({field: row.get(field, "") for field in self.fieldnames})
+            self.count += 1
+        if self._snapshot:
+            self._snapshot.write(records)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._json_file:
+            self._json_file.write("[]" if self.count == 0 else "\n]")
+            self._json_file.close()
+        if self._csv_file:
+            self._csv_file.close()
+        if self._snapshot:
+            self._snapshot.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def find_run_archive(run_folder: str) -> Optional[str]:
+    """The run's loadable archive: the snapshot if present, else all_records.json"""
+    for filename in (SNAPSHOT_FILENAME, "all_records.json"):
+        path = os.path.join(run_folder, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_run_records(path: str) -> List[Dict[str, Any]]:
+    """Processed records from a run archive (snapshot or JSON)"""
+    if path.endswith(".snap"):
+        return read_records(path)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class BackgroundRunWriter:
+    """TrackingRunWriter running on its own thread.
+
+    ``write`` only queues the chunk, so serializing the archive never holds up
+    fetching or loading. ``close`` waits for the queue to drain and re-raises
+    any error the writer thread hit.
+    """
+
+    _DONE = object()
+
+    def __init__(self, run_folder: str, fieldnames: List[str] = RECORD_FIELDNAMES,
+                 formats: Optional[List[str]] = None):
+        self.run_folder = run_folder
+        self._writer = TrackingRunWriter(run_folder, fieldnames, formats)
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="tracking-archive-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def count(self) -> int:
+        return self._writer.count
+
+    def _run(self):
+        while True:
+            records = self._queue.get()
+            if records is self._DONE:
+                break
+            if self._error is None:
+                try:
+                    self._writer.write(records)
+                except Exception as e:
+                    self._error = e
+        self._writer.close()
+
+    def write(self, records: Iterable[Dict[str, Any]]):
+        self._queue.put(list(records))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._DONE)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,244 @@
+"""Zoom-level device clusters for the map, built from a hierarchical grid.
+
+Positions are projected to Web Mercator and binned into square cells of
+CELL_PIXELS screen pixels: at zoom z the world is ``2**z`` tiles across and
+every tile is split into CELLS_PER_TILE x CELLS_PER_TILE cells. Cell
+numbers are powers of two apart between zoom levels, so the cells of
+zoom z are those of zoom z + 1 with their coordinates halved: the levels
+are aggregated bottom-up from MAX_CLUSTER_ZOOM in one pass each, with no
+distance computations. Every level keeps per cell the device count, the
+centroid and the count per datastatus_description, sorted by tile so the
+clusters of one map tile are a contiguous slice.
+
+Each web process keeps one index and rebuilds it lazily when the snapshot
+version changes; the per-tile cluster lists are additionally cached per
+(snapshot, zoom, tile) in the 'responses' cache.
+"""
+import logging
+import threading
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from api.models import DeviceData
+from api.services.response_cache import get_snapshot
+from api.services.spatial import Bbox, parse_bbox
+
+logger = logging.getLogger(__name__)
+
+# Cells per tile side, as a power of two; 4 cells of 64 px on a 256 px tile
+CELL_BITS = 2
+CELLS_PER_TILE = 1 << CELL_BITS
+CELL_PIXELS = 256 // CELLS_PER_TILE
+# Deepest aggregated level (cells of about 40 m); higher zooms are served from it
+MAX_CLUSTER_ZOOM = 18
+MAX_REQUEST_ZOOM = 24
+# Tiles one request may span; a full-HD viewport needs about 40
+MAX_CLUSTER_TILES = 100
+# Web Mercator stops here; devices further north or south are drawn on the edge
+MAX_MERCATOR_LATITUDE = 85.05112878
+
+
+def mercator_xy(latitudes: np.ndarray, longitudes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Web Mercator position in 0..1 for positions in degrees (y grows southwards)"""
+    lat = np.radians(np.clip(latitudes, -MAX_MERCATOR_LATITUDE, MAX_MERCATOR_LATITUDE))
+    x = (np.asarray(longitudes, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return np.clip(x, 0, 1), np.clip(y, 0, 1)
+
+
+def tile_range(bbox: Bbox, zoom: int) -> Tuple[List[Tuple[int, int]], int, int]:
+    """Tiles of ``zoom`` covering ``bbox``: (x spans, first y, last y).
+
+    A box whose min_lon is greater than its max_lon crosses the antimeridian
+    and gets two x spans.
+    """
+    min_lat, min_lon, max_lat, max_lon = (float(value) for value in bbox)
+    tiles = 1 << zoom
+    (west, east), (north, south) = mercator_xy(np.array([max_lat, min_lat]), np.array([min_lon, max_lon]))
+
+    def tile(position: float) -> int:
+        return min(int(position * tiles), tiles - 1)
+
+    if min_lon <= max_lon:
+        spans = [(tile(west), tile(east))]
+    else:
+        spans = [(tile(west), tiles - 1), (0, tile(east))]
+    return spans, tile(north), tile(south)
+
+
+class ClusterLevel:
+    """The occupied cells of one zoom level, sorted by (tile, cell)"""
+
+    def __init__(self, zoom: int, cell_x: np.ndarray, cell_y: np.ndarray, counts: np.ndarray,
+                 latitude_sums: np.ndarray, longitude_sums: np.ndarray, status_counts: np.ndarray,
+                 representatives: np.ndarray):
+        self.zoom = zoom
+        tile_keys = (cell_y >> CELL_BITS) * (1 << zoom) + (cell_x >> CELL_BITS)
+        order = np.lexsort((cell_x, cell_y, tile_keys))
+        self.tile_keys = tile_keys[order]
+        self.cell_x = cell_x[order]
+        self.cell_y = cell_y[order]
+        self.counts = counts[order]
+        self.latitude_sums = latitude_sums[order]
+        self.longitude_sums = longitude_sums[order]
+        self.status_counts = status_counts[order]
+        # Index of one member device per cell (the only one for single devices)
+        self.representatives = representatives[order]
+
+    def coarser(self) -> 'ClusterLevel':
+        """The level one zoom out: cells merged two by two along each axis"""
+        cell_x, cell_y = self.cell_x >> 1, self.cell_y >> 1
+        keys = cell_y * (CELLS_PER_TILE << (self.zoom - 1)) + cell_x
+        _, first, groups = np.unique(keys, return_index=True, return_inverse=True)
+        size = len(first)
+
+        def total(values: np.ndarray) -> np.ndarray:
+            return np.bincount(groups, weights=values, minlength=size)
+
+        status_counts = np.column_stack([
+            total(self.status_counts[:, column]) for column in range(self.status_counts.shape[1])
+        ]).astype(np.int64) if size else self.status_counts[:0]
+        return ClusterLevel(
+            self.zoom - 1, cell_x[first], cell_y[first], total(self.counts).astype(np.int64),
+            total(self.latitude_sums), total(self.longitude_sums), status_counts, self.representatives[first],
+        )
+
+    def tile_slice(self, x: int, y: int) -> slice:
+        key = y * (1 << self.zoom) + x
+        return slice(int(np.searchsorted(self.tile_keys, key, 'left')),
+                     int(np.searchsorted(self.tile_keys, key, 'right')))
+
+
+class ClusterIndex:
+    """ClusterLevels 0..MAX_CLUSTER_ZOOM of one snapshot version"""
+
+    def __init__(self, version: int, imeis: List[str], latitudes: np.ndarray, longitudes: np.ndarray,
+                 descriptions: List[str]):
+        self.version = version
+        self.imeis = imeis
+        self.device_count = len(imeis)
+        self.statuses, status_codes = np.unique(np.array(descriptions, dtype=str), return_inverse=True)
+        self.statuses = self.statuses.tolist()
+
+        x, y = mercator_xy(latitudes, longitudes)
+        cells = CELLS_PER_TILE << MAX_CLUSTER_ZOOM
+        cell_x = np.minimum((x * cells).astype(np.int64), cells - 1)
+        cell_y = np.minimum((y * cells).astype(np.int64), cells - 1)
+        status_counts = np.zeros((len(imeis), len(self.statuses)), dtype=np.int64)
+        status_counts[np.arange(len(imeis)), status_codes] = 1
+
+        # The deepest level starts with one "cell" per device; coarser() merges duplicates
+        level = ClusterLevel(
+            MAX_CLUSTER_ZOOM + 1, cell_x << 1, cell_y << 1, np.ones(len(imeis), dtype=np.int64),
+            latitudes.astype(np.float64), longitudes.astype(np.float64), status_counts, np.arange(len(imeis)),
+        )
+        self.levels = []
+        for _ in range(MAX_CLUSTER_ZOOM + 1):
+            level = level.coarser()
+            self.levels.append(level)
+        self.levels.reverse()
+
+    @classmethod
+    def build(cls, version: int) -> 'ClusterIndex':
+        rows = list(
+            DeviceData.objects
+            .exclude(latitude=0, longitude=0)
+            .exclude(coordinates='0,0')
+            .filter(latitude__gte=-90, latitude__lte=90, longitude__gte=-180, longitude__lte=180)
+            .values_list('imei', 'latitude', 'longitude', 'datastatus_description')
+            .iterator(chunk_size=5000)
+        )
+        return cls(
+            version,
+            [row[0] for row in rows],
+            np.array([row[1] for row in rows], dtype=np.float64),
+            np.array([row[2] for row in rows], dtype=np.float64),
+            [row[3] or '' for row in rows],
+        )
+
+    def tile_clusters(self, zoom: int, x: int, y: int) -> List[Dict[str, Any]]:
+        """Clusters of one tile of ``zoom`` (at most MAX_CLUSTER_ZOOM)"""
+        level = self.levels[zoom]
+        window = level.tile_slice(x, y)
+        counts = level.counts[window].tolist()
+        latitudes = (level.latitude_sums[window] / level.counts[window]).tolist()
+        longitudes = (level.longitude_sums[window] / level.counts[window]).tolist()
+        clusters = []
+        for count, latitude, longitude, statuses, representative in zip(
+                counts, latitudes, longitudes, level.status_counts[window].tolist(),
+                level.representatives[window].tolist()):
+            cluster = {
+                'latitude': round(latitude, 6),
+                'longitude': round(longitude, 6),
+                'count': count,
+                'statuses': {status: devices for status, devices in zip(self.statuses, statuses) if devices},
+            }
+            if count == 1:
+                cluster['imei'] = self.imeis[representative]
+            clusters.append(cluster)
+        return clusters
+
+
+_index = None
+_build_lock = threading.Lock()
+
+
+def get_cluster_index() -> ClusterIndex:
+    """The index of the current snapshot.
+
+    While another thread rebuilds, the previous index keeps answering; only
+    the very first build is waited for.
+    """
+    global _index
+    version, _ = get_snapshot()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    if not _build_lock.acquire(blocking=index is None):
+        return index
+    try:
+        if _index is None or _index.version != version:
+            _index = ClusterIndex.build(version)
+            logger.info(f"Cluster index rebuilt for snapshot v{version}: {_index.device_count} devices")
+        return _index
+    finally:
+        _build_lock.release()
+
+
+def parse_cluster_params(params: Dict[str, str]) -> Tuple[int, Optional[Bbox]]:
+    """(zoom, bbox) from ``?zoom=&bbox=west,south,east,north``; raises ValueError.
+
+    ``bbox`` is in the order of Leaflet's toBBoxString() and may be left out
+    for the whole world.
+    """
+    try:
+        zoom = int(params['zoom'])
+    except (KeyError, ValueError):
+        raise ValueError('zoom is a required integer')
+    if not 0 <= zoom <= MAX_REQUEST_ZOOM:
+        raise ValueError(f'zoom must be between 0 and {MAX_REQUEST_ZOOM}')
+    if not params.get('bbox'):
+        return zoom, None
+    parts = params['bbox'].split(',')
+    if len(parts) != 4:
+        raise ValueError('bbox must be west,south,east,north')
+    west, south, east, north = (part.strip() for part in parts)
+    return zoom, parse_bbox({'min_lat': south, 'min_lon': west, 'max_lat': north, 'max_lon': east})
+
+
+def cluster_tiles(zoom: int, bbox: Optional[Bbox]) -> List[Tuple[int, int]]:
+    """(x, y) of the tiles of ``zoom`` covering ``bbox`` (the whole world when None); raises ValueError"""
+    if bbox is None:
+        bbox = (Decimal(-90), Decimal(-180), Decimal(90), Decimal(180))
+    spans, first_y, last_y = tile_range(bbox, zoom)
+    tile_count = sum(last - first + 1 for first, last in spans) * (last_y - first_y + 1)
+    if tile_count > MAX_CLUSTER_TILES:
+        raise ValueError(f'bbox spans {tile_count} tiles at zoom {zoom}; at most {MAX_CLUSTER_TILES} are allowed')
+    return [(x, y) for y in range(first_y, last_y + 1) for first, last in spans for x in range(first, last + 1)]
+
+
+def cluster_zoom(zoom: int) -> int:
+    """The aggregated level that serves a requested map zoom"""
+    return min(zoom, MAX_CLUSTER_ZOOM)
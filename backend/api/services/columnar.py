@@ -0,0 +1,209 @@
+"""Vectorized (NumPy) processing of raw API device records.
+
+Device records are pulled into columns once, then GMT+7 date/time, elapsed
+strings, status descriptions and coordinate strings are computed in whole-
+array passes against a single shared "now". ``process_batch`` (streaming
+fetch and refresh) runs it per batch and ``process_tracking_data`` once
+over a whole run. The output is identical to the per-record
+``protrack_service.process_devices`` called with the same ``now``; values
+the fast path cannot represent exactly (floats, unparsable strings,
+timestamps outside 1970-2100) fall back to the scalar helpers.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .protrack_service import (
+    combine_coordinates,
+    convert_hearttime_to_gmt7_separated,
+    format_time_since,
+    get_relative_short,
+)
+from .time_labels import format_elapsed, format_relative
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+GMT7_OFFSET_SECONDS = 7 * 3600
+# Fast path range for hearttime (1970-01-01 .. 2100-01-01 UTC)
+MAX_FAST_TIMESTAMP = 4102444800
+
+US_PER_SECOND = 1_000_000
+US_PER_MINUTE = 60 * US_PER_SECOND
+
+INVALID_COORDINATES = ["", "0", "0.0", "None", "null"]
+
+# index = datastatus code; anything else is "Unknown"
+STATUS_DESCRIPTIONS = np.array(
+    ["Unknown", "Never online", "Online", "Expired", "Offline", "Block", "Unknown"], dtype=object
+)
+
+# hearttime kinds
+HT_EMPTY = 0
+HT_FAST = 1
+HT_SCALAR = 2
+
+
+def _hearttime_kind(value):
+    """Classify a raw hearttime as empty, fast-path int, or scalar fallback"""
+    if not value or value in ["", "0", 0, "None", "null", None]:
+        return HT_EMPTY, 0
+    if type(value) is int:
+        ts = value
+    elif type(value) is str:
+        try:
+            ts = int(value)
+        except ValueError:
+            return HT_SCALAR, 0
+    else:
+        return HT_SCALAR, 0
+    if 0 <= ts < MAX_FAST_TIMESTAMP:
+        return HT_FAST, ts
+    return HT_SCALAR, 0
+
+
+def _status_codes(datastatus: List[Any]) -> np.ndarray:
+    """datastatus column -> codes 1..5, 0 for anything that maps to Unknown"""
+    if set(map(type, datastatus)) == {int}:
+        try:
+            codes = np.array(datastatus, dtype=np.int64)
+        except OverflowError:
+            codes = None
+        if codes is not None:
+            return np.where((codes >= 1) & (codes <= 5), codes, 0)
+
+    def code(value):
+        try:
+            value = int(value)
+        except (ValueError, TypeError):
+            return 0
+        return value if 1 <= value <= 5 else 0
+
+    return np.fromiter((code(v) for v in datastatus), dtype=np.int64, count=len(datastatus))
+
+
+def _parse_hearttimes(hearttimes: List[Any]):
+    """hearttime column -> (kinds, timestamps) arrays"""
+    n = len(hearttimes)
+    if set(map(type, hearttimes)) == {int}:
+        try:
+            timestamps = np.array(hearttimes, dtype=np.int64)
+        except OverflowError:
+            timestamps = None
+        if timestamps is not None:
+            in_range = (timestamps >= 0) & (timestamps < MAX_FAST_TIMESTAMP)
+            kinds = np.where(timestamps == 0, HT_EMPTY, np.where(in_range, HT_FAST, HT_SCALAR)).astype(np.int8)
+            return kinds, np.where(kinds == HT_FAST, timestamps, 0)
+
+    parsed = [_hearttime_kind(value) for value in hearttimes]
+    kinds = np.fromiter((kind for kind, _ in parsed), dtype=np.int8, count=n)
+    timestamps = np.fromiter((ts for _, ts in parsed), dtype=np.int64, count=n)
+    return kinds, timestamps
+
+
+_TIME_OF_DAY = None
+
+
+def _time_of_day_table() -> np.ndarray:
+    """'HH:MM:SS' for every second of the day, built once"""
+    global _TIME_OF_DAY
+    if _TIME_OF_DAY is None:
+        _TIME_OF_DAY = np.array(
+            [f"{h:02d}:{m:02d}:{sec:02d}" for h in range(24) for m in range(60) for sec in range(60)], dtype=object
+        )
+    return _TIME_OF_DAY
+
+
+def _map_unique(values: np.ndarray, formatter) -> np.ndarray:
+    """Format each distinct value once and broadcast back (object array)"""
+    unique, inverse = np.unique(values, return_inverse=True)
+    return np.array([formatter(v) for v in unique.tolist()], dtype=object)[inverse]
+
+
+def process_devices_columnar(devices: List[Dict[str, Any]], now: datetime) -> List[Dict[str, Any]]:
+    """Turn a list of raw API device dicts into processed records, column by column"""
+    n = len(devices)
+    if n == 0:
+        return []
+
+    imeis = [str(d.get('imei', '')) for d in devices]
+    latitudes = [d.get('latitude', '') for d in devices]
+    longitudes = [d.get('longitude', '') for d in devices]
+    datastatus = [d.get('datastatus', '') for d in devices]
+    hearttimes = [d.get('hearttime', '') for d in devices]
+
+    # Status descriptions: one lookup over the parsed codes
+    descriptions = STATUS_DESCRIPTIONS[_status_codes(datastatus)].tolist()
+
+    # Coordinates: "lat,lon" where both are truthy and not a placeholder
+    lat_list = [str(v) for v in latitudes]
+    lon_list = [str(v) for v in longitudes]
+    lat_str = np.array(lat_list, dtype=str)
+    lon_str = np.array(lon_list, dtype=str)
+    truthy = np.fromiter((bool(a) and bool(b) for a, b in zip(latitudes, longitudes)), dtype=bool, count=n)
+    valid = truthy & ~np.isin(lat_str, INVALID_COORDINATES) & ~np.isin(lon_str, INVALID_COORDINATES)
+    coordinates = [f"{lat},{lon}" if ok else "0,0" for lat, lon, ok in zip(lat_list, lon_list, valid.tolist())]
+    # NumPy unicode arrays drop trailing NULs; such values go through the scalar helper
+    if '\x00' in ''.join(lat_list) or '\x00' in ''.join(lon_list):
+        for i, (lat, lon) in enumerate(zip(lat_list, lon_list)):
+            if '\x00' in lat or '\x00' in lon:
+                coordinates[i] = combine_coordinates(latitudes[i], longitudes[i])
+
+    # Hearttime columns
+    kinds, timestamps = _parse_hearttimes(hearttimes)
+    fast = kinds == HT_FAST
+
+    heart_date = np.full(n, '', dtype=object)
+    heart_time = np.full(n, '', dtype=object)
+    elapsed = np.full(n, '', dtype=object)
+    relative = np.full(n, '', dtype=object)
+
+    if fast.any():
+        ts = timestamps[fast]
+
+        # GMT+7 date from the day number, time of day from a per-second table
+        local = ts + GMT7_OFFSET_SECONDS
+        days, day_inverse = np.unique(local // 86400, return_inverse=True)
+        day_strings = np.datetime_as_string(days.astype('datetime64[D]')).astype(object)
+        heart_date[fast] = day_strings[day_inverse]
+        heart_time[fast] = _time_of_day_table()[local % 86400]
+
+        # Both elapsed strings depend only on the whole minutes since the fix
+        # (timedelta semantics: floored, so future timestamps go negative)
+        now_us = (now - EPOCH) // timedelta(microseconds=1)
+        mins = (now_us - ts * US_PER_SECOND) // US_PER_MINUTE
+        elapsed[fast] = _map_unique(mins, format_elapsed)
+        relative[fast] = _map_unique(mins, format_relative)
+
+    heart_date = heart_date.tolist()
+    heart_time = heart_time.tolist()
+    elapsed = elapsed.tolist()
+    relative = relative.tolist()
+    for i in np.flatnonzero(kinds == HT_SCALAR).tolist():
+        value = hearttimes[i]
+        heart_date[i], heart_time[i] = convert_hearttime_to_gmt7_separated(value)
+        elapsed[i] = format_time_since(value, now) or ''
+        relative[i] = get_relative_short(value, now) or ''
+
+    return [
+        {
+            'imei': imei,
+            'latitude': lat,
+            'longitude': lon,
+            'coordinates': coords,
+            'datastatus': status,
+            'datastatus_description': description,
+            'hearttime_date': date_part,
+            'hearttime_time': time_part,
+            'hearttime_unix': hearttime,
+            'TimeSinceUpdate': since,
+            'TimeAgo': ago,
+            'status': 'success'
+        }
+        for imei, lat, lon, coords, status, description, date_part, time_part, hearttime, since, ago in zip(
+            imeis, latitudes, longitudes, coordinates, datastatus, descriptions,
+            heart_date, heart_time, hearttimes, elapsed, relative,
+        )
+    ]
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+# Outcomes recorded for each finished request
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'          # failed, but not a sign of upstream overload
+OUTCOME_THROTTLED = 'throttled'  # timeout, 429 or 5xx: back off
+
+
+def classify_batch_result(result: Any) -> str:
+    """Map a fetch_batch result to a limiter outcome"""
+    if not isinstance(result, dict) or "error" not in result:
+        return OUTCOME_OK
+    if result.get("error_type") == "timeout":
+        return OUTCOME_THROTTLED
+    http_status = result.get("http_status")
+    if http_status is not None and (http_status == 429 or http_status >= 500):
+        return OUTCOME_THROTTLED
+    return OUTCOME_ERROR
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on the number of in-flight batch requests.
+
+    The limit grows by one after each window of requests whose p95 latency
+    and error rate are healthy, and is multiplied by ``backoff_factor`` when
+    a request times out or is throttled, or when a window's p95 latency
+    exceeds ``latency_target`` (at most once per cooldown so one burst of
+    failures counts as a single congestion signal).
+
+    Use as ``async with limiter:`` around a request and call ``record()``
+    with its latency and outcome.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 32,
+                 latency_target: float = 10.0, error_rate_threshold: float = 0.1,
+                 backoff_factor: float = 0.5, sample_size: int = 50):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.error_rate_threshold = error_rate_threshold
+        self.backoff_factor = backoff_factor
+
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self._in_flight = 0
+        self._condition = None
+        self._latencies = deque(maxlen=sample_size)
+        self._outcomes = deque(maxlen=sample_size)
+        self._since_adjust = 0
+        self._cooldown_until = 0.0
+
+        self.peak_limit = int(self._limit)
+        self.total_requests = 0
+        self.total_throttled = 0
+        self.total_errors = 0
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so the limiter binds to the loop that uses it
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def __aenter__(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        condition = self._get_condition()
+        async with condition:
+            self._in_flight -= 1
+            condition.notify_all()
+        return False
+
+    def p95_latency(self) -> float:
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for o in self._outcomes if o != OUTCOME_OK) / len(self._outcomes)
+
+    def record(self, latency: float, outcome: str = OUTCOME_OK):
+        """Feed back one finished request and adjust the limit"""
+        self.total_requests += 1
+        self._latencies.append(latency)
+        self._outcomes.append(outcome)
+
+        if outcome == OUTCOME_THROTTLED:
+            self.total_throttled += 1
+            self._decrease("Upstream throttling/timeout")
+            return
+
+        if outcome == OUTCOME_ERROR:
+            self.total_errors += 1
+
+        self._since_adjust += 1
+        if self._since_adjust < self.limit:
+            return
+        self._since_adjust = 0
+        p95 = self.p95_latency()
+        if p95 > self.latency_target:
+            self._decrease(f"p95 latency {p95:.1f}s over target")
+        elif self.error_rate() <= self.error_rate_threshold:
+            if self._limit < self.max_limit:
+                self._limit = min(float(self.max_limit), self._limit + 1)
+                self.peak_limit = max(self.peak_limit, self.limit)
+                self._notify_waiters()
+
+    def _decrease(self, reason: str):
+        """Multiplicative decrease, skipped while the previous one cools down"""
+        now = time.monotonic()
+        if now < self._cooldown_until:
+            return
+        old = self.limit
+        self._limit = max(float(self.min_limit), self._limit * self.backoff_factor)
+        self._cooldown_until = now + max(self.p95_latency(), 1.0)
+        self._since_adjust = 0
+        self.decreases += 1
+        logger.warning(f"{reason}, concurrency {old} -> {self.limit}")
+
+    def _notify_waiters(self):
+        condition = self._condition
+        if condition is None:
+            return
+
+        async def _wake():
+            async with condition:
+                condition.notify_all()
+
+        try:
+            asyncio.get_running_loop().create_task(_wake())
+        except RuntimeError:
+            pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Summary of the run, including the concurrency the limiter settled on"""
+        return {
+            'concurrency': self.limit,
+            'peak_concurrency': self.peak_limit,
+            'p95_latency': round(self.p95_latency(), 3),
+            'error_rate': round(self.error_rate(), 3),
+            'requests': self.total_requests,
+            'throttled': self.total_throttled,
+            'errors': self.total_errors,
+            'decreases': self.decreases,
+        }
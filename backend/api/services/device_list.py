@@ -0,0 +1,121 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from api.models import DeviceData
+from api.services.time_labels import now_timestamp, time_labels
+
+# Upper bound for per_page in cursor mode
+MAX_PER_PAGE = 1000
+
+# Columns read for the device list, in the order serialize_device_rows unpacks them
+DEVICE_LIST_FIELDS = [
+    'ranking_id', 'imei', 'latitude', 'longitude', 'coordinates',
+    'datastatus', 'datastatus_description',
+    'hearttime_date', 'hearttime_time', 'hearttime_unix',
+    'status', 'created_at', 'updated_at',
+]
+
+# Keys of a serialized device record, in response order; the choices for ``?fields=``
+DEVICE_RECORD_FIELDS = [
+    'ranking_id', 'imei', 'latitude', 'longitude', 'coordinates',
+    'datastatus', 'datastatus_description',
+    'hearttime_date', 'hearttime_time', 'hearttime_unix',
+    'TimeSinceUpdate', 'TimeAgo',
+    'status', 'created_at', 'updated_at',
+]
+TIME_LABEL_FIELDS = ('TimeSinceUpdate', 'TimeAgo')
+
+LAYOUT_RECORDS = 'records'
+LAYOUT_COLUMNS = 'columns'
+
+
+def serialize_device_rows(rows) -> List[Dict[str, Any]]:
+    """API dicts for ``values_list(*DEVICE_LIST_FIELDS)`` tuples.
+
+    TimeSinceUpdate/TimeAgo are left empty so the result can be cached;
+    apply_time_labels fills them in when the response is sent.
+    """
+    data = []
+    for (ranking_id, imei, latitude, longitude, coordinates, datastatus, description,
+         hearttime_date, hearttime_time, hearttime_unix, status, created_at, updated_at) in rows:
+        data.append({
+            'ranking_id': ranking_id,
+            'imei': imei,
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'coordinates': coordinates,
+            'datastatus': datastatus,
+            'datastatus_description': description,
+            'hearttime_date': hearttime_date.isoformat() if hearttime_date else '',
+            'hearttime_time': hearttime_time.strftime('%H:%M:%S') if hearttime_time else '',
+            'hearttime_unix': hearttime_unix,
+            'TimeSinceUpdate': '',
+            'TimeAgo': '',
+            'status': status,
+            'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+        })
+    return data
+
+
+def apply_time_labels(data: List[Dict[str, Any]], now: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Fill in TimeSinceUpdate/TimeAgo relative to ``now`` (unix seconds), in place"""
+    now = now_timestamp() if now is None else now
+    for device in data:
+        device['TimeSinceUpdate'], device['TimeAgo'] = time_labels(device['hearttime_unix'], now)
+    return data
+
+
+def parse_projection(params: Dict[str, str]) -> Tuple[Optional[List[str]], bool]:
+    """``(fields, columnar)`` from ``?fields=`` (comma-separated record keys) and ``?layout=records|columns``"""
+    fields = None
+    if params.get('fields'):
+        fields = list(dict.fromkeys(field.strip() for field in params['fields'].split(',') if field.strip()))
+        unknown = [field for field in fields if field not in DEVICE_RECORD_FIELDS]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)} (choose from {", ".join(DEVICE_RECORD_FIELDS)})')
+    layout = params.get('layout', LAYOUT_RECORDS)
+    if layout not in (LAYOUT_RECORDS, LAYOUT_COLUMNS):
+        raise ValueError(f'layout must be {LAYOUT_RECORDS} or {LAYOUT_COLUMNS}')
+    return fields, layout == LAYOUT_COLUMNS
+
+
+def shape_devices(data: List[Dict[str, Any]], fields: Optional[List[str]] = None, columnar: bool = False,
+                  now: Optional[int] = None) -> Dict[str, Any]:
+    """Response body entries for device records.
+
+    ``{'data': [records]}``, or with ``columnar`` ``{'columns': fields,
+    'rows': [[values]]}`` which names each field once instead of per record.
+    ``fields`` projects the records (all fields by default); time labels are
+    only computed when requested.
+    """
+    fields = fields or DEVICE_RECORD_FIELDS
+    if any(field in fields for field in TIME_LABEL_FIELDS):
+        apply_time_labels(data, now)
+    if columnar:
+        return {'columns': fields, 'rows': [[device[field] for field in fields] for device in data]}
+    if fields == DEVICE_RECORD_FIELDS:
+        return {'data': data}
+    return {'data': [{field: device[field] for field in fields} for device in data]}
+
+
+def parse_cursor(cursor: str) -> Optional[int]:
+    """ranking_id a cursor points after; an empty cursor is the first page"""
+    return int(cursor) if cursor else None
+
+
+def get_device_page_after(cursor: Optional[int], per_page: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of devices with ranking_id > ``cursor`` (keyset pagination).
+
+    Seeks on the primary key index, so every page costs the same no matter
+    how deep it is. Returns the page and the cursor of the next one (None on
+    the last page).
+    """
+    queryset = DeviceData.objects.order_by('ranking_id')
+    if cursor is not None:
+        queryset = queryset.filter(ranking_id__gt=cursor)
+    # One extra row tells whether there is a next page without counting
+    rows = list(queryset.values_list(*DEVICE_LIST_FIELDS)[:per_page + 1])
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = str(rows[-1][0]) if has_next else None
+    return serialize_device_rows(rows), next_cursor
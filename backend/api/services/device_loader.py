@@ -0,0 +1,379 @@
+import io
+import logging
+from datetime import date, datetime, time, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.models import DeviceData, PositionHistory
+from api.services.position_history import ensure_partitions
+from api.services.spatial import coordinates_text, grid_cell
+from api.signals import devices_changed
+
+logger = logging.getLogger(__name__)
+
+# Rows per upsert statement / COPY
+DEFAULT_CHUNK_SIZE = 2000
+
+# Columns written from a record (ranking_id, created_at and updated_at are managed separately)
+DEVICE_COLUMNS = [
+    'imei', 'latitude', 'longitude', 'coordinates',
+    'datastatus', 'datastatus_description',
+    'hearttime_date', 'hearttime_time', 'hearttime_unix',
+    'status', 'last_update_detailed_db', 'last_update_relative_db', 'grid_cell',
+]
+
+COORDINATE_QUANTUM = Decimal('0.000001')
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+BIGINT_MIN, BIGINT_MAX = -2 ** 63, 2 ** 63 - 1
+
+# DeviceData columns copied into PositionHistory when hearttime_unix changes
+HISTORY_COLUMNS = ['imei', 'hearttime_unix', 'latitude', 'longitude', 'datastatus']
+
+# Columns compared against the stored state; the remaining columns are derived from these
+STATE_COLUMNS = ['hearttime_unix', 'datastatus', 'latitude', 'longitude']
+
+DeviceState = Dict[str, Tuple[int, int, Decimal, Decimal]]
+
+
+def _parse_date(value) -> Optional[date]:
+    # fromisoformat is far cheaper than strptime; the length check keeps it to exactly YYYY-MM-DD
+    if isinstance(value, str) and len(value) == 10:
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    return None
+
+
+def _parse_time(value) -> Optional[time]:
+    if isinstance(value, str) and len(value) == 8:
+        try:
+            return time.fromisoformat(value)
+        except ValueError:
+            pass
+    return None
+
+
+def _parse_coordinate(value) -> Decimal:
+    coordinate = Decimal(str(value)).quantize(COORDINATE_QUANTUM)
+    if not coordinate.is_finite() or abs(coordinate) >= 1000:
+        raise ValueError(f'coordinate out of range: {value}')
+    return coordinate
+
+
+def _parse_int(value, low: int, high: int) -> int:
+    number = int(value)
+    if not low <= number <= high:
+        raise ValueError(f'integer out of range: {value}')
+    return number
+
+
+def device_max_lengths() -> Dict[str, int]:
+    """max_length of every DeviceData CharField"""
+    return {
+        field.name: field.max_length
+        for field in DeviceData._meta.get_fields()
+        if getattr(field, 'max_length', None)
+    }
+
+
+def _check_length(field: str, value: str) -> str:
+    max_length = DeviceData._meta.get_field(field).max_length
+    if len(value) > max_length:
+        raise ValueError(f'{field} longer than {max_length} characters')
+    return value
+
+
+def _parse_last_update(record: Dict[str, Any], field: str, now: datetime) -> datetime:
+    if record.get(field):
+        try:
+            return datetime.fromisoformat(record[field])
+        except Exception:
+            pass
+    return now
+
+
+def build_device_row(record: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    """Validate and convert one processed record into DeviceData column values.
+
+    Raises ValueError/TypeError/InvalidOperation for records the database
+    would reject, so one bad record cannot fail a whole bulk statement.
+    """
+    imei = record.get('imei')
+    if imei is None:
+        raise ValueError('missing imei')
+
+    # Prefer hearttime_unix for the last update datetimes so UI/CSV match DB
+    last_update = None
+    heart_unix_val = record.get('hearttime_unix')
+    if heart_unix_val not in [None, '', '0']:
+        try:
+            last_update = datetime.fromtimestamp(int(heart_unix_val), tz=dt_timezone.utc)
+        except Exception:
+            last_update = None
+
+    latitude = _parse_coordinate(record.get('latitude', 0))
+    longitude = _parse_coordinate(record.get('longitude', 0))
+    return {
+        'imei': _check_length('imei', str(imei)),
+        'latitude': latitude,
+        'longitude': longitude,
+        # Rebuilt from the parsed values so JSON and snapshot loads store the same text
+        'coordinates': _check_length('coordinates', coordinates_text(latitude, longitude)),
+        'datastatus': _parse_int(record.get('datastatus', 0), INT_MIN, INT_MAX),
+        'datastatus_description': _check_length(
+            'datastatus_description', str(record.get('datastatus_description', ''))
+        ),
+        'hearttime_date': _parse_date(record.get('hearttime_date')),
+        'hearttime_time': _parse_time(record.get('hearttime_time')),
+        'hearttime_unix': _parse_int(record.get('hearttime_unix', 0), BIGINT_MIN, BIGINT_MAX),
+        'status': _check_length('status', str(record.get('status', ''))),
+        'last_update_detailed_db': last_update or _parse_last_update(record, 'last_update_detailed_db', now),
+        'last_update_relative_db': last_update or _parse_last_update(record, 'last_update_relative_db', now),
+        'grid_cell': grid_cell(latitude, longitude),
+    }
+
+
+def load_device_state() -> DeviceState:
+    """imei -> (hearttime_unix, datastatus, latitude, longitude) for every stored device, in one query"""
+    rows = DeviceData.objects.values_list('imei', *STATE_COLUMNS).iterator(chunk_size=10000)
+    return {imei: (hearttime, datastatus, latitude, longitude)
+            for imei, hearttime, datastatus, latitude, longitude in rows}
+
+
+def _row_state(row: Dict[str, Any]) -> Tuple[int, int, Decimal, Decimal]:
+    return tuple(row[name] for name in STATE_COLUMNS)
+
+
+def _copy_value(value) -> str:
+    """Encode one value for COPY ... FROM STDIN (text format)"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    text = str(value)
+    return (text.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _history_row(row: Dict[str, Any], now: datetime) -> PositionHistory:
+    return PositionHistory(recorded_at=now, **{name: row[name] for name in HISTORY_COLUMNS})
+
+
+def _is_new_position(row: Dict[str, Any], previous_hearttime: Optional[int]) -> bool:
+    # hearttime_unix 0 means the device never reported; there is no position to keep
+    return row['hearttime_unix'] > 0 and row['hearttime_unix'] != previous_hearttime
+
+
+def _upsert_postgres(rows: List[Dict[str, Any]], now: datetime) -> Tuple[int, int, int]:
+    """COPY rows into a temp table, append changed positions to history, then merge with one INSERT ... ON CONFLICT"""
+    quote = connection.ops.quote_name
+    table = quote(DeviceData._meta.db_table)
+    history_table = quote(PositionHistory._meta.db_table)
+    history_columns = ', '.join(quote(name) for name in HISTORY_COLUMNS)
+    columns = [DeviceData._meta.get_field(name).column for name in DEVICE_COLUMNS]
+    column_list = ', '.join(quote(column) for column in columns)
+    temp_table = quote('device_data_load')
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(row[name]) for name in DEVICE_COLUMNS))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    copy_sql = f'COPY {temp_table} ({column_list}) FROM STDIN'
+    updates = ', '.join(
+        f'{quote(column)} = EXCLUDED.{quote(column)}' for column in columns if column != 'imei'
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TEMP TABLE IF NOT EXISTS {temp_table} ON COMMIT DROP AS '
+            f'SELECT {column_list} FROM {table} WITH NO DATA'
+        )
+        cursor.execute(f'TRUNCATE {temp_table}')
+
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, 'copy_expert'):
+            # psycopg2
+            raw_cursor.copy_expert(copy_sql, buffer)
+        else:
+            # psycopg 3
+            with raw_cursor.copy(copy_sql) as copy:
+                copy.write(buffer.getvalue())
+
+        # Compared against DeviceData before the merge overwrites hearttime_unix
+        cursor.execute(
+            f'INSERT INTO {history_table} ({history_columns}, {quote("recorded_at")}) '
+            f'SELECT {", ".join("t." + quote(name) for name in HISTORY_COLUMNS)}, %s '
+            f'FROM {temp_table} t LEFT JOIN {table} d ON d.{quote("imei")} = t.{quote("imei")} '
+            f'WHERE t.{quote("hearttime_unix")} > 0 '
+            f'AND (d.{quote("imei")} IS NULL OR d.{quote("hearttime_unix")} <> t.{quote("hearttime_unix")}) '
+            f'ON CONFLICT DO NOTHING',
+            [now],
+        )
+        appended = cursor.rowcount
+
+        # xmax = 0 only for freshly inserted tuples, which gives exact created/updated counts
+        cursor.execute(
+            f'INSERT INTO {table} ({column_list}, {quote("created_at")}, {quote("updated_at")}) '
+            f'SELECT {column_list}, %s, %s FROM {temp_table} '
+            f'ON CONFLICT ({quote("imei")}) DO UPDATE SET {updates}, '
+            f'{quote("updated_at")} = EXCLUDED.{quote("updated_at")} '
+            f'RETURNING (xmax = 0)',
+            [now, now],
+        )
+        inserted = [row[0] for row in cursor.fetchall()]
+
+    created = sum(1 for flag in inserted if flag)
+    return created, len(inserted) - created, appended
+
+
+def _upsert_generic(rows: List[Dict[str, Any]], now: datetime) -> Tuple[int, int, int]:
+    """bulk_create with ON CONFLICT DO UPDATE; existing rows are looked up once for counts and history"""
+    imeis = [row['imei'] for row in rows]
+    existing = dict(DeviceData.objects.filter(imei__in=imeis).values_list('imei', 'hearttime_unix'))
+    history = [_history_row(row, now) for row in rows if _is_new_position(row, existing.get(row['imei']))]
+    PositionHistory.objects.bulk_create(history, batch_size=len(rows), ignore_conflicts=True)
+    DeviceData.objects.bulk_create(
+        [DeviceData(**row) for row in rows],
+        batch_size=len(rows),
+        update_conflicts=True,
+        unique_fields=['imei'],
+        update_fields=[name for name in DEVICE_COLUMNS if name != 'imei'] + ['updated_at'],
+    )
+    updated = sum(1 for imei in imeis if imei in existing)
+    return len(rows) - updated, updated, len(history)
+
+
+def _upsert_rows_individually(rows: List[Dict[str, Any]], now: datetime,
+                              warn: Callable[[str], None]) -> Tuple[Dict[str, int], List[Dict[str, Any]]]:
+    """Fallback for a chunk the database rejected: isolate the failing rows.
+
+    Returns the counts and the rows that were saved.
+    """
+    counts = {'created': 0, 'updated': 0, 'errors': 0, 'appended': 0}
+    saved = []
+    for row in rows:
+        try:
+            with transaction.atomic():
+                previous = DeviceData.objects.filter(imei=row['imei']).values_list('hearttime_unix', flat=True).first()
+                if _is_new_position(row, previous):
+                    _, appended = PositionHistory.objects.get_or_create(
+                        imei=row['imei'], hearttime_unix=row['hearttime_unix'],
+                        defaults={'latitude': row['latitude'], 'longitude': row['longitude'],
+                                  'datastatus': row['datastatus'], 'recorded_at': now},
+                    )
+                    counts['appended'] += appended
+                defaults = {name: row[name] for name in DEVICE_COLUMNS if name != 'imei'}
+                _, created = DeviceData.objects.update_or_create(imei=row['imei'], defaults=defaults)
+            counts['created' if created else 'updated'] += 1
+            saved.append(row)
+        except Exception as e:
+            counts['errors'] += 1
+            warn(f'Error processing record {row["imei"]}: {str(e)}')
+    return counts, saved
+
+
+def new_changes() -> Dict[str, Any]:
+    """Collector for the changed rows of a load spread over several bulk_load_device_data calls"""
+    return {'rows': [], 'previous': {}}
+
+
+def notify_devices_changed(changes: Dict[str, Any]):
+    """Send devices_changed for the collected rows once they are committed"""
+    if changes['rows']:
+        transaction.on_commit(lambda: devices_changed.send(
+            sender=DeviceData, rows=changes['rows'], previous=changes['previous'],
+        ))
+
+
+def bulk_load_device_data(data: List[Dict[str, Any]], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                          progress: Optional[Callable[[int, int], None]] = None,
+                          warn: Optional[Callable[[str], None]] = None,
+                          prepared: bool = False,
+                          state: Optional[DeviceState] = None,
+                          changes: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+    """Upsert the new and changed processed tracking records into DeviceData in bulk.
+
+    Each record is compared with ``state`` (see load_device_state; loaded
+    here when not given) and devices whose hearttime, datastatus and position
+    are unchanged are skipped entirely: no write, no history append, no
+    notification. ``state`` is updated with what was written, so callers
+    loading in several calls can share one index for the whole run.
+
+    Changed rows use COPY + INSERT ... ON CONFLICT on PostgreSQL and
+    bulk_create with update_conflicts elsewhere. Returns created/updated/
+    unchanged/error counts plus ``appended``: positions added to
+    PositionHistory because hearttime_unix changed. Once committed, the
+    changed rows are sent with the devices_changed signal. Callers loading
+    one snapshot in several calls pass a ``changes`` dict (see
+    new_changes) instead and send it once with notify_devices_changed.
+
+    With ``prepared=True`` the items are already validated column values (as
+    returned by build_device_row, or read from a run snapshot).
+    """
+    warn = warn or logger.warning
+    now = timezone.now()
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': 0, 'appended': 0}
+    if state is None:
+        state = load_device_state()
+    use_copy = connection.vendor == 'postgresql'
+    if use_copy:
+        ensure_partitions()
+    collecting = changes is not None
+    if not collecting:
+        changes = new_changes()
+
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+
+        # Last record wins for a repeated IMEI, like sequential update_or_create calls;
+        # the earlier occurrences count as updates of it
+        rows = {}
+        for record in chunk:
+            try:
+                row = record if prepared else build_device_row(record, now)
+            except (ValueError, TypeError, InvalidOperation) as e:
+                counts['errors'] += 1
+                warn(f'Error processing record {record.get("imei", "unknown")}: {str(e)}')
+                continue
+            if row['imei'] in rows:
+                counts['updated'] += 1
+            rows[row['imei']] = row
+
+        # Only the rows that differ from the stored state are written
+        unchanged = [imei for imei, row in rows.items() if state.get(imei) == _row_state(row)]
+        for imei in unchanged:
+            del rows[imei]
+        counts['unchanged'] += len(unchanged)
+        rows = list(rows.values())
+
+        if rows:
+            try:
+                with transaction.atomic():
+                    upsert = _upsert_postgres if use_copy else _upsert_generic
+                    created, updated, appended = upsert(rows, now)
+                counts['created'] += created
+                counts['updated'] += updated
+                counts['appended'] += appended
+            except Exception as e:
+                logger.warning(f'Bulk upsert of {len(rows)} rows failed ({e}), retrying row by row')
+                loaded, rows = _upsert_rows_individually(rows, now, warn)
+                for key, value in loaded.items():
+                    counts[key] += value
+            for row in rows:
+                # State before this load, for receivers reporting transitions
+                changes['previous'].setdefault(row['imei'], state.get(row['imei']))
+                state[row['imei']] = _row_state(row)
+            changes['rows'].extend(rows)
+
+        if progress:
+            progress(min(start + chunk_size, len(data)), len(data))
+
+    if not collecting:
+        notify_devices_changed(changes)
+    return counts
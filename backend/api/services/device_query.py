@@ -0,0 +1,116 @@
+"""Indexed device filters for /api/devices/query/ and the device export.
+
+Every filter maps onto one of the DeviceData indexes: the datastatus and
+staleness filters onto (datastatus, hearttime_unix, ranking_id) and
+(hearttime_unix, ranking_id), the IMEI prefix onto the unique imei index,
+and "no coordinates" onto a partial index. Query results are ordered by
+last heartbeat (longest silent first) and paginated with a
+(hearttime_unix, ranking_id) keyset that seeks on the same indexes.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+
+from api.models import DeviceData
+from api.services.device_list import DEVICE_LIST_FIELDS, serialize_device_rows
+
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+
+
+def _int(value: str, name: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+
+
+def parse_device_filters(params: Dict[str, str]) -> Dict[str, Any]:
+    """Validate device filter query parameters; raises ValueError for bad values.
+
+    ``datastatus``: comma-separated status codes. ``status``: comma-separated
+    datastatus descriptions. ``stale_minutes`` / ``fresh_minutes``: last
+    heartbeat older / newer than that many minutes (devices that never
+    reported count as stale). ``imei_prefix``: IMEI starts with.
+    ``has_coordinates``: true/false.
+    """
+    filters = {}
+    if params.get('datastatus'):
+        filters['datastatus'] = [_int(code, 'datastatus') for code in params['datastatus'].split(',') if code.strip()]
+    if params.get('status'):
+        filters['status'] = [status.strip() for status in params['status'].split(',') if status.strip()]
+    for name in ('stale_minutes', 'fresh_minutes'):
+        if params.get(name):
+            filters[name] = _int(params[name], name)
+    if params.get('imei_prefix'):
+        filters['imei_prefix'] = params['imei_prefix'].strip()
+    has_coordinates = (params.get('has_coordinates') or '').lower()
+    if has_coordinates:
+        if has_coordinates not in TRUE_VALUES + FALSE_VALUES:
+            raise ValueError('has_coordinates must be true or false')
+        filters['has_coordinates'] = has_coordinates in TRUE_VALUES
+    return filters
+
+
+def filter_devices(queryset: QuerySet, filters: Dict[str, Any], now: int) -> QuerySet:
+    """Apply parsed filters in SQL; each one maps onto an index (see DeviceData.Meta.indexes)"""
+    if filters.get('datastatus'):
+        queryset = queryset.filter(datastatus__in=filters['datastatus'])
+    if filters.get('status'):
+        queryset = queryset.filter(datastatus_description__in=filters['status'])
+    if filters.get('stale_minutes') is not None:
+        queryset = queryset.filter(hearttime_unix__lt=now - filters['stale_minutes'] * 60)
+    if filters.get('fresh_minutes') is not None:
+        queryset = queryset.filter(hearttime_unix__gte=now - filters['fresh_minutes'] * 60)
+    prefix = filters.get('imei_prefix')
+    if prefix:
+        # The range bounds the scan on the imei index (a LIKE cannot use it on
+        # SQLite); startswith keeps the match exact whatever the collation
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        queryset = queryset.filter(imei__gte=prefix, imei__lt=upper, imei__startswith=prefix)
+    if filters.get('has_coordinates') is not None:
+        no_coordinates = Q(latitude=0, longitude=0)
+        queryset = queryset.exclude(no_coordinates) if filters['has_coordinates'] else queryset.filter(no_coordinates)
+    return queryset
+
+
+def filter_cache_key(filters: Dict[str, Any], now: Optional[int]) -> tuple:
+    """Hashable key of a filter set; staleness filters depend on the minute they were evaluated in"""
+    uses_now = 'stale_minutes' in filters or 'fresh_minutes' in filters
+    return tuple(sorted((name, repr(value)) for name, value in filters.items())) + ((now if uses_now else None),)
+
+
+def parse_query_cursor(cursor: str) -> Optional[Tuple[int, int]]:
+    """(hearttime_unix, ranking_id) a query cursor points after; an empty cursor is the first page"""
+    if not cursor:
+        return None
+    try:
+        hearttime_unix, ranking_id = cursor.split(':')
+        return int(hearttime_unix), int(ranking_id)
+    except ValueError:
+        raise ValueError('cursor must be a next_cursor returned by a previous page')
+
+
+def query_device_page(filters: Dict[str, Any], now: int, cursor: Optional[Tuple[int, int]],
+                      per_page: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of matching devices after ``cursor``, longest silent first.
+
+    Returns the page and the cursor of the next one (None on the last page).
+    """
+    queryset = filter_devices(DeviceData.objects.all(), filters, now).order_by('hearttime_unix', 'ranking_id')
+    if cursor is not None:
+        hearttime_unix, ranking_id = cursor
+        # A range on hearttime_unix keeps the seek on the index; ties are cut by ranking_id
+        queryset = queryset.filter(hearttime_unix__gte=hearttime_unix).exclude(
+            hearttime_unix=hearttime_unix, ranking_id__lte=ranking_id,
+        )
+    # One extra row tells whether there is a next page without counting
+    rows = list(queryset.values_list(*DEVICE_LIST_FIELDS)[:per_page + 1])
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = f'{rows[-1][9]}:{rows[-1][0]}' if has_next else None
+    return serialize_device_rows(rows), next_cursor
+
+
+def count_devices(filters: Dict[str, Any], now: int) -> int:
+    return filter_devices(DeviceData.objects.all(), filters, now).order_by().count()
@@ -0,0 +1,284 @@
+"""Streaming exports of DeviceData and PositionHistory.
+
+Rows are read through a server-side cursor (``QuerySet.iterator``) and
+written out in chunks of EXPORT_CHUNK_ROWS. Memory stays flat whatever the
+size of the export, and the first bytes go out before the query finishes.
+CSV can be gzip-compressed on the fly. Parquet and Arrow IPC streams are
+available when ``pyarrow`` is installed.
+"""
+import csv
+import io
+import zlib
+from datetime import date, datetime, time
+from itertools import islice
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+
+from api.models import DeviceData, PositionHistory
+from api.services.device_query import filter_devices, parse_device_filters
+from api.services.time_labels import time_labels
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # optional dependency
+    pyarrow = None
+
+# Rows fetched per cursor round trip and written per output chunk / row group
+EXPORT_CHUNK_ROWS = 2000
+
+FORMAT_CSV = 'csv'
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+EXPORT_FORMATS = [FORMAT_CSV, FORMAT_PARQUET, FORMAT_ARROW]
+
+DATASET_DEVICES = 'devices'
+DATASET_HISTORY = 'history'
+
+CONTENT_TYPES = {
+    FORMAT_CSV: 'text/csv',
+    FORMAT_PARQUET: 'application/vnd.apache.parquet',
+    FORMAT_ARROW: 'application/vnd.apache.arrow.stream',
+}
+
+# (CSV header, DB field or None for a computed column, Arrow type name)
+DEVICE_EXPORT_COLUMNS = [
+    ('Ranking ID', 'ranking_id', 'int64'),
+    ('IMEI', 'imei', 'string'),
+    ('Latitude', 'latitude', 'coordinate'),
+    ('Longitude', 'longitude', 'coordinate'),
+    ('Coordinates', 'coordinates', 'string'),
+    ('Data Status Code', 'datastatus', 'int32'),
+    ('Data Status', 'datastatus_description', 'string'),
+    ('Heart Date', 'hearttime_date', 'date'),
+    ('Heart Time', 'hearttime_time', 'time'),
+    ('Heart Unix', 'hearttime_unix', 'int64'),
+    ('TimeSinceUpdate', None, 'string'),
+    ('TimeAgo', None, 'string'),
+    ('Status', 'status', 'string'),
+    ('Created At', 'created_at', 'timestamp'),
+    ('Updated At', 'updated_at', 'timestamp'),
+]
+
+HISTORY_EXPORT_COLUMNS = [
+    ('IMEI', 'imei', 'string'),
+    ('Heart Unix', 'hearttime_unix', 'int64'),
+    ('Latitude', 'latitude', 'coordinate'),
+    ('Longitude', 'longitude', 'coordinate'),
+    ('Data Status Code', 'datastatus', 'int32'),
+    ('Recorded At', 'recorded_at', 'timestamp'),
+]
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def _int_param(params: Dict[str, str], name: str) -> Optional[int]:
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+
+
+def device_export_rows(params: Dict[str, str], now: int) -> Iterator[Tuple]:
+    """DeviceData rows for an export, filtered in SQL.
+
+    Takes the filters of /api/devices/query/ (see
+    device_query.parse_device_filters), e.g. ``status=Online,Static`` or
+    ``stale_minutes=10080`` for devices silent for more than a week.
+    """
+    queryset = filter_devices(DeviceData.objects.order_by('ranking_id'), parse_device_filters(params), now)
+    fields = [field for _, field, _ in DEVICE_EXPORT_COLUMNS if field]
+    return _with_time_labels(queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_ROWS), now)
+
+
+def _with_time_labels(rows: Iterable[Tuple], now: int) -> Iterator[Tuple]:
+    for (ranking_id, imei, latitude, longitude, coordinates, datastatus, description,
+         hearttime_date, hearttime_time, hearttime_unix, status, created_at, updated_at) in rows:
+        elapsed, relative = time_labels(hearttime_unix, now)
+        yield (ranking_id, imei, latitude, longitude, coordinates, datastatus, description,
+               hearttime_date, hearttime_time, hearttime_unix, elapsed, relative, status,
+               created_at, updated_at)
+
+
+def history_export_rows(params: Dict[str, str], now: int) -> Iterator[Tuple]:
+    """PositionHistory rows ordered by device and time; ``imei`` (comma-separated), ``since``/``until`` (unix)"""
+    queryset = PositionHistory.objects.order_by('imei', 'hearttime_unix')
+    imeis = _split(params.get('imei'))
+    if imeis:
+        queryset = queryset.filter(imei__in=imeis)
+    since = _int_param(params, 'since')
+    if since is not None:
+        queryset = queryset.filter(hearttime_unix__gte=since)
+    until = _int_param(params, 'until')
+    if until is not None:
+        queryset = queryset.filter(hearttime_unix__lt=until)
+    fields = [field for _, field, _ in HISTORY_EXPORT_COLUMNS]
+    return queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_ROWS)
+
+
+DATASETS = {
+    DATASET_DEVICES: (DEVICE_EXPORT_COLUMNS, device_export_rows),
+    DATASET_HISTORY: (HISTORY_EXPORT_COLUMNS, history_export_rows),
+}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, time):
+        return value.strftime('%H:%M:%S')
+    return value
+
+
+def stream_csv(rows: Iterable[Tuple], header: List[str], compress: bool = False) -> Iterator[bytes]:
+    """CSV bytes in chunks of EXPORT_CHUNK_ROWS rows, optionally as one gzip stream"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # wbits=31 produces a gzip container
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([_csv_value(value) for value in row])
+        if count % EXPORT_CHUNK_ROWS == 0:
+            chunk = drain()
+            if chunk:
+                yield chunk
+    chunk = drain()
+    if compressor:
+        chunk += compressor.flush()
+    yield chunk
+
+
+class _ByteSink:
+    """Write-only file collecting what pyarrow writes until it is drained.
+
+    Parquet footers record absolute offsets, so ``tell`` keeps counting
+    across drains.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_schema(columns):
+    types = {
+        'int64': pyarrow.int64(),
+        'int32': pyarrow.int32(),
+        'string': pyarrow.string(),
+        'coordinate': pyarrow.decimal128(9, 6),
+        'date': pyarrow.date32(),
+        'time': pyarrow.time32('s'),
+        'timestamp': pyarrow.timestamp('us', tz='UTC'),
+    }
+    return pyarrow.schema([(header, types[kind]) for header, _, kind in columns])
+
+
+def stream_arrow(rows: Iterable[Tuple], columns, export_format: str) -> Iterator[bytes]:
+    """Parquet (one row group per chunk) or Arrow IPC stream bytes"""
+    schema = _arrow_schema(columns)
+    sink = _ByteSink()
+    output = pyarrow.PythonFile(sink, mode='w')
+    if export_format == FORMAT_PARQUET:
+        writer = pyarrow.parquet.ParquetWriter(output, schema, compression='zstd')
+    else:
+        writer = pyarrow.ipc.new_stream(output, schema)
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, EXPORT_CHUNK_ROWS))
+        if not chunk:
+            break
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+async def iterate_in_thread(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """Async iterator over ``chunks`` for ASGI responses.
+
+    Each chunk is produced by sync_to_async in the request's thread, so the
+    server-side cursor stays on one connection and only one chunk is held in
+    memory at a time.
+    """
+    next_chunk = sync_to_async(next)
+    done = object()
+    while True:
+        chunk = await next_chunk(chunks, done)
+        if chunk is done:
+            break
+        yield chunk
+
+
+def build_export(params: Dict[str, str], now: int) -> Tuple[Iterator[bytes], str, str]:
+    """Validate export parameters and return ``(chunks, content_type, file_extension)``.
+
+    Raises ValueError for unknown formats/datasets or bad filter values
+    before any query runs. ``compress=gzip`` applies to CSV; Parquet is
+    always zstd-compressed internally.
+    """
+    export_format = params.get('format', FORMAT_CSV).lower()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'format must be one of {", ".join(EXPORT_FORMATS)}')
+    dataset = params.get('dataset', DATASET_DEVICES).lower()
+    if dataset not in DATASETS:
+        raise ValueError(f'dataset must be one of {", ".join(DATASETS)}')
+    compress = params.get('compress', '').lower()
+    if compress not in ('', 'gzip'):
+        raise ValueError('compress must be gzip')
+    if export_format != FORMAT_CSV and pyarrow is None:
+        raise ValueError(f'{export_format} export requires pyarrow')
+
+    columns, row_source = DATASETS[dataset]
+    rows = row_source(params, now)
+
+    if export_format == FORMAT_CSV:
+        chunks = stream_csv(rows, [header for header, _, _ in columns], compress=compress == 'gzip')
+        if compress:
+            return chunks, 'application/gzip', 'csv.gz'
+        return chunks, CONTENT_TYPES[FORMAT_CSV], 'csv'
+    return stream_arrow(rows, columns, export_format), CONTENT_TYPES[export_format], export_format
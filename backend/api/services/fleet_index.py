@@ -0,0 +1,106 @@
+"""In-memory imei -> device record index for bulk lookups.
+
+Each web process keeps one FleetIndex holding the serialized record of
+every device. It is rebuilt from a single pass over DeviceData whenever the
+snapshot version (see response_cache.get_snapshot) moves on. While one
+thread rebuilds, concurrent lookups don't wait: they are answered by
+chunked ``imei__in`` queries. Fleets larger than MAX_INDEXED_DEVICES never
+get an index and always use the query path.
+"""
+import logging
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from api.models import DeviceData
+from api.services.device_list import DEVICE_LIST_FIELDS, serialize_device_rows
+from api.services.fleet_stats import get_fleet_stats
+from api.services.response_cache import get_snapshot
+
+logger = logging.getLogger(__name__)
+
+# IMEIs accepted by one /api/devices/lookup/ request
+MAX_LOOKUP_IMEIS = 10000
+# Above this many devices the index is not built (memory bound per process)
+MAX_INDEXED_DEVICES = 200000
+# IMEIs per ``imei__in`` query; stays under SQLite's bound-parameter limit
+LOOKUP_CHUNK_SIZE = 900
+# Rows per cursor round trip while rebuilding
+INDEX_BUILD_CHUNK_ROWS = 5000
+
+
+class FleetIndex:
+    """Records of one snapshot version, keyed by IMEI (read-only once built)"""
+
+    def __init__(self, version: int, records: Dict[str, Dict[str, Any]]):
+        self.version = version
+        self.records = records
+
+    @classmethod
+    def build(cls, version: int) -> Optional['FleetIndex']:
+        if get_fleet_stats()['total_devices'] > MAX_INDEXED_DEVICES:
+            return None
+        rows = DeviceData.objects.values_list(*DEVICE_LIST_FIELDS).iterator(chunk_size=INDEX_BUILD_CHUNK_ROWS)
+        return cls(version, {record['imei']: record for record in serialize_device_rows(rows)})
+
+
+_index = None
+_build_lock = threading.Lock()
+
+
+def get_fleet_index() -> Optional[FleetIndex]:
+    """The index of the current snapshot, or None while it is being (re)built elsewhere or too large"""
+    global _index
+    version, _ = get_snapshot()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    if not _build_lock.acquire(blocking=False):
+        return None
+    try:
+        # Another thread may have finished a rebuild while we read the version
+        if _index is not None and _index.version == version:
+            return _index
+        index = FleetIndex.build(version)
+        if index is not None:
+            logger.info(f"Fleet index rebuilt for snapshot v{version}: {len(index.records)} devices")
+        _index = index
+        return index
+    finally:
+        _build_lock.release()
+
+
+def query_devices_by_imei(imeis: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Records for ``imeis`` straight from the database, LOOKUP_CHUNK_SIZE IMEIs per query"""
+    records = {}
+    for start in range(0, len(imeis), LOOKUP_CHUNK_SIZE):
+        chunk = imeis[start:start + LOOKUP_CHUNK_SIZE]
+        rows = DeviceData.objects.filter(imei__in=chunk).values_list(*DEVICE_LIST_FIELDS)
+        records.update((record['imei'], record) for record in serialize_device_rows(rows))
+    return records
+
+
+def lookup_devices(imeis: Iterable[str]) -> Tuple[List[Dict[str, Any]], List[str], str]:
+    """Current records of ``imeis`` in request order (duplicates dropped).
+
+    Returns ``(records, missing_imeis, source)`` where source is ``'index'``
+    or ``'database'``. Records are copies, safe for the caller to modify.
+    """
+    imeis = list(dict.fromkeys(imeis))
+    index = None
+    try:
+        index = get_fleet_index()
+    except Exception as e:
+        logger.warning(f"Fleet index unavailable, querying instead: {e}")
+    if index is not None:
+        found, source = index.records, 'index'
+    else:
+        found, source = query_devices_by_imei(imeis), 'database'
+
+    records, missing = [], []
+    for imei in imeis:
+        record = found.get(imei)
+        if record is None:
+            missing.append(imei)
+        else:
+            records.append(dict(record))
+    return records, missing, source
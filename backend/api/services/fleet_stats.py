@@ -0,0 +1,85 @@
+import logging
+from typing import Any, Dict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api.models import DeviceData, FleetStats
+from api.services.response_cache import set_snapshot
+from api.signals import devices_changed
+
+logger = logging.getLogger(__name__)
+
+# Primary key of the single summary row
+FLEET_STATS_ID = 1
+
+
+def compute_fleet_stats() -> Dict[str, Any]:
+    """Dashboard totals from one GROUP BY scan of DeviceData.
+
+    Each status group also counts its devices with a position using a
+    conditional Count, so totals and coordinate counts need no extra queries.
+    """
+    groups = DeviceData.objects.order_by().values('datastatus_description').annotate(
+        devices=Count('pk'),
+        with_coordinates=Count('pk', filter=~Q(latitude=0, longitude=0)),
+    )
+    status_counts, total_devices, with_coordinates = {}, 0, 0
+    for group in groups:
+        status_counts[group['datastatus_description']] = group['devices']
+        total_devices += group['devices']
+        with_coordinates += group['with_coordinates']
+    return {
+        'total_devices': total_devices,
+        'with_coordinates': with_coordinates,
+        'without_coordinates': total_devices - with_coordinates,
+        'status_counts': status_counts,
+    }
+
+
+def refresh_fleet_stats() -> FleetStats:
+    """Recompute the summary row and bump its snapshot version; called whenever DeviceData changes"""
+    stats = compute_fleet_stats()
+    fields = {
+        'total_devices': stats['total_devices'],
+        'with_coordinates': stats['with_coordinates'],
+        'status_counts': stats['status_counts'],
+        'updated_at': timezone.now(),
+    }
+    # F() keeps concurrent refreshes from different processes from reusing a version
+    if not FleetStats.objects.filter(pk=FLEET_STATS_ID).update(version=F('version') + 1, **fields):
+        try:
+            with transaction.atomic():
+                FleetStats.objects.create(pk=FLEET_STATS_ID, version=1, **fields)
+        except IntegrityError:
+            FleetStats.objects.filter(pk=FLEET_STATS_ID).update(version=F('version') + 1, **fields)
+    summary = FleetStats.objects.get(pk=FLEET_STATS_ID)
+    # This process sees the new version right away; others within SNAPSHOT_CHECK_SECONDS
+    set_snapshot(summary.version, summary.updated_at)
+    return summary
+
+
+def get_fleet_stats() -> Dict[str, Any]:
+    """Dashboard totals read from the summary row (a primary key lookup)"""
+    summary = FleetStats.objects.filter(pk=FLEET_STATS_ID).first()
+    if summary is None:
+        # First request before any load populated it
+        summary = refresh_fleet_stats()
+    return {
+        'total_devices': summary.total_devices,
+        'with_coordinates': summary.with_coordinates,
+        'without_coordinates': summary.total_devices - summary.with_coordinates,
+        'status_counts': summary.status_counts,
+        'updated_at': summary.updated_at.isoformat(),
+    }
+
+
+@receiver(devices_changed)
+def refresh_on_devices_changed(sender, rows, **kwargs):
+    try:
+        refresh_fleet_stats()
+    except Exception as e:
+        # The load itself is committed; stale stats must not fail it
+        logger.warning(f"Could not refresh fleet stats: {e}")
@@ -0,0 +1,296 @@
+"""Geofence evaluation: which devices are inside which depots and zones.
+
+After every committed load, every device with a position is tested against
+every active fence. Steps:
+
+- Grid lookup. Fences are registered in a coarse lat/lon grid (GRID_DEGREES
+  cells). A device is only paired with the fences registered in its own cell.
+  Fences covering more than MAX_FENCE_CELLS cells are paired with every device.
+- Bounding-box check. One vectorized comparison drops the pairs whose device
+  lies outside the fence's bounding box.
+- Exact test. The remaining pairs are grouped per fence. Polygons use NumPy
+  even-odd ray casting over all their edges at once. Circles use the
+  haversine distance.
+
+The resulting (fence, imei) set is diffed against GeofenceMembership. The
+differences are written as enter/exit GeofenceEvents, and the membership
+table becomes the new set. Polygons are treated as planar in
+latitude/longitude and must not cross the antimeridian.
+"""
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api.models import DeviceData, Geofence, GeofenceEvent, GeofenceMembership
+from api.signals import devices_changed
+
+logger = logging.getLogger(__name__)
+
+GRID_DEGREES = 0.25
+GRID_COLUMNS = int(360 / GRID_DEGREES)
+# Fences spanning more grid cells are paired with every device instead
+MAX_FENCE_CELLS = 400
+# Points x edges per ray-casting batch, bounding the temporary arrays (~8 MB each)
+RAY_CAST_BATCH = 1000000
+METERS_PER_DEGREE = 111320.0
+EARTH_RADIUS_M = 6371008.8
+MAX_POLYGON_POINTS = 10000
+# IMEIs per membership delete statement
+DELETE_CHUNK_SIZE = 900
+
+
+def parse_geofence(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Geofence field values from an API payload; raises ValueError"""
+    name = str(data.get('name') or '').strip()
+    if not name or len(name) > 100:
+        raise ValueError('name is required (at most 100 characters)')
+    kind = data.get('kind')
+    if kind == Geofence.KIND_POLYGON:
+        points = data.get('points')
+        try:
+            points = [[float(latitude), float(longitude)] for latitude, longitude in points]
+        except (TypeError, ValueError):
+            raise ValueError('points must be a list of [latitude, longitude] pairs')
+        if not 3 <= len(points) <= MAX_POLYGON_POINTS:
+            raise ValueError(f'A polygon needs between 3 and {MAX_POLYGON_POINTS} points')
+        if not all(-90 <= lat <= 90 and -180 <= lon <= 180 for lat, lon in points):
+            raise ValueError('Polygon points must be valid latitude/longitude pairs')
+        return {'name': name, 'kind': kind, 'points': points}
+    if kind == Geofence.KIND_CIRCLE:
+        try:
+            latitude = float(data['center_latitude'])
+            longitude = float(data['center_longitude'])
+            radius_m = float(data['radius_m'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('A circle needs numeric center_latitude, center_longitude and radius_m')
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError('center_latitude/center_longitude must be a valid position')
+        if not 0 < radius_m <= 1000000:
+            raise ValueError('radius_m must be between 0 and 1,000,000')
+        return {'name': name, 'kind': kind, 'center_latitude': round(latitude, 6),
+                'center_longitude': round(longitude, 6), 'radius_m': radius_m}
+    raise ValueError(f'kind must be {Geofence.KIND_POLYGON} or {Geofence.KIND_CIRCLE}')
+
+
+def points_in_polygon(latitudes: np.ndarray, longitudes: np.ndarray,
+                      polygon_latitudes: np.ndarray, polygon_longitudes: np.ndarray) -> np.ndarray:
+    """Even-odd ray casting of every point against every polygon edge at once"""
+    y1, x1 = polygon_latitudes, polygon_longitudes
+    y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+    inside = np.zeros(len(latitudes), dtype=bool)
+    batch = max(1, RAY_CAST_BATCH // len(y1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(latitudes), batch):
+            py = latitudes[start:start + batch, None]
+            px = longitudes[start:start + batch, None]
+            # Edges straddling the point's latitude, crossed to the east of it
+            straddles = (y1 > py) != (y2 > py)
+            crossing = (x2 - x1) * (py - y1) / (y2 - y1) + x1
+            inside[start:start + batch] = np.count_nonzero(straddles & (px < crossing), axis=1) % 2 == 1
+    return inside
+
+
+def points_in_circle(latitudes: np.ndarray, longitudes: np.ndarray,
+                     center_latitude: float, center_longitude: float, radius_m: float) -> np.ndarray:
+    lat1, lat2 = np.radians(center_latitude), np.radians(latitudes)
+    half_dlat = (lat2 - lat1) / 2
+    half_dlon = np.radians(longitudes - center_longitude) / 2
+    a = np.sin(half_dlat) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(half_dlon) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1))) <= radius_m
+
+
+def _grid_cells(latitudes, longitudes):
+    rows = np.floor((np.asarray(latitudes) + 90) / GRID_DEGREES).astype(np.int64)
+    columns = np.floor((np.asarray(longitudes) + 180) / GRID_DEGREES).astype(np.int64)
+    return rows * GRID_COLUMNS + np.clip(columns, 0, GRID_COLUMNS - 1)
+
+
+class FenceSet:
+    """Active fences with bounding boxes and the grid index over them"""
+
+    def __init__(self, fences: List[Geofence]):
+        self.fences = fences
+        self.ids = np.array([fence.id for fence in fences], dtype=np.int64)
+        self.kinds = [fence.kind for fence in fences]
+        self.shapes = []
+        boxes = []
+        for fence in fences:
+            if fence.kind == Geofence.KIND_POLYGON:
+                points = np.array(fence.points, dtype=np.float64)
+                shape = (points[:, 0], points[:, 1])
+                box = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+            else:
+                latitude, longitude = float(fence.center_latitude), float(fence.center_longitude)
+                shape = (latitude, longitude, fence.radius_m)
+                dlat = fence.radius_m / METERS_PER_DEGREE
+                dlon = dlat / max(np.cos(np.radians(latitude)), 1e-6)
+                box = (latitude - dlat, longitude - dlon, latitude + dlat, longitude + dlon)
+            self.shapes.append(shape)
+            boxes.append(box)
+        self.boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+        # cell -> fence indexes; fences too large for the grid are checked against every device
+        self.grid = defaultdict(list)
+        self.large = []
+        for index, (min_lat, min_lon, max_lat, max_lon) in enumerate(self.boxes):
+            first_row, first_column = (int(value) for value in
+                                       np.floor([(min_lat + 90) / GRID_DEGREES, (min_lon + 180) / GRID_DEGREES]))
+            last_row, last_column = (int(value) for value in
+                                     np.floor([(max_lat + 90) / GRID_DEGREES, (max_lon + 180) / GRID_DEGREES]))
+            if (last_row - first_row + 1) * (last_column - first_column + 1) > MAX_FENCE_CELLS:
+                self.large.append(index)
+                continue
+            for row in range(first_row, last_row + 1):
+                for column in range(max(first_column, 0), min(last_column, GRID_COLUMNS - 1) + 1):
+                    self.grid[row * GRID_COLUMNS + column].append(index)
+
+    def candidate_pairs(self, latitudes: np.ndarray, longitudes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(device index, fence index) pairs sharing a grid cell and passing the bounding-box test"""
+        cells, inverse = np.unique(_grid_cells(latitudes, longitudes), return_inverse=True)
+        by_cell = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[by_cell], np.arange(len(cells) + 1))
+        device_parts, fence_parts = [], []
+        for position, cell in enumerate(cells.tolist()):
+            fences = self.grid.get(cell)
+            if fences:
+                devices = by_cell[bounds[position]:bounds[position + 1]]
+                device_parts.append(np.repeat(devices, len(fences)))
+                fence_parts.append(np.tile(np.array(fences, dtype=np.int64), len(devices)))
+        if self.large:
+            device_parts.append(np.repeat(np.arange(len(latitudes)), len(self.large)))
+            fence_parts.append(np.tile(np.array(self.large, dtype=np.int64), len(latitudes)))
+        if not device_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        devices = np.concatenate(device_parts)
+        fences = np.concatenate(fence_parts)
+        boxes = self.boxes[fences]
+        lat, lon = latitudes[devices], longitudes[devices]
+        keep = (lat >= boxes[:, 0]) & (lon >= boxes[:, 1]) & (lat <= boxes[:, 2]) & (lon <= boxes[:, 3])
+        return devices[keep], fences[keep]
+
+    def contains(self, latitudes: np.ndarray, longitudes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(device index, fence index) of every device inside a fence"""
+        devices, fences = self.candidate_pairs(latitudes, longitudes)
+        order = np.argsort(fences, kind='stable')
+        devices, fences = devices[order], fences[order]
+        starts = np.flatnonzero(np.r_[True, fences[1:] != fences[:-1]]) if len(fences) else []
+        inside = np.zeros(len(devices), dtype=bool)
+        for start, end in zip(starts, list(starts[1:]) + [len(fences)]):
+            fence = fences[start]
+            lat, lon = latitudes[devices[start:end]], longitudes[devices[start:end]]
+            if self.kinds[fence] == Geofence.KIND_POLYGON:
+                inside[start:end] = points_in_polygon(lat, lon, *self.shapes[fence])
+            else:
+                inside[start:end] = points_in_circle(lat, lon, *self.shapes[fence])
+        return devices[inside], fences[inside]
+
+
+def _delete_memberships(exited: List[Tuple[int, str]]):
+    by_fence = defaultdict(list)
+    for fence_id, imei in exited:
+        by_fence[fence_id].append(imei)
+    for fence_id, imeis in by_fence.items():
+        for start in range(0, len(imeis), DELETE_CHUNK_SIZE):
+            GeofenceMembership.objects.filter(
+                geofence_id=fence_id, imei__in=imeis[start:start + DELETE_CHUNK_SIZE],
+            ).delete()
+
+
+def evaluate_geofences(now=None) -> Dict[str, int]:
+    """Test the whole fleet against every active fence and record enter/exit events.
+
+    A fence's first evaluation only records its members. Devices without
+    a position keep their memberships instead of "leaving". Returns
+    counts: fences, devices, inside, entered, exited.
+    """
+    now = now or timezone.now()
+    fences = list(Geofence.objects.filter(active=True).order_by('id'))
+    counts = {'fences': len(fences), 'devices': 0, 'inside': 0, 'entered': 0, 'exited': 0}
+    if not fences:
+        return counts
+
+    rows = list(DeviceData.objects.values_list('imei', 'latitude', 'longitude', 'hearttime_unix'))
+    imeis = [row[0] for row in rows]
+    latitudes = np.array([row[1] for row in rows], dtype=np.float64)
+    longitudes = np.array([row[2] for row in rows], dtype=np.float64)
+    positioned = ~((latitudes == 0) & (longitudes == 0))
+    positioned &= (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+    located = np.flatnonzero(positioned)
+    counts['devices'] = len(located)
+
+    fence_set = FenceSet(fences)
+    devices, fence_indexes = fence_set.contains(latitudes[located], longitudes[located])
+    current = {(int(fence_set.ids[fence]), imeis[located[device]])
+               for device, fence in zip(devices.tolist(), fence_indexes.tolist())}
+    counts['inside'] = len(current)
+
+    fence_ids = [fence.id for fence in fences]
+    baseline = {fence.id for fence in fences if fence.evaluated_at is None}
+    unlocated = {imeis[index] for index in np.flatnonzero(~positioned).tolist()}
+    rows_by_imei = {row[0]: row for row in rows}
+
+    with transaction.atomic():
+        previous = set(GeofenceMembership.objects.filter(geofence_id__in=fence_ids).values_list('geofence_id', 'imei'))
+        current |= {(fence_id, imei) for fence_id, imei in previous if imei in unlocated}
+        entered = current - previous
+        exited = previous - current
+
+        events = []
+        for event, pairs in ((GeofenceEvent.EVENT_ENTER, entered), (GeofenceEvent.EVENT_EXIT, exited)):
+            for fence_id, imei in pairs:
+                row = rows_by_imei.get(imei)
+                if fence_id in baseline or row is None:
+                    continue  # first evaluation of the fence, or the device was deleted
+                events.append(GeofenceEvent(
+                    geofence_id=fence_id, imei=imei, event=event,
+                    latitude=row[1], longitude=row[2], hearttime_unix=row[3],
+                ))
+        GeofenceEvent.objects.bulk_create(events, batch_size=2000)
+        _delete_memberships(sorted(exited))
+        GeofenceMembership.objects.bulk_create(
+            [GeofenceMembership(geofence_id=fence_id, imei=imei, entered_at=now) for fence_id, imei in entered],
+            batch_size=2000, ignore_conflicts=True,
+        )
+        if baseline:
+            Geofence.objects.filter(id__in=baseline).update(evaluated_at=now)
+
+    counts['entered'] = sum(1 for event in events if event.event == GeofenceEvent.EVENT_ENTER)
+    counts['exited'] = len(events) - counts['entered']
+    return counts
+
+
+@receiver(devices_changed)
+def evaluate_geofences_on_devices_changed(sender, **kwargs):
+    try:
+        counts = evaluate_geofences()
+        if counts['entered'] or counts['exited']:
+            logger.info(f"Geofences: {counts['entered']} entries, {counts['exited']} exits "
+                        f"({counts['fences']} fences, {counts['devices']} devices)")
+    except Exception as e:
+        # The load itself is committed; the next load re-evaluates everything
+        logger.warning(f"Could not evaluate geofences: {e}")
+
+
+def serialize_geofence(fence: Geofence, members: Optional[int] = None) -> Dict[str, Any]:
+    data = {
+        'id': fence.id,
+        'name': fence.name,
+        'kind': fence.kind,
+        'active': fence.active,
+        'created_at': fence.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'evaluated_at': fence.evaluated_at.strftime('%Y-%m-%d %H:%M:%S') if fence.evaluated_at else None,
+    }
+    if fence.kind == Geofence.KIND_POLYGON:
+        data['points'] = fence.points
+    else:
+        data.update(center_latitude=float(fence.center_latitude), center_longitude=float(fence.center_longitude),
+                    radius_m=fence.radius_m)
+    if members is not None:
+        data['members'] = members
+    return data
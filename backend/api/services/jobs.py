@@ -0,0 +1,240 @@
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from api.models import Job
+
+logger = logging.getLogger(__name__)
+
+# Fetch/load runs are I/O bound and share one upstream API, so a single
+# background thread per process is enough and keeps runs from competing
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))
+
+# An active job without a heartbeat for this long belongs to a dead worker
+STALE_AFTER = timedelta(minutes=int(os.getenv('JOB_STALE_MINUTES', '10')))
+
+# Minimum seconds between progress writes
+PROGRESS_INTERVAL = 1.0
+
+# Seconds between heartbeats while a handler runs; well below STALE_AFTER
+HEARTBEAT_INTERVAL = 60.0
+
+# Dedupe key of the jobs that poll ProTrack365 (fetch_tracking, refresh): one of them runs at a time
+UPSTREAM_FETCH_KEY = 'upstream-fetch'
+
+_handlers: Dict[str, Callable] = {}
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def register_job(kind: str):
+    """Decorator registering ``handler(params, report) -> result dict`` for a job kind"""
+    def decorator(handler):
+        _handlers[kind] = handler
+        return handler
+    return decorator
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Created lazily so gunicorn workers each get their own threads after forking
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+        return _executor
+
+
+def fail_stale_jobs():
+    """Mark active jobs whose worker stopped heartbeating as failed so they stop blocking new runs"""
+    return Job.objects.filter(
+        status__in=Job.ACTIVE_STATUSES, updated_at__lt=timezone.now() - STALE_AFTER
+    ).update(status=Job.STATUS_FAILED, error='Worker stopped responding', finished_at=timezone.now())
+
+
+def submit_job(kind: str, params: Optional[Dict[str, Any]] = None, dedupe_key: str = '') -> Tuple[Job, bool]:
+    """Queue a job, or return the active job of the same kind and key.
+
+    A non-empty ``dedupe_key`` is shared across kinds: jobs of different
+    kinds that must not overlap (see UPSTREAM_FETCH_KEY) pass the same key.
+    Returns ``(job, created)``. The partial unique constraints on active
+    jobs make the dedupe hold across gunicorn workers, not just within one.
+    """
+    if kind not in _handlers:
+        raise ValueError(f'Unknown job kind: {kind}')
+
+    fail_stale_jobs()
+    try:
+        with transaction.atomic():
+            job = Job.objects.create(kind=kind, dedupe_key=dedupe_key, params=params or {})
+    except IntegrityError:
+        active = Job.objects.filter(status__in=Job.ACTIVE_STATUSES)
+        existing = (active.filter(dedupe_key=dedupe_key) if dedupe_key
+                    else active.filter(kind=kind, dedupe_key='')).first()
+        if existing is None:
+            # The active job finished in between; try once more
+            return submit_job(kind, params, dedupe_key)
+        return existing, False
+
+    # Only hand the job to a thread once the row is visible to it
+    transaction.on_commit(lambda: _get_executor().submit(run_job, job.id))
+    return job, True
+
+
+class ProgressReporter:
+    """Merges progress fields into Job.progress, writing at most once per PROGRESS_INTERVAL"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.progress = {}
+        self._last_write = 0.0
+
+    def __call__(self, **fields):
+        self.progress.update(fields)
+        now = time.monotonic()
+        if now - self._last_write >= PROGRESS_INTERVAL:
+            self.flush()
+            self._last_write = now
+
+    def flush(self):
+        Job.objects.filter(pk=self.job_id).update(progress=self.progress, updated_at=timezone.now())
+
+
+class Heartbeat:
+    """Touches Job.updated_at every HEARTBEAT_INTERVAL from a side thread.
+
+    Handlers can spend longer than STALE_AFTER in one phase without
+    reporting progress (a large COPY, closing the run archive); the
+    heartbeat keeps fail_stale_jobs from declaring such a job dead.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'job-heartbeat-{job_id}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(HEARTBEAT_INTERVAL):
+                try:
+                    Job.objects.filter(pk=self.job_id, status=Job.STATUS_RUNNING).update(updated_at=timezone.now())
+                except Exception as e:
+                    logger.warning(f"Job {self.job_id} heartbeat failed: {e}")
+        finally:
+            close_old_connections()
+
+
+def run_job(job_id):
+    """Executor entry point: run the job's handler and record the outcome"""
+    close_old_connections()
+    try:
+        updated = Job.objects.filter(pk=job_id, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_RUNNING, started_at=timezone.now(), updated_at=timezone.now()
+        )
+        if not updated:
+            return
+        job = Job.objects.get(pk=job_id)
+        report = ProgressReporter(job_id)
+        logger.info(f"Job {job_id} ({job.kind}) started")
+        # Outcomes are only recorded on a job that is still running: once fail_stale_jobs
+        # has failed it, a new run of the same kind may already have started
+        running = Job.objects.filter(pk=job_id, status=Job.STATUS_RUNNING)
+        try:
+            with Heartbeat(job_id):
+                result = _handlers[job.kind](job.params, report)
+        except Exception as e:
+            logger.error(f"Job {job_id} ({job.kind}) failed: {e}")
+            running.update(
+                status=Job.STATUS_FAILED, progress=report.progress,
+                error=f'{e}\n{traceback.format_exc()}', finished_at=timezone.now(),
+            )
+            return
+        if running.update(
+            status=Job.STATUS_SUCCEEDED, progress=report.progress,
+            result=result or {}, finished_at=timezone.now(),
+        ):
+            logger.info(f"Job {job_id} ({job.kind}) succeeded")
+        else:
+            logger.warning(f"Job {job_id} ({job.kind}) finished after it was marked failed; result discarded")
+    finally:
+        close_old_connections()
+
+
+def job_to_dict(job: Job) -> Dict[str, Any]:
+    return {
+        'id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'result': job.result,
+        'error': job.error.split('\n', 1)[0] if job.error else None,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# Job kinds started from the API
+
+@register_job('fetch_tracking')
+def fetch_tracking_job(params, report):
+    import io
+    from django.core.management import call_command
+    from api.services.archive_writer import create_run_folder, find_run_archive
+
+    run_folder = create_run_folder()
+    call_command(
+        'fetch_tracking_data', '--stream', '--save-to', os.path.basename(run_folder),
+        progress=report, stdout=io.StringIO(),
+    )
+    return {
+        'json_file': find_run_archive(run_folder),
+        'folder': os.path.basename(run_folder),
+    }
+
+
+@register_job('load_database')
+def load_database_job(params, report):
+    import io
+    from django.core.management import call_command
+    from api.models import DeviceData
+
+    cmd_args = ['load_device_data', params['json_file']]
+    if params.get('clear_existing'):
+        cmd_args.append('--clear-existing')
+    call_command(*cmd_args, progress=report, stdout=io.StringIO())
+    return {'total_records': DeviceData.objects.count()}
+
+
+@register_job('refresh')
+def refresh_job(params, report):
+    from scripts.utils.load_imei import get_imeis_from_csv
+    from api.models import DeviceData
+    from api.services.archive_writer import create_run_folder
+    from api.services.refresh_pipeline import run_refresh
+
+    imeis = get_imeis_from_csv(params.get('imei_file', 'MAIN.csv'))
+    archive_folder = create_run_folder() if params.get('archive', True) else None
+    stats = run_refresh(
+        imeis,
+        archive_folder=archive_folder,
+        progress=lambda loaded, total, batches: report(batches_done=batches, records_loaded=loaded, total=total),
+    )
+    stats['archive_folder'] = os.path.basename(archive_folder) if archive_folder else None
+    stats['total_records'] = DeviceData.objects.count()
+    return stats
@@ -0,0 +1,294 @@
+"""Live fleet updates pushed to dashboards as server-sent events.
+
+Every load that changes DeviceData records one SnapshotDelta row: the
+changed devices, datastatus transitions, and the refreshed stats with their
+difference from the previous delta. The row is written by whichever process
+ran the load (daemon, job thread, command). In each ASGI web process a
+single LiveHub polls the table for new rows. It polls only while clients
+are connected, and fans each delta out to bounded per-client queues. A
+client that falls behind gets its queued deltas coalesced into one, and a
+client that falls too far behind is told to resync.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+from datetime import timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api.models import SnapshotDelta
+from api.services.fleet_stats import get_fleet_stats
+from api.services.refresh_pipeline import run_in_thread
+from api.services.response_cache import get_snapshot
+from api.signals import devices_changed
+
+logger = logging.getLogger(__name__)
+
+# Seconds between hub polls of SnapshotDelta while clients are connected
+LIVE_POLL_SECONDS = 1.0
+# Events queued per client before its pending deltas are coalesced
+LIVE_QUEUE_SIZE = 8
+# Comment lines keeping idle connections (and proxies) open
+LIVE_HEARTBEAT_SECONDS = 15
+# Deltas kept for Last-Event-ID replay after a reconnect
+DELTA_RETENTION = timedelta(hours=1)
+# Beyond this many devices a delta is replaced by a resync event
+MAX_DELTA_DEVICES = 5000
+# Client reconnect delay sent with the stream (milliseconds)
+RETRY_MS = 5000
+
+# Device fields sent in deltas; enough to update a table row or map marker
+LIVE_DEVICE_FIELDS = [
+    'imei', 'latitude', 'longitude', 'coordinates', 'datastatus', 'datastatus_description',
+    'hearttime_date', 'hearttime_time', 'hearttime_unix', 'status',
+]
+
+
+def _live_device(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Delta fields of a loader row, formatted like /api/devices/ records"""
+    device = {name: row[name] for name in LIVE_DEVICE_FIELDS}
+    device['latitude'] = float(device['latitude'])
+    device['longitude'] = float(device['longitude'])
+    device['hearttime_date'] = row['hearttime_date'].isoformat() if row['hearttime_date'] else ''
+    device['hearttime_time'] = row['hearttime_time'].strftime('%H:%M:%S') if row['hearttime_time'] else ''
+    return device
+
+
+def _stats_delta(stats: Dict[str, Any], before: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    before = before or {}
+    before_counts = before.get('status_counts', {})
+    statuses = set(stats['status_counts']) | set(before_counts)
+    return {
+        'total_devices': stats['total_devices'] - before.get('total_devices', 0),
+        'with_coordinates': stats['with_coordinates'] - before.get('with_coordinates', 0),
+        'status_counts': {
+            status: stats['status_counts'].get(status, 0) - before_counts.get(status, 0)
+            for status in statuses
+            if stats['status_counts'].get(status, 0) != before_counts.get(status, 0)
+        },
+    }
+
+
+def record_delta(rows: List[Dict[str, Any]], previous: Dict[str, Optional[Tuple]], resync: bool = False) -> SnapshotDelta:
+    """Store the delta of one committed load (FleetStats must already be refreshed)"""
+    stats = get_fleet_stats()
+    last = SnapshotDelta.objects.order_by('-id').values_list('payload', flat=True).first()
+    resync = resync or len(rows) > MAX_DELTA_DEVICES
+    payload = {
+        'resync': resync,
+        'devices': [] if resync else [_live_device(row) for row in rows],
+        'transitions': [] if resync else [
+            {'imei': row['imei'], 'from': previous[row['imei']][1] if previous.get(row['imei']) else None,
+             'to': row['datastatus']}
+            for row in rows
+            if not previous.get(row['imei']) or previous[row['imei']][1] != row['datastatus']
+        ],
+        'stats': stats,
+        'stats_delta': _stats_delta(stats, last['stats'] if last else None),
+    }
+    delta = SnapshotDelta.objects.create(version=_snapshot_version(), payload=payload)
+    SnapshotDelta.objects.filter(created_at__lt=timezone.now() - DELTA_RETENTION).delete()
+    return delta
+
+
+def _snapshot_version() -> int:
+    return get_snapshot()[0]
+
+
+def publish_resync():
+    """Tell connected dashboards to reload everything (e.g. after the table was cleared)"""
+    return record_delta([], {}, resync=True)
+
+
+# Connected after fleet_stats' receiver (see ApiConfig.ready), so the stats are already refreshed
+@receiver(devices_changed)
+def record_delta_on_devices_changed(sender, rows, previous=None, **kwargs):
+    try:
+        record_delta(rows, previous or {})
+    except Exception as e:
+        # The load itself is committed; dashboards fall back to resync on reconnect
+        logger.warning(f"Could not record live delta: {e}")
+
+
+# Events
+
+def _event(delta_id: int, version: int, payload: Dict[str, Any], coalesced: int = 1) -> Dict[str, Any]:
+    return dict(payload, id=delta_id, version=version, coalesced=coalesced)
+
+
+def merge_events(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    """One event equivalent to ``first`` followed by ``second``"""
+    if first['resync'] or second['resync']:
+        devices, transitions, resync = [], [], True
+    else:
+        by_imei = {device['imei']: device for device in first['devices']}
+        by_imei.update((device['imei'], device) for device in second['devices'])
+        devices = list(by_imei.values())
+        resync = len(devices) > MAX_DELTA_DEVICES
+        # First "from" and last "to" per device; back-and-forth changes cancel out
+        spans = {}
+        for transition in first['transitions'] + second['transitions']:
+            start = spans.get(transition['imei'], transition)['from']
+            spans[transition['imei']] = {'imei': transition['imei'], 'from': start, 'to': transition['to']}
+        transitions = [] if resync else [span for span in spans.values() if span['from'] != span['to']]
+        if resync:
+            devices = []
+
+    stats_delta = {
+        'total_devices': first['stats_delta']['total_devices'] + second['stats_delta']['total_devices'],
+        'with_coordinates': first['stats_delta']['with_coordinates'] + second['stats_delta']['with_coordinates'],
+        'status_counts': dict(first['stats_delta']['status_counts']),
+    }
+    for status, change in second['stats_delta']['status_counts'].items():
+        stats_delta['status_counts'][status] = stats_delta['status_counts'].get(status, 0) + change
+    stats_delta['status_counts'] = {status: change for status, change in stats_delta['status_counts'].items() if change}
+
+    return {
+        'id': second['id'],
+        'version': second['version'],
+        'resync': resync,
+        'devices': devices,
+        'transitions': transitions,
+        'stats': second['stats'],
+        'stats_delta': stats_delta,
+        'coalesced': first['coalesced'] + second['coalesced'],
+    }
+
+
+class Subscriber:
+    """One connected client: a bounded queue whose backlog is coalesced instead of growing"""
+
+    def __init__(self, maxsize: int = LIVE_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize)
+
+    def push(self, event: Dict[str, Any]):
+        if self.queue.full():
+            # Slow client: fold everything pending and the new event into one
+            merged = self.queue.get_nowait()
+            while not self.queue.empty():
+                merged = merge_events(merged, self.queue.get_nowait())
+            event = merge_events(merged, event)
+        self.queue.put_nowait(event)
+
+
+def _deltas_after(last_id: int, limit: int = 100) -> List[Tuple[int, int, Dict[str, Any]]]:
+    return list(
+        SnapshotDelta.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'version', 'payload')[:limit]
+    )
+
+
+def _latest_delta_id() -> int:
+    return SnapshotDelta.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def _oldest_delta_id() -> int:
+    return SnapshotDelta.objects.order_by('id').values_list('id', flat=True).first() or 0
+
+
+class LiveHub:
+    """Polls SnapshotDelta once per process and broadcasts new rows to every subscriber"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.last_id = None
+        self._task = None
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        if self._task is None or self._task.done():
+            # A fresh context: the poller outlives the request that started it
+            self._task = asyncio.get_running_loop().create_task(self._poll(), context=contextvars.Context())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def _poll(self):
+        while self.subscribers:
+            try:
+                if self.last_id is None:
+                    self.last_id = await run_in_thread(_latest_delta_id)
+                for delta_id, version, payload in await run_in_thread(_deltas_after, self.last_id):
+                    event = _event(delta_id, version, payload)
+                    for subscriber in list(self.subscribers):
+                        subscriber.push(event)
+                    self.last_id = delta_id
+            except Exception as e:
+                logger.warning(f"Live update poll failed: {e}")
+            await asyncio.sleep(LIVE_POLL_SECONDS)
+        # Nobody listening: stop polling and start from the newest delta next time
+        self.last_id = None
+
+
+_hubs = {}
+
+
+def get_hub() -> LiveHub:
+    """The hub of the running event loop (one per ASGI worker)"""
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        _hubs.clear()
+        _hubs[loop] = LiveHub()
+    return _hubs[loop]
+
+
+def _format(event_type: str, data: Dict[str, Any], event_id: Optional[int] = None) -> bytes:
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def _event_message(event: Dict[str, Any]) -> bytes:
+    return _format('resync' if event['resync'] else 'delta', event, event['id'])
+
+
+async def _replay(last_event_id: int) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Deltas missed since ``last_event_id`` as one event, or a resync when they are no longer all kept"""
+    deltas = await run_in_thread(_deltas_after, last_event_id, 1000)
+    if not deltas:
+        return None, last_event_id
+    event = None
+    for delta_id, version, payload in deltas:
+        current = _event(delta_id, version, payload)
+        event = current if event is None else merge_events(event, current)
+    # Ids can skip (sequence values lost to rolled-back inserts), so a gap proves nothing.
+    # Pruning goes oldest first: the client's last delta being gone means later ones may be too
+    if last_event_id < await run_in_thread(_oldest_delta_id):
+        event['resync'], event['devices'], event['transitions'] = True, [], []
+    return event, deltas[-1][0]
+
+
+async def event_stream(last_event_id: Optional[str] = None) -> AsyncIterator[bytes]:
+    """SSE byte stream for one client: current snapshot, missed deltas, then live deltas"""
+    hub = get_hub()
+    subscriber = hub.subscribe()
+    try:
+        yield f'retry: {RETRY_MS}\n\n'.encode('utf-8')
+        stats = await run_in_thread(get_fleet_stats)
+        yield _format('snapshot', {'version': await run_in_thread(_snapshot_version), 'stats': stats})
+
+        sent_id = 0
+        if last_event_id and last_event_id.isdigit():
+            event, sent_id = await _replay(int(last_event_id))
+            if event is not None:
+                yield _event_message(event)
+
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), LIVE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield b': ping\n\n'
+                continue
+            if event['id'] <= sent_id:
+                continue  # already covered by the replay
+            sent_id = event['id']
+            yield _event_message(event)
+    finally:
+        hub.unsubscribe(subscriber)
@@ -0,0 +1,195 @@
+"""k-nearest-device search over current positions.
+
+Positions are stored as 3D unit vectors in a static KD-tree. The straight
+(chord) distance between two unit vectors grows monotonically with their
+great-circle distance, so the Euclidean nearest neighbours in 3D are
+exactly the haversine nearest neighbours on the sphere, with no special
+cases at the poles or the antimeridian. Each web process keeps one tree and
+rebuilds it lazily when the snapshot version changes. Devices without a
+position (the "0,0" placeholder of combine_coordinates) are left out.
+"""
+import heapq
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from api.models import DeviceData
+from api.services.device_list import DEVICE_LIST_FIELDS, serialize_device_rows
+from api.services.response_cache import get_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Mean Earth radius (IUGG)
+EARTH_RADIUS_KM = 6371.0088
+# Points per leaf; leaves are scanned with one vectorized distance computation
+LEAF_SIZE = 32
+DEFAULT_NEIGHBOURS = 10
+MAX_NEIGHBOURS = 100
+
+
+def unit_vectors(latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """(n, 3) unit vectors for positions in degrees"""
+    lat = np.radians(latitudes)
+    lon = np.radians(longitudes)
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_km(chord: np.ndarray) -> np.ndarray:
+    """Great-circle distance for the chord length between two unit vectors"""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def km_to_chord(distance_km: float) -> float:
+    return 2 * np.sin(min(distance_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+class KDTree:
+    """Static KD-tree over 3D points with bounding boxes per node.
+
+    Nodes cover contiguous slices of ``order``; a query visits them best-first
+    by the distance from the query point to their bounding box and stops once
+    no unvisited node can hold a closer point than the k found so far.
+    """
+
+    def __init__(self, points: np.ndarray, leaf_size: int = LEAF_SIZE):
+        self.points = points
+        self.order = np.arange(len(points))
+        self.leaf_size = leaf_size
+        # Per node: slice bounds, children (-1 for leaves) and bounding box
+        self.starts, self.ends, self.lefts, self.rights, self.lows, self.highs = [], [], [], [], [], []
+        if len(points):
+            self._build(0, len(points))
+        self.lows = np.array(self.lows)
+        self.highs = np.array(self.highs)
+
+    def _build(self, start: int, end: int) -> int:
+        node = len(self.starts)
+        subset = self.points[self.order[start:end]]
+        low, high = subset.min(axis=0), subset.max(axis=0)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.lefts.append(-1)
+        self.rights.append(-1)
+        self.lows.append(low)
+        self.highs.append(high)
+        if end - start > self.leaf_size:
+            # Split the widest axis at the median
+            axis = int(np.argmax(high - low))
+            middle = (end - start) // 2
+            partition = np.argpartition(subset[:, axis], middle)
+            self.order[start:end] = self.order[start:end][partition]
+            self.lefts[node] = self._build(start, start + middle)
+            self.rights[node] = self._build(start + middle, end)
+        return node
+
+    def _box_distance(self, node: int, point: np.ndarray) -> float:
+        gap = np.maximum(np.maximum(self.lows[node] - point, point - self.highs[node]), 0)
+        return float(np.sqrt(gap @ gap))
+
+    def query(self, point: np.ndarray, k: int, max_distance: float = np.inf) -> List[Tuple[float, int]]:
+        """Up to ``k`` (distance, point index) pairs nearest to ``point``, closest first"""
+        if not len(self.points):
+            return []
+        best = []  # max-heap of (-distance, index) holding the k closest so far
+        candidates = [(self._box_distance(0, point), 0)]
+        while candidates:
+            bound, node = heapq.heappop(candidates)
+            limit = -best[0][0] if len(best) == k else max_distance
+            if bound > limit:
+                break
+            if self.lefts[node] < 0:
+                indexes = self.order[self.starts[node]:self.ends[node]]
+                offsets = self.points[indexes] - point
+                distances = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+                for distance, index in zip(distances.tolist(), indexes.tolist()):
+                    if distance > max_distance:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, index))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, index))
+            else:
+                for child in (self.lefts[node], self.rights[node]):
+                    heapq.heappush(candidates, (self._box_distance(child, point), child))
+        return sorted((-negative, index) for negative, index in best)
+
+
+class PositionIndex:
+    """KD-tree of one snapshot version plus the device record of every point"""
+
+    def __init__(self, version: int, records: List[Dict[str, Any]]):
+        self.version = version
+        self.records = records
+        latitudes = np.array([record['latitude'] for record in records], dtype=np.float64)
+        longitudes = np.array([record['longitude'] for record in records], dtype=np.float64)
+        self.tree = KDTree(unit_vectors(latitudes, longitudes))
+
+    @classmethod
+    def build(cls, version: int) -> 'PositionIndex':
+        rows = (
+            DeviceData.objects
+            .exclude(latitude=0, longitude=0)
+            .exclude(coordinates='0,0')
+            .filter(latitude__gte=-90, latitude__lte=90, longitude__gte=-180, longitude__lte=180)
+            .values_list(*DEVICE_LIST_FIELDS)
+        )
+        return cls(version, serialize_device_rows(rows.iterator(chunk_size=5000)))
+
+    def nearest(self, latitude: float, longitude: float, k: int,
+                max_km: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Copies of the ``k`` nearest records, closest first, each with ``distance_km``"""
+        point = unit_vectors(np.array([latitude]), np.array([longitude]))[0]
+        max_distance = km_to_chord(max_km) if max_km is not None else np.inf
+        matches = self.tree.query(point, k, max_distance)
+        distances = chord_to_km(np.array([distance for distance, _ in matches]))
+        return [
+            dict(self.records[index], distance_km=round(float(distance_km), 3))
+            for (_, index), distance_km in zip(matches, distances)
+        ]
+
+
+_index = None
+_build_lock = threading.Lock()
+
+
+def get_position_index() -> PositionIndex:
+    """The index of the current snapshot.
+
+    While another thread rebuilds, the previous index keeps answering; only
+    the very first build is waited for.
+    """
+    global _index
+    version, _ = get_snapshot()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    if not _build_lock.acquire(blocking=index is None):
+        return index
+    try:
+        if _index is None or _index.version != version:
+            _index = PositionIndex.build(version)
+            logger.info(f"Position index rebuilt for snapshot v{version}: {len(_index.records)} devices")
+        return _index
+    finally:
+        _build_lock.release()
+
+
+def parse_nearest_params(params: Dict[str, str]) -> Tuple[float, float, int, Optional[float]]:
+    """(lat, lon, k, max_km) from query parameters; raises ValueError"""
+    try:
+        latitude = float(params['lat'])
+        longitude = float(params['lon'])
+        k = int(params.get('k', DEFAULT_NEIGHBOURS))
+        max_km = float(params['max_km']) if params.get('max_km') else None
+    except (KeyError, ValueError):
+        raise ValueError('lat and lon are required numbers; k must be an integer and max_km a number')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('lat must be within -90..90 and lon within -180..180')
+    if not 1 <= k <= MAX_NEIGHBOURS:
+        raise ValueError(f'k must be between 1 and {MAX_NEIGHBOURS}')
+    if max_km is not None and not max_km > 0:
+        raise ValueError('max_km must be positive')
+    return latitude, longitude, k, max_km
@@ -0,0 +1,76 @@
+import logging
+from datetime import datetime, timezone as dt_timezone
+from typing import Any, Dict, List, Optional
+
+from django.db import connection, transaction
+
+from api.models import PositionHistory
+
+logger = logging.getLogger(__name__)
+
+# Monthly partitions created ahead of the current month
+PARTITION_MONTHS_AHEAD = 2
+
+# Months this process already made sure exist
+_ensured_months = set()
+
+
+def _month_start(year: int, month: int) -> int:
+    return int(datetime(year, month, 1, tzinfo=dt_timezone.utc).timestamp())
+
+
+def _add_months(year: int, month: int, count: int):
+    index = year * 12 + (month - 1) + count
+    return index // 12, index % 12 + 1
+
+
+def ensure_partitions(now: Optional[datetime] = None, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Create the monthly PositionHistory partitions for this month and the next few (PostgreSQL only).
+
+    Heartbeats outside existing partitions (e.g. long-offline devices
+    reporting an old hearttime) go to the DEFAULT partition. A month whose
+    rows already sit in DEFAULT cannot be attached and is left there.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    now = now or datetime.now(dt_timezone.utc)
+    table = PositionHistory._meta.db_table
+
+    for offset in range(months_ahead + 1):
+        year, month = _add_months(now.year, now.month, offset)
+        if (year, month) in _ensured_months:
+            continue
+        next_year, next_month = _add_months(year, month, 1)
+        partition = f'{table}_y{year}m{month:02d}'
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(partition)} '
+                    f'PARTITION OF {connection.ops.quote_name(table)} '
+                    f'FOR VALUES FROM ({_month_start(year, month)}) TO ({_month_start(next_year, next_month)})'
+                )
+            _ensured_months.add((year, month))
+        except Exception as e:
+            logger.warning(f"Could not create partition {partition}: {e}")
+
+
+def get_position_history(imei: str, since: Optional[int] = None, until: Optional[int] = None,
+                         limit: int = 1000) -> List[Dict[str, Any]]:
+    """Positions of one device, oldest first, optionally bounded by unix timestamps"""
+    queryset = PositionHistory.objects.filter(imei=imei)
+    if since is not None:
+        queryset = queryset.filter(hearttime_unix__gte=since)
+    if until is not None:
+        queryset = queryset.filter(hearttime_unix__lt=until)
+    rows = queryset.order_by('hearttime_unix').values_list(
+        'hearttime_unix', 'latitude', 'longitude', 'datastatus'
+    )[:limit]
+    return [
+        {
+            'hearttime_unix': hearttime,
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'datastatus': datastatus,
+        }
+        for hearttime, latitude, longitude, datastatus in rows
+    ]
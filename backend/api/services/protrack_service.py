@@ -1,47 +1,27 @@
-import hashlib
 import time
 import requests
 import asyncio
 import aiohttp
-from typing import List, Dict, Any
+from typing import AsyncIterator, List, Dict, Any, Optional, Set, Tuple
 import logging
 from datetime import datetime, timezone, timedelta
 
+from .retry import RetryBudget, RetryPolicy
+from .concurrency import AdaptiveConcurrencyLimiter, classify_batch_result
+from .token_manager import PROTRACK_BASE_URL, TokenManager, get_token_manager, is_auth_error
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def get_token():
-    """Get authentication token from ProTrack365 API"""
-    account = "bajajtrack"
-    password = "bajajrecombodia"
-    unix_time = int(time.time())
-
-    # Generate MD5 hashed password
-    first_hash = hashlib.md5(password.encode()).hexdigest()
-    signature = hashlib.md5((first_hash + str(unix_time)).encode()).hexdigest()
+TRACK_ENDPOINT = f"{PROTRACK_BASE_URL}/api/track"
 
-    # Build endpoint
-    endpoint = f"https://api.protrack365.com/api/authorization?time={unix_time}&account={account}&signature={signature}"
+def get_token():
+    """Get authentication token from ProTrack365 API.
 
-    try:
-        response = requests.get(endpoint, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        if 'record' in data and 'access_token' in data['record']:
-            token = data['record']['access_token']
-            logger.info("Successfully obtained access token")
-            return token
-        else:
-            logger.error(f"Invalid response format: {data}")
-            raise ValueError("Invalid response format from authorization API")
-            
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching token: {e}")
-        raise
-    except KeyError as e:
-        logger.error(f"Missing key in response: {e}")
-        raise
+    Served from the shared token manager, so repeated calls reuse the cached
+    token until it is close to expiry.
+    """
+    return get_token_manager().get_token()
 
 def get_device_list(account, token):
     """Get list of devices from ProTrack365 API"""
@@ -61,8 +41,17 @@ def chunk_list(lst: List[str], size: int = 100) -> List[List[str]]:
     """Split list into chunks of specified size"""
     return [lst[i:i + size] for i in range(0, len(lst), size)]
 
-async def fetch_batch(session: aiohttp.ClientSession, imei_batch: List[str], token: str, endpoint: str) -> Dict[str, Any]:
-    """Fetch tracking data for a batch of IMEIs"""
+async def fetch_batch(session: aiohttp.ClientSession, imei_batch: List[str], token: str, endpoint: str,
+                      token_manager: Optional[TokenManager] = None) -> Dict[str, Any]:
+    """Fetch tracking data for a batch of IMEIs.
+
+    With a token manager, the batch uses the manager's current token (``token``
+    only until it holds one), so a refresh done for one batch is picked up by
+    every later attempt. If the API rejects the token, it is refreshed and the
+    batch is retried once.
+    """
+    if token_manager is not None:
+        token = token_manager.current_token(token)
     params = {  
         "imeis": ",".join(imei_batch),
         "access_token": token
@@ -70,67 +59,180 @@ async def fetch_batch(session: aiohttp.ClientSession, imei_batch: List[str], tok
     
     try:
         async with session.get(endpoint, params=params, timeout=aiohttp.ClientTimeout(total=60)) as response:
+            if response.status != 401:
+                response.raise_for_status()
+                data = await response.json()
+            else:
+                data = None
+
+        # The response's connection is back in the pool here. When a token expires every
+        # in-flight batch gets a 401 at once, and the re-authentication needs a connection too
+        if token_manager is not None and is_auth_error(response.status, data):
+            logger.warning(f"Access token rejected for batch {imei_batch[:3]}..., re-authenticating")
+            token_manager.invalidate(token)
+            new_token = await token_manager.get_token_async(session, force=True, stale_token=token)
+            return await fetch_batch(session, imei_batch, new_token, endpoint)
+        if response.status == 401:
             response.raise_for_status()
-            data = await response.json()
+
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Batch response for {len(imei_batch)} IMEIs: {data}")
-            return data
+        if isinstance(data, dict) and 'record' not in data and data.get('code') not in (None, 0, '0'):
+            logger.error(f"API error {data.get('code')} for batch {imei_batch[:3]}...: {data.get('message')}")
+            return batch_error(imei_batch, data.get('message') or f"code {data.get('code')}", error_type="api")
+        return data
+    except asyncio.TimeoutError as e:
+        logger.error(f"Timeout fetching batch {imei_batch[:3]}...")
+        return batch_error(imei_batch, e or "timeout", error_type="timeout")
+    except aiohttp.ClientResponseError as e:
+        logger.error(f"HTTP {e.status} fetching batch {imei_batch[:3]}...: {e.message}")
+        return batch_error(imei_batch, e, error_type="http", http_status=e.status)
     except Exception as e:
         logger.error(f"Error fetching batch {imei_batch[:3]}...: {e}")
-        # Return error info instead of raising to continue with other batches
-        return {
-            "error": str(e),
-            "imei_batch": imei_batch,
-            "status": "failed"
-        }
-
-async def get_track_info_concurrent(imei_list: List[str], token: str, endpoint: str) -> List[Dict[str, Any]]:
-    """Main async function to fetch tracking data for all IMEIs"""
+        return batch_error(imei_batch, e)
+
+
+def batch_error(imei_batch: List[str], error, error_type: str = "network",
+                http_status: Optional[int] = None) -> Dict[str, Any]:
+    """Error info returned instead of raising so the other batches continue"""
+    return {
+        "error": str(error) or error_type,
+        "error_type": error_type,
+        "http_status": http_status,
+        "imei_batch": imei_batch,
+        "status": "failed"
+    }
+
+async def fetch_batch_limited(session: aiohttp.ClientSession, imei_batch: List[str], token: str, endpoint: str,
+                              token_manager: Optional[TokenManager],
+                              limiter: AdaptiveConcurrencyLimiter) -> Dict[str, Any]:
+    """fetch_batch under the adaptive concurrency limit, feeding back latency and outcome"""
+    async with limiter:
+        started = time.monotonic()
+        result = await fetch_batch(session, imei_batch, token, endpoint, token_manager)
+        limiter.record(time.monotonic() - started, classify_batch_result(result))
+    return result
+
+def create_track_session(max_connections: int = 32) -> aiohttp.ClientSession:
+    """ClientSession for the track API; the pool is sized to the limiter's ceiling
+    and the limiter decides how many connections are actually used"""
+    timeout = aiohttp.ClientTimeout(total=120)
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections)
+    return aiohttp.ClientSession(timeout=timeout, connector=connector)
+
+def is_failed_batch(result: Any) -> bool:
+    return isinstance(result, dict) and "error" in result
+
+async def fetch_batch_resilient(session: aiohttp.ClientSession, imei_batch: List[str], token: str, endpoint: str,
+                                token_manager: Optional[TokenManager], limiter: AdaptiveConcurrencyLimiter,
+                                policy: RetryPolicy, budget: RetryBudget) -> List[Dict[str, Any]]:
+    """Fetch a batch, retrying failures with backoff and bisecting batches that keep failing.
+
+    Returns one result per sub-batch actually fetched. A single IMEI that
+    still fails after its retries is returned with ``isolated=True`` so the
+    caller can quarantine it.
+    """
+    result = await fetch_batch_limited(session, imei_batch, token, endpoint, token_manager, limiter)
+    attempt = 0
+    while is_failed_batch(result) and attempt + 1 < policy.max_attempts and budget.try_spend():
+        await asyncio.sleep(policy.delay(attempt))
+        attempt += 1
+        result = await fetch_batch_limited(session, imei_batch, token, endpoint, token_manager, limiter)
+
+    if not is_failed_batch(result):
+        return [result]
+
+    if len(imei_batch) > 1 and budget.try_spend(2):
+        mid = len(imei_batch) // 2
+        logger.warning(f"Batch of {len(imei_batch)} IMEIs keeps failing, splitting to isolate bad IMEIs")
+        halves = await asyncio.gather(
+            fetch_batch_resilient(session, imei_batch[:mid], token, endpoint, token_manager, limiter, policy, budget),
+            fetch_batch_resilient(session, imei_batch[mid:], token, endpoint, token_manager, limiter, policy, budget),
+        )
+        return halves[0] + halves[1]
+
+    if len(imei_batch) == 1 and attempt + 1 >= policy.max_attempts:
+        result["isolated"] = True
+    return [result]
+
+async def get_track_info_concurrent(imei_list: List[str], token: str, endpoint: str,
+                                    token_manager: Optional[TokenManager] = None,
+                                    limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                                    retry_policy: Optional[RetryPolicy] = None,
+                                    retry_budget: Optional[RetryBudget] = None,
+                                    session: Optional[aiohttp.ClientSession] = None) -> List[Dict[str, Any]]:
+    """Main async function to fetch tracking data for all IMEIs.
+
+    In-flight batches are bounded by an adaptive (AIMD) limiter; pass one in
+    to read back the concurrency it settled on via ``limiter.snapshot()``.
+    Failed batches are retried and bisected within a per-run retry budget;
+    whatever still fails is returned as error dicts after the successful
+    batches so process_tracking_data can mark only those IMEIs.
+
+    Pass ``session`` to reuse a long-lived ClientSession (and its open
+    connections) across runs; otherwise one is created for this run.
+    """
     if not imei_list:
         logger.warning("Empty IMEI list provided")
         return []
     
+    if limiter is None:
+        limiter = AdaptiveConcurrencyLimiter()
+    if session is None:
+        async with create_track_session(limiter.max_limit) as own_session:
+            return await get_track_info_concurrent(imei_list, token, endpoint, token_manager, limiter,
+                                                   retry_policy, retry_budget, own_session)
+
     imei_chunks = chunk_list(imei_list, 100)
     logger.info(f"Processing {len(imei_list)} IMEIs in {len(imei_chunks)} batches")
     
-    # Set up aiohttp session with proper timeout and connection limits
-    timeout = aiohttp.ClientTimeout(total=120)
-    connector = aiohttp.TCPConnector(limit=10, limit_per_host=5)
+    if token_manager is None:
+        token_manager = get_token_manager()
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    if retry_budget is None:
+        retry_budget = RetryBudget(max_retries=max(50, len(imei_chunks)))
+
+    tasks = [
+        fetch_batch_resilient(session, chunk, token, endpoint, token_manager, limiter,
+                              retry_policy, retry_budget)
+        for chunk in imei_chunks
+    ]
     
-    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-        tasks = [
-            fetch_batch(session, chunk, token, endpoint)
-            for chunk in imei_chunks
-        ]
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Process results and handle exceptions
-        successful_results = []
-        failed_batches = []
-        
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                logger.error(f"Batch {i} failed with exception: {result}")
-                failed_batches.append({
-                    "batch_index": i,
-                    "imei_batch": imei_chunks[i],
-                    "error": str(result),
-                    "status": "exception"
-                })
-            elif isinstance(result, dict) and "error" in result:
-                logger.error(f"Batch {i} returned error: {result['error']}")
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    # Process results and handle exceptions
+    successful_results = []
+    failed_batches = []
+    
+    for i, batch_results in enumerate(results):
+        if isinstance(batch_results, Exception):
+            logger.error(f"Batch {i} failed with exception: {batch_results}")
+            failed_batches.append({
+                "batch_index": i,
+                "imei_batch": imei_chunks[i],
+                "error": str(batch_results),
+                "status": "exception"
+            })
+            continue
+        for result in batch_results:
+            if is_failed_batch(result):
+                logger.error(f"Batch {i} returned error for {len(result['imei_batch'])} IMEIs: {result['error']}")
                 failed_batches.append(result)
             else:
                 successful_results.append(result)
-        
-        logger.info(f"Successfully fetched {len(successful_results)} batches, {len(failed_batches)} failed")
-        
-        if failed_batches:
-            logger.warning(f"Failed batches: {failed_batches}")
-        
-        return successful_results
+    
+    failed_imeis = sum(len(b["imei_batch"]) for b in failed_batches)
+    logger.info(f"Successfully fetched {len(successful_results)} batches, "
+                f"{len(failed_batches)} failed ({failed_imeis} IMEIs), "
+                f"retries used {retry_budget.spent}/{retry_budget.max_retries}")
+    logger.info(f"Adaptive concurrency settled at {limiter.limit} (stats: {limiter.snapshot()})")
+    
+    return successful_results + failed_batches
 
-def get_track_info(imei_list: List[str], token: str, endpoint: str) -> List[Dict[str, Any]]:
+def get_track_info(imei_list: List[str], token: str, endpoint: str,
+                   token_manager: Optional[TokenManager] = None,
+                   limiter: Optional[AdaptiveConcurrencyLimiter] = None) -> List[Dict[str, Any]]:
     """Synchronous wrapper to call the async tracking function"""
     try:
         # Check if we're already in an event loop
@@ -143,7 +245,7 @@ def get_track_info(imei_list: List[str], token: str, endpoint: str) -> List[Dict
             raise RuntimeError("Cannot call asyncio.run() from within an async context")
         except RuntimeError:
             # No event loop running, safe to use asyncio.run()
-            return asyncio.run(get_track_info_concurrent(imei_list, token, endpoint))
+            return asyncio.run(get_track_info_concurrent(imei_list, token, endpoint, token_manager, limiter))
     except Exception as e:
         logger.error(f"Error in get_track_info: {e}")
         raise
@@ -163,9 +265,10 @@ def get_datastatus_description(datastatus):
         return "Unknown"
 
 
-def format_time_since(unix_timestamp):
+def format_time_since(unix_timestamp, now=None):
     """Return human-readable elapsed time from unix_timestamp to now in UTC as 'XdYhZmin'.
     If unix_timestamp is falsy or invalid, return empty string.
+    Pass ``now`` (aware datetime) to share one reference time across records.
     """
     if not unix_timestamp or unix_timestamp in ["", "0", 0, "None", "null", None]:
         return ""
@@ -175,7 +278,8 @@ def format_time_since(unix_timestamp):
             unix_timestamp = int(unix_timestamp)
 
         ts_dt = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc)
-        now = datetime.now(timezone.utc)
+        if now is None:
+            now = datetime.now(timezone.utc)
         # If timestamp is in the future, show 0
         if now < ts_dt:
             delta = now - ts_dt
@@ -191,16 +295,40 @@ def format_time_since(unix_timestamp):
         logger.debug(f"format_time_since error for {unix_timestamp}: {e}")
         return ""
 
+def get_relative_short(unix_timestamp, now=None):
+    """Return compact elapsed time such as '5min ago', '3h ago', '2d ago', '4m ago' or '1y ago'.
+    If unix_timestamp is falsy or invalid, return empty string.
+    """
+    if not unix_timestamp or unix_timestamp in ["", "0", 0, "None", "null", None]:
+        return ''
+    try:
+        if isinstance(unix_timestamp, str):
+            unix_timestamp = int(unix_timestamp)
+        ts_dt = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc)
+        if now is None:
+            now = datetime.now(timezone.utc)
+        mins = int((now - ts_dt).total_seconds() // 60)
+        mins_in_year = 365 * 24 * 60
+        mins_in_month = 30 * 24 * 60
+        mins_in_day = 24 * 60
+        if mins >= mins_in_year:
+            return f"{mins // mins_in_year}y ago"
+        if mins >= mins_in_month:
+            return f"{mins // mins_in_month}m ago"
+        if mins >= mins_in_day:
+            return f"{mins // mins_in_day}d ago"
+        if mins >= 60:
+            return f"{mins // 60}h ago"
+        return f"{mins}min ago"
+    except Exception:
+        return ''
+
 def combine_coordinates(latitude, longitude):
     """Combine latitude and longitude into a single string"""
-    logger.debug(f"Combining coordinates: lat={latitude} (type: {type(latitude)}), lng={longitude} (type: {type(longitude)})")
     if (latitude and longitude and 
         str(latitude) not in ["", "0", "0.0", "None", "null"] and 
         str(longitude) not in ["", "0", "0.0", "None", "null"]):
-        result = f"{latitude},{longitude}"
-        logger.debug(f"Combined coordinates result: {result}")
-        return result
-    logger.debug("Coordinates invalid, returning '0,0'")
+        return f"{latitude},{longitude}"
     return "0,0"
 
 def convert_hearttime_to_gmt7_separated(unix_timestamp):
@@ -253,94 +381,108 @@ def convert_hearttime_to_gmt7(unix_timestamp):
         logger.warning(f"Error converting hearttime {unix_timestamp}: {e}")
         return str(unix_timestamp)  # Return original value as string if conversion fails
 
-def process_tracking_data(raw_data: List[Dict[str, Any]], original_imeis: List[str]) -> List[Dict[str, Any]]:
-    """Process raw API response data into standardized format"""
+def process_devices(devices: List[Dict[str, Any]], now: datetime) -> List[Dict[str, Any]]:
+    """Process raw API device dicts one record at a time.
+
+    Reference implementation: the pipelines use
+    ``columnar.process_devices_columnar``, which must return exactly this.
+    """
+    processed_data = []
+    for device in devices:
+        imei = device.get('imei', '')
+        latitude = device.get('latitude', '')
+        longitude = device.get('longitude', '')
+        datastatus_num = device.get('datastatus', '')
+        raw_hearttime = device.get('hearttime', '')
+
+        heart_date, heart_time = convert_hearttime_to_gmt7_separated(raw_hearttime)
+
+        processed_data.append({
+            'imei': str(imei),
+            'latitude': latitude,
+            'longitude': longitude,
+            'coordinates': combine_coordinates(latitude, longitude),
+            'datastatus': datastatus_num,
+            'datastatus_description': get_datastatus_description(datastatus_num),
+            'hearttime_date': heart_date,
+            'hearttime_time': heart_time,
+            'hearttime_unix': raw_hearttime,
+            # New field: human-readable time since last update only (e.g. "153d23h46min")
+            'TimeSinceUpdate': format_time_since(raw_hearttime, now) or '',
+            'TimeAgo': get_relative_short(raw_hearttime, now) or '',
+            'status': 'success'
+        })
+    return processed_data
+
+
+def batch_devices(batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The device dicts of a successful API response"""
+    records = batch['record']
+    if not isinstance(records, list):
+        records = [records]
+    return [device for device in records if isinstance(device, dict)]
+
+
+def error_records(batch: Any, returned_imeis: Set[str]) -> List[Dict[str, Any]]:
+    """Error records for every IMEI of a failed batch.
+
+    The IMEIs are added to ``returned_imeis``: they already have a record, so
+    missing_imei_records must not append a "can't access" one that would
+    overwrite the error (or quarantine) status on load. The original
+    process_tracking_data emitted both.
+    """
+    processed_data = []
+    # Handle batch errors or unexpected formats
+    if not (isinstance(batch, dict) and "imei_batch" in batch):
+        logger.warning(f"Unexpected batch format: {batch}")
+        return processed_data
+    # This is a failed batch, add error records
+    for imei in batch["imei_batch"]:
+        processed_data.append({
+            "imei": str(imei),
+            "latitude": "",
+            "longitude": "",
+            "coordinates": "0,0",
+            "datastatus": None,
+            "datastatus_description": "Quarantined" if batch.get("error_type") == "quarantined" else "API Error",
+            "hearttime_date": "",
+            "hearttime_time": "",
+            "hearttime_unix": "",
+            "status": f"API error: {batch.get('error', 'Unknown error')}"
+        })
+        returned_imeis.add(str(imei))
+    return processed_data
+
+
+def add_returned_imeis(devices: List[Dict[str, Any]], returned_imeis: Set[str]):
+    returned_imeis.update(str(device['imei']) for device in devices if device.get('imei', ''))
+
+
+def process_batch(batch: Dict[str, Any], returned_imeis: Set[str], now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Process one raw batch (API response or failed-batch dict) into standardized records.
+
+    Device records go through the columnar (NumPy) path. IMEIs covered by
+    the batch are added to ``returned_imeis``. Elapsed-time fields are
+    computed against ``now`` (default: the time of the call).
+    """
+    from .columnar import process_devices_columnar
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+    if not (isinstance(batch, dict) and 'record' in batch):
+        return error_records(batch, returned_imeis)
+    devices = batch_devices(batch)
+    if logger.isEnabledFor(logging.DEBUG):
+        for device in devices:
+            logger.debug(f"Device {device.get('imei', '')}: lat={device.get('latitude', '')}, "
+                         f"lng={device.get('longitude', '')}, raw_data={device}")
+    add_returned_imeis(devices, returned_imeis)
+    return process_devices_columnar(devices, now)
+
+
+def missing_imei_records(original_imeis: List[str], returned_imeis: Set[str]) -> List[Dict[str, Any]]:
+    """Records for IMEIs that no batch returned, marked as "can't access"."""
     processed_data = []
-    returned_imeis = set()
-    
-    for batch in raw_data:
-        if isinstance(batch, dict) and 'record' in batch:
-            records = batch['record']
-            if not isinstance(records, list):
-                records = [records]
-                
-            for device in records:
-                if isinstance(device, dict):
-                    imei = device.get('imei', '')
-                    latitude = device.get('latitude', '')
-                    longitude = device.get('longitude', '')
-                    datastatus_num = device.get('datastatus', '')
-                    raw_hearttime = device.get('hearttime', '')
-                    
-                    # Debug logging for coordinates
-                    logger.debug(f"Device {imei}: lat={latitude}, lng={longitude}, raw_data={device}")
-                    
-                    heart_date, heart_time = convert_hearttime_to_gmt7_separated(raw_hearttime)
-
-                    # compute formatted elapsed once
-                    formatted_elapsed = format_time_since(raw_hearttime)
-
-                    def get_relative_short(unix_timestamp):
-                        if not unix_timestamp or unix_timestamp in ["", "0", 0, "None", "null", None]:
-                            return ''
-                        try:
-                            if isinstance(unix_timestamp, str):
-                                unix_timestamp = int(unix_timestamp)
-                            ts_dt = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc)
-                            mins = int((datetime.now(timezone.utc) - ts_dt).total_seconds() // 60)
-                            mins_in_year = 365 * 24 * 60
-                            mins_in_month = 30 * 24 * 60
-                            mins_in_day = 24 * 60
-                            if mins >= mins_in_year:
-                                return f"{mins // mins_in_year}y ago"
-                            if mins >= mins_in_month:
-                                return f"{mins // mins_in_month}m ago"
-                            if mins >= mins_in_day:
-                                return f"{mins // mins_in_day}d ago"
-                            if mins >= 60:
-                                return f"{mins // 60}h ago"
-                            return f"{mins}min ago"
-                        except Exception:
-                            return ''
-
-                    processed_data.append({
-                        'imei': str(imei),
-                        'latitude': latitude,
-                        'longitude': longitude,
-                        'coordinates': combine_coordinates(latitude, longitude),
-                        'datastatus': datastatus_num,
-                        'datastatus_description': get_datastatus_description(datastatus_num),
-                        'hearttime_date': heart_date,
-                        'hearttime_time': heart_time,
-                        'hearttime_unix': raw_hearttime,
-                        # New field: human-readable time since last update only (e.g. "153d23h46min")
-                        'TimeSinceUpdate': formatted_elapsed or '',
-                        'TimeAgo': get_relative_short(raw_hearttime) or '',
-                        'status': 'success'
-                    })
-                    
-                    if imei:
-                        returned_imeis.add(str(imei))
-        else:
-            # Handle batch errors or unexpected formats
-            logger.warning(f"Unexpected batch format: {batch}")
-            if isinstance(batch, dict) and "imei_batch" in batch:
-                # This is a failed batch, add error records
-                for imei in batch["imei_batch"]:
-                    processed_data.append({
-                        "imei": str(imei),
-                        "latitude": "",
-                        "longitude": "",
-                        "coordinates": "0,0",
-                        "datastatus": None,
-                        "datastatus_description": "API Error",
-                        "hearttime_date": "",
-                        "hearttime_time": "",
-                        "hearttime_unix": "",
-                        "status": f"API error: {batch.get('error', 'Unknown error')}"
-                    })
-    
-    # Add missing IMEIs as "can't access"
     missing_imeis = set(str(imei) for imei in original_imeis) - returned_imeis
     for imei in missing_imeis:
         processed_data.append({
@@ -355,6 +497,139 @@ def process_tracking_data(raw_data: List[Dict[str, Any]], original_imeis: List[s
             "hearttime_unix": "",
             "status": f"can't access to {imei}"
         })
+    return processed_data
+
+
+def process_tracking_data(raw_data: List[Dict[str, Any]], original_imeis: List[str],
+                          now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Process raw API response data into standardized format.
+
+    Device records from every successful batch are processed in a single
+    columnar pass; records keep the order of ``raw_data``, followed by the
+    IMEIs that no batch returned.
+    """
+    from .columnar import process_devices_columnar
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+    devices = []
+    segments = []  # (start, end) into devices, or the error records of a failed batch
+    returned_imeis = set()
+    for batch in raw_data:
+        if isinstance(batch, dict) and 'record' in batch:
+            start = len(devices)
+            devices.extend(batch_devices(batch))
+            segments.append((start, len(devices)))
+        else:
+            segments.append(error_records(batch, returned_imeis))
+
+    processed = process_devices_columnar(devices, now)
+    add_returned_imeis(devices, returned_imeis)
+
+    processed_data = []
+    for segment in segments:
+        if isinstance(segment, tuple):
+            processed_data.extend(processed[segment[0]:segment[1]])
+        else:
+            processed_data.extend(segment)
+    
+    # Add missing IMEIs as "can't access"
+    processed_data.extend(missing_imei_records(original_imeis, returned_imeis))
     
     logger.info(f"Processed {len(processed_data)} total records")
-    return processed_data
\ No newline at end of file
+    return processed_data
+
+
+async def iter_track_batches(imei_list: List[str], token: str, endpoint: str,
+                             token_manager: Optional[TokenManager] = None,
+                             limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                             retry_policy: Optional[RetryPolicy] = None,
+                             retry_budget: Optional[RetryBudget] = None,
+                             session: Optional[aiohttp.ClientSession] = None,
+                             max_pending: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Yield raw batch results (responses or failed-batch dicts) as they complete.
+
+    Same retry/bisection and adaptive concurrency as get_track_info_concurrent,
+    but only ``max_pending`` chunks are scheduled at a time, so memory stays
+    bounded by the window rather than by the fleet size. Results arrive in
+    completion order, not chunk order.
+    """
+    if not imei_list:
+        logger.warning("Empty IMEI list provided")
+        return
+    if limiter is None:
+        limiter = AdaptiveConcurrencyLimiter()
+    if session is None:
+        async with create_track_session(limiter.max_limit) as own_session:
+            async for result in iter_track_batches(imei_list, token, endpoint, token_manager, limiter,
+                                                   retry_policy, retry_budget, own_session, max_pending):
+                yield result
+        return
+
+    imei_chunks = chunk_list(imei_list, 100)
+    logger.info(f"Streaming {len(imei_list)} IMEIs in {len(imei_chunks)} batches")
+    if token_manager is None:
+        token_manager = get_token_manager()
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    if retry_budget is None:
+        retry_budget = RetryBudget(max_retries=max(50, len(imei_chunks)))
+    if max_pending is None:
+        max_pending = limiter.max_limit * 2
+
+    chunks = iter(imei_chunks)
+    pending = {}
+
+    def schedule():
+        while len(pending) < max_pending:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            task = asyncio.ensure_future(fetch_batch_resilient(
+                session, chunk, token, endpoint, token_manager, limiter, retry_policy, retry_budget
+            ))
+            pending[task] = chunk
+
+    schedule()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                chunk = pending.pop(task)
+                try:
+                    batch_results = task.result()
+                except Exception as e:
+                    logger.error(f"Batch {chunk[:3]}... failed with exception: {e}")
+                    batch_results = [batch_error(chunk, e, error_type="exception")]
+                for result in batch_results:
+                    yield result
+            schedule()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    logger.info(f"Streaming fetch finished, retries used {retry_budget.spent}/{retry_budget.max_retries}, "
+                f"concurrency settled at {limiter.limit}")
+
+
+async def stream_tracking_records(imei_list: List[str], token: str, endpoint: str,
+                                  original_imeis: Optional[List[str]] = None,
+                                  **fetch_options) -> AsyncIterator[Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """Yield ``(raw_batch, records)`` as each batch completes, processed like process_tracking_data.
+
+    After the last batch, records for IMEIs of ``original_imeis`` (defaults
+    to ``imei_list``) that nothing returned are yielded with ``raw_batch=None``.
+    Consumers can write or load each chunk of records immediately.
+    """
+    returned_imeis = set()
+    total = 0
+    async for batch in iter_track_batches(imei_list, token, endpoint, **fetch_options):
+        records = process_batch(batch, returned_imeis)
+        total += len(records)
+        yield batch, records
+
+    missing = missing_imei_records(original_imeis if original_imeis is not None else imei_list, returned_imeis)
+    total += len(missing)
+    if missing:
+        yield None, missing
+    logger.info(f"Processed {total} total records")
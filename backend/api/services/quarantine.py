@@ -0,0 +1,98 @@
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List, Set
+
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import QuarantinedIMEI
+
+logger = logging.getLogger(__name__)
+
+# First hold is one hour, doubling for every repeated failure up to a week
+BASE_HOLD = timedelta(hours=1)
+MAX_HOLD = timedelta(days=7)
+
+# Failures that say nothing about the IMEI itself
+TRANSIENT_ERROR_TYPES = {"timeout"}
+
+
+def get_quarantined_imeis() -> Set[str]:
+    """IMEIs whose quarantine hold has not expired yet"""
+    return set(
+        QuarantinedIMEI.objects.filter(quarantined_until__gt=timezone.now()).values_list('imei', flat=True)
+    )
+
+
+def quarantined_batch(imeis: Iterable[str]) -> Dict[str, Any]:
+    """Placeholder batch so skipped IMEIs still show up in the processed output"""
+    return {
+        "error": "quarantined",
+        "error_type": "quarantined",
+        "http_status": None,
+        "imei_batch": sorted(imeis),
+        "status": "failed",
+    }
+
+
+def _is_quarantinable(batch: Dict[str, Any]) -> bool:
+    if not batch.get("isolated") or batch.get("error_type") in TRANSIENT_ERROR_TYPES:
+        return False
+    http_status = batch.get("http_status")
+    return http_status != 429
+
+
+def collect_quarantine_changes(raw_data: Iterable[Dict[str, Any]], failing: Dict[str, str], returned: Set[str]):
+    """Accumulate isolated failing IMEIs and answering IMEIs from raw batches.
+
+    Lets streaming consumers feed batches one at a time before calling
+    ``apply_quarantine_changes`` once at the end of the run.
+    """
+    for batch in raw_data:
+        if not isinstance(batch, dict):
+            continue
+        if 'record' in batch:
+            records = batch['record'] if isinstance(batch['record'], list) else [batch['record']]
+            returned.update(str(r.get('imei')) for r in records if isinstance(r, dict) and r.get('imei'))
+        elif _is_quarantinable(batch):
+            for imei in batch["imei_batch"]:
+                failing[str(imei)] = str(batch.get("error", ""))[:255]
+
+
+def update_quarantine(raw_data: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Quarantine isolated failing IMEIs and release quarantined IMEIs that answered again"""
+    failing = {}
+    returned = set()
+    collect_quarantine_changes(raw_data, failing, returned)
+    return apply_quarantine_changes(failing, returned)
+
+
+def apply_quarantine_changes(failing: Dict[str, str], returned: Set[str]) -> Dict[str, int]:
+    """Persist the changes gathered by ``collect_quarantine_changes``"""
+    now = timezone.now()
+    with transaction.atomic():
+        # The quarantine table is tiny compared to the fleet, so intersect in memory
+        recovered = set(QuarantinedIMEI.objects.values_list('imei', flat=True)) & returned
+        released = 0
+        if recovered:
+            released = QuarantinedIMEI.objects.filter(imei__in=list(recovered)).delete()[0]
+
+        existing = {q.imei: q for q in QuarantinedIMEI.objects.filter(imei__in=list(failing))}
+        for imei, reason in failing.items():
+            entry = existing.get(imei)
+            failure_count = entry.failure_count + 1 if entry else 1
+            hold = min(BASE_HOLD * (2 ** (failure_count - 1)), MAX_HOLD)
+            QuarantinedIMEI.objects.update_or_create(
+                imei=imei,
+                defaults={
+                    'reason': reason,
+                    'failure_count': failure_count,
+                    'quarantined_until': now + hold,
+                }
+            )
+
+    if failing:
+        logger.warning(f"Quarantined {len(failing)} IMEIs: {sorted(failing)[:10]}")
+    if released:
+        logger.info(f"Released {released} IMEIs from quarantine")
+    return {'quarantined': len(failing), 'released': released}
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from django.db import close_old_connections
+
+from .archive_writer import BackgroundRunWriter
+from .concurrency import AdaptiveConcurrencyLimiter
+from .device_loader import bulk_load_device_data, load_device_state, new_changes, notify_devices_changed
+from .protrack_service import TRACK_ENDPOINT, create_track_session, process_batch, stream_tracking_records
+from .quarantine import apply_quarantine_changes, collect_quarantine_changes, get_quarantined_imeis, quarantined_batch
+from .token_manager import get_token_manager
+
+logger = logging.getLogger(__name__)
+
+# Records buffered from the stream before each DB load
+DEFAULT_LOAD_CHUNK_SIZE = 1000
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """Run blocking ORM/file work off the event loop with a clean DB connection"""
+    def call():
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return await asyncio.to_thread(call)
+
+
+async def refresh_tracking_data_async(imeis: List[str], endpoint: str = TRACK_ENDPOINT,
+                                      session=None, token_manager=None,
+                                      limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                                      archive_folder: Optional[str] = None,
+                                      load_chunk_size: int = DEFAULT_LOAD_CHUNK_SIZE,
+                                      progress: Optional[Callable[[int, int, int], None]] = None) -> Dict[str, Any]:
+    """Fetch tracking data for ``imeis`` and load it straight into DeviceData.
+
+    Processed records are bulk-loaded chunk by chunk while the remaining
+    batches are still being fetched; nothing is serialized in between. The
+    current DeviceData state is indexed once per call so only devices whose
+    hearttime, datastatus or position changed are written. When
+    ``archive_folder`` is given, the run archive (snapshot/JSON/CSV) is also
+    written there on a background thread; an archive failure is logged and
+    reported as ``archive_error`` without undoing the load. ``progress(records_loaded, total,
+    batches_done)`` is called after every loaded chunk.
+    """
+    if session is None:
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter()
+        async with create_track_session(limiter.max_limit) as session:
+            return await refresh_tracking_data_async(
+                imeis, endpoint, session, token_manager, limiter, archive_folder, load_chunk_size, progress
+            )
+
+    token_manager = token_manager or get_token_manager()
+    limiter = limiter or AdaptiveConcurrencyLimiter()
+    started = time.monotonic()
+    token = await token_manager.get_token_async(session)
+
+    quarantined = await run_in_thread(get_quarantined_imeis)
+    active_imeis = [imei for imei in imeis if imei not in quarantined]
+    skipped = [imei for imei in imeis if imei in quarantined]
+
+    failing, returned = {}, set()
+    totals = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': 0, 'appended': 0}
+    state = await run_in_thread(load_device_state)
+    # Receivers (stats, live dashboards) hear about the cycle once, not per chunk
+    changes = new_changes()
+    pending = []
+    processed = 0
+    batches_done = 0
+    archive = BackgroundRunWriter(archive_folder) if archive_folder else None
+    archive_error = None
+
+    async def flush():
+        nonlocal processed
+        counts = await run_in_thread(bulk_load_device_data, pending[:], state=state, changes=changes)
+        for key in totals:
+            totals[key] += counts[key]
+        processed += len(pending)
+        pending.clear()
+        if progress:
+            # Off the event loop: the callback may write to the DB
+            await run_in_thread(progress, processed, len(imeis), batches_done)
+
+    try:
+        async for batch, records in stream_tracking_records(
+            active_imeis, token, endpoint,
+            token_manager=token_manager, limiter=limiter, session=session,
+        ):
+            if batch is not None:
+                batches_done += 1
+                collect_quarantine_changes([batch], failing, returned)
+            pending.extend(records)
+            if archive is not None:
+                archive.write(records)
+            if len(pending) >= load_chunk_size:
+                await flush()
+
+        if skipped:
+            records = process_batch(quarantined_batch(skipped), set())
+            pending.extend(records)
+            if archive is not None:
+                archive.write(records)
+        if pending:
+            await flush()
+    finally:
+        if archive is not None:
+            try:
+                await asyncio.to_thread(archive.close)
+            except Exception as e:
+                # The archive is a side output; the loaded devices still count
+                logger.error(f"Archive {archive_folder} failed: {e}")
+                archive_error = str(e)
+        # Loaded chunks are committed even if the stream failed, so receivers still hear about them
+        await run_in_thread(notify_devices_changed, changes)
+
+    quarantine_stats = await run_in_thread(apply_quarantine_changes, failing, returned)
+    elapsed = time.monotonic() - started
+    logger.info(f"Refresh loaded {processed} records in {elapsed:.1f}s, "
+                f"{totals['created'] + totals['updated']} changed")
+
+    return {
+        'records': processed,
+        'batches': batches_done,
+        'created': totals['created'],
+        'updated': totals['updated'],
+        'changed': totals['created'] + totals['updated'],
+        'unchanged': totals['unchanged'],
+        'errors': totals['errors'],
+        'appended': totals['appended'],
+        'skipped': len(skipped),
+        'quarantined': quarantine_stats['quarantined'],
+        'released': quarantine_stats['released'],
+        'archive_folder': archive_folder,
+        'archive_error': archive_error,
+        'elapsed': round(elapsed, 2),
+        'fetch_stats': limiter.snapshot(),
+    }
+
+
+def run_refresh(imeis: List[str], **options) -> Dict[str, Any]:
+    """Synchronous wrapper around refresh_tracking_data_async"""
+    return asyncio.run(refresh_tracking_data_async(imeis, **options))
@@ -0,0 +1,111 @@
+"""Response cache for the read endpoints, keyed by the DeviceData snapshot version.
+
+FleetStats.version is bumped whenever a load changes DeviceData (see
+fleet_stats.refresh_fleet_stats). Payloads are cached under keys that
+include the version, so they never need explicit invalidation: a new
+version uses new keys and stale entries age out of the LRU/TTL-bounded
+'responses' cache. Payloads with TimeSinceUpdate/TimeAgo are cached without
+the labels, and views fill them in on read against the current minute.
+"""
+import hashlib
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+from typing import Any, Callable, Tuple
+
+from django.core.cache import caches
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from api.models import FleetStats
+from api.services.time_labels import now_timestamp
+
+RESPONSE_CACHE_ALIAS = 'responses'
+SNAPSHOT_KEY = 'snapshot'
+
+# How long a worker trusts its copy of the version before re-reading it; bounds
+# how stale responses can be after a load that ran in another process
+SNAPSHOT_CHECK_SECONDS = 2
+
+
+def _cache():
+    return caches[RESPONSE_CACHE_ALIAS]
+
+
+def set_snapshot(version: int, updated_at: datetime):
+    _cache().set(SNAPSHOT_KEY, (version, updated_at), SNAPSHOT_CHECK_SECONDS)
+
+
+def get_snapshot() -> Tuple[int, datetime]:
+    """(version, updated_at) of the current DeviceData snapshot"""
+    snapshot = _cache().get(SNAPSHOT_KEY)
+    if snapshot is None:
+        from api.services.fleet_stats import FLEET_STATS_ID, refresh_fleet_stats
+
+        snapshot = FleetStats.objects.filter(pk=FLEET_STATS_ID).values_list('version', 'updated_at').first()
+        if snapshot is None:
+            # refresh_fleet_stats publishes the snapshot itself
+            summary = refresh_fleet_stats()
+            return summary.version, summary.updated_at
+        set_snapshot(*snapshot)
+    return snapshot
+
+
+def label_time() -> int:
+    """Reference time for relative-time labels: the start of the current minute.
+
+    Labels change at most once a minute, which keeps them consistent with
+    the minute-bucketed ETag of the responses that carry them.
+    """
+    return now_timestamp() // 60 * 60
+
+
+def cached_payload(name: str, params: Any, build: Callable[[], Any]) -> Any:
+    """``build()`` once per snapshot version and ``params``, then served from memory"""
+    version, _ = get_snapshot()
+    # Hashed so any params make a valid key for every cache backend
+    key = f'{name}:{version}:{hashlib.md5(repr(params).encode()).hexdigest()}'
+    cache = _cache()
+    payload = cache.get(key)
+    if payload is None:
+        payload = build()
+        cache.set(key, payload)
+    return payload
+
+
+def _snapshot_etag(request, *args, **kwargs) -> str:
+    return f'v{get_snapshot()[0]}'
+
+
+def _snapshot_last_modified(request, *args, **kwargs) -> datetime:
+    return get_snapshot()[1]
+
+
+def _labeled_etag(request, *args, **kwargs) -> str:
+    return f'v{get_snapshot()[0]}-m{label_time() // 60}'
+
+
+def _labeled_last_modified(request, *args, **kwargs) -> datetime:
+    return max(get_snapshot()[1], datetime.fromtimestamp(label_time(), tz=dt_timezone.utc))
+
+
+def snapshot_conditional(time_labels: bool = False):
+    """Conditional GET for a view whose output only depends on the snapshot.
+
+    Sets ETag/Last-Modified and answers If-None-Match/If-Modified-Since with
+    304 while the snapshot (and, with ``time_labels``, the minute used for
+    relative-time labels) is unchanged. Responses are marked ``no-cache`` so
+    browsers revalidate every poll instead of reusing a stale copy.
+    """
+    etag_func = _labeled_etag if time_labels else _snapshot_etag
+    last_modified_func = _labeled_last_modified if time_labels else _snapshot_last_modified
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,38 @@
+import random
+import threading
+
+
+class RetryPolicy:
+    """Jittered exponential backoff ("full jitter": sleep uniform(0, base * 2**attempt))"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class RetryBudget:
+    """Cap on extra requests (retries and bisection halves) spent in one run.
+
+    Keeps a widespread upstream outage from turning into a retry storm: once
+    the budget is gone, failures are reported as they are.
+    """
+
+    def __init__(self, max_retries: int = 100):
+        self.max_retries = max_retries
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> int:
+        return max(self.max_retries - self.spent, 0)
+
+    def try_spend(self, amount: int = 1) -> bool:
+        with self._lock:
+            if self.spent + amount > self.max_retries:
+                return False
+            self.spent += amount
+            return True
@@ -0,0 +1,385 @@
+"""Compact columnar archive for tracking runs (``all_records.snap``).
+
+Layout::
+
+    b"PTSNAP01" | uint32 header length | JSON header | padding | column blocks
+
+Every column block starts on a 64-byte boundary. The header lists each
+column's dtype, offset and (compressed) size. Typed columns:
+
+- imei: int64, or dictionary-encoded when any IMEI is not a plain number
+- lat_e6 / lon_e6: int32 microdegrees
+- hearttime: int64 unix seconds
+- datastatus: uint8
+- datastatus_description / status: dictionary-encoded (codes + vocabulary
+  in the header)
+
+Blocks are zstd- (when ``zstandard`` is installed) or gzip-compressed, or
+stored raw so readers can ``np.memmap`` them. Derived fields (coordinates,
+GMT+7 date/time, elapsed strings) are not stored. They are recomputed on
+read against the run's ``generated_at``. Values are normalized, so numeric
+strings come back as numbers.
+"""
+import gzip
+import json
+import os
+import struct
+from datetime import datetime, time, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from api.services.spatial import coordinates_text, grid_cells
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+MAGIC = b"PTSNAP01"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+SNAPSHOT_FILENAME = "all_records.snap"
+
+COMPRESSION_NONE = "none"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+
+# Sentinels for missing / non-numeric values
+MISSING_COORDINATE = np.iinfo(np.int32).min
+MISSING_HEARTTIME = -1
+STATUS_NONE = 255   # datastatus None
+STATUS_OTHER = 254  # datastatus '' or anything non-numeric
+
+
+def default_compression() -> str:
+    return COMPRESSION_ZSTD if zstandard is not None else COMPRESSION_GZIP
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    if compression == COMPRESSION_GZIP:
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    return data
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed snapshots")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    return data
+
+
+def _to_number(value) -> Optional[float]:
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _encode_coordinate(value) -> int:
+    number = _to_number(value)
+    if number is None or number != number or abs(number) >= 2147:
+        return MISSING_COORDINATE
+    return int(round(number * 1_000_000))
+
+
+def _encode_hearttime(value) -> int:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value if value >= 0 else MISSING_HEARTTIME
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return MISSING_HEARTTIME
+    return number if number >= 0 else MISSING_HEARTTIME
+
+
+def _encode_datastatus(value) -> int:
+    if value is None:
+        return STATUS_NONE
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return STATUS_OTHER
+    return number if 0 <= number < STATUS_OTHER else STATUS_OTHER
+
+
+def _is_numeric_imei(imei: str) -> bool:
+    return imei.isdigit() and imei.isascii() and len(imei) <= 18 and (imei == "0" or imei[0] != "0")
+
+
+class SnapshotWriter:
+    """Accumulate processed records and write them as one snapshot file on close"""
+
+    def __init__(self, path: str, compression: Optional[str] = None, generated_at: Optional[datetime] = None):
+        self.path = path
+        self.compression = compression or default_compression()
+        self.generated_at = generated_at or datetime.now(timezone.utc)
+        self.count = 0
+        self._imeis: List[str] = []
+        self._lat: List[int] = []
+        self._lon: List[int] = []
+        self._hearttime: List[int] = []
+        self._datastatus: List[int] = []
+        self._descriptions: List[str] = []
+        self._statuses: List[str] = []
+        self._closed = False
+
+    def write(self, records: Iterable[Dict[str, Any]]):
+        for row in records:
+            self._imeis.append(str(row.get("imei", "")))
+            self._lat.append(_encode_coordinate(row.get("latitude")))
+            self._lon.append(_encode_coordinate(row.get("longitude")))
+            self._hearttime.append(_encode_hearttime(row.get("hearttime_unix")))
+            self._datastatus.append(_encode_datastatus(row.get("datastatus")))
+            self._descriptions.append(str(row.get("datastatus_description", "")))
+            self._statuses.append(str(row.get("status", "")))
+            self.count += 1
+
+    @staticmethod
+    def _dictionary(values: List[str]) -> Tuple[np.ndarray, List[str]]:
+        vocab = {}
+        codes = [vocab.setdefault(value, len(vocab)) for value in values]
+        dtype = np.uint8 if len(vocab) <= 256 else np.uint32
+        return np.array(codes, dtype=dtype), list(vocab)
+
+    def _columns(self) -> Dict[str, Tuple[np.ndarray, Optional[List[str]]]]:
+        if all(_is_numeric_imei(imei) for imei in self._imeis):
+            imei_column = (np.array([int(imei) for imei in self._imeis], dtype="<i8"), None)
+        else:
+            imei_column = self._dictionary(self._imeis)
+        description_codes, description_vocab = self._dictionary(self._descriptions)
+        status_codes, status_vocab = self._dictionary(self._statuses)
+        return {
+            "imei": imei_column,
+            "lat_e6": (np.array(self._lat, dtype="<i4"), None),
+            "lon_e6": (np.array(self._lon, dtype="<i4"), None),
+            "hearttime": (np.array(self._hearttime, dtype="<i8"), None),
+            "datastatus": (np.array(self._datastatus, dtype=np.uint8), None),
+            "datastatus_description": (description_codes, description_vocab),
+            "status": (status_codes, status_vocab),
+        }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        blocks = []
+        header = {
+            "version": FORMAT_VERSION,
+            "count": self.count,
+            "generated_at": self.generated_at.isoformat(),
+            "compression": self.compression,
+            "columns": {},
+        }
+        for name, (array, vocab) in self._columns().items():
+            raw = np.ascontiguousarray(array).tobytes()
+            data = _compress(raw, self.compression)
+            column = {"dtype": array.dtype.str, "size": len(data), "raw_size": len(raw)}
+            if vocab is not None:
+                column["vocab"] = vocab
+            header["columns"][name] = column
+            blocks.append((column, data))
+
+        # Offsets depend on the header length, which depends on the offsets' digits:
+        # recompute until the layout stops moving (at most a couple of rounds)
+        for column, _ in blocks:
+            column["offset"] = 0
+        while True:
+            header_bytes = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            offset = _align(len(MAGIC) + 4 + len(header_bytes))
+            changed = False
+            for column, data in blocks:
+                if column["offset"] != offset:
+                    column["offset"] = offset
+                    changed = True
+                offset = _align(offset + len(data))
+            if not changed:
+                break
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            for column, data in blocks:
+                f.write(b"\0" * (column["offset"] - f.tell()))
+                f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    """Header only (count, generated_at, columns); cheap enough for directory listings"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a tracking snapshot: {path}")
+        (length,) = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(length).decode("utf-8"))
+
+
+def read_columns(path: str, mmap: bool = True) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """Return ``(header, columns)``. Uncompressed snapshots are memory-mapped when ``mmap``."""
+    header = read_header(path)
+    compression = header["compression"]
+    count = header["count"]
+    columns = {}
+    with open(path, "rb") as f:
+        for name, column in header["columns"].items():
+            dtype = np.dtype(column["dtype"])
+            if compression == COMPRESSION_NONE and mmap and count:
+                columns[name] = np.memmap(path, dtype=dtype, mode="r", offset=column["offset"], shape=(count,))
+                continue
+            f.seek(column["offset"])
+            data = _decompress(f.read(column["size"]), compression)
+            columns[name] = np.frombuffer(data, dtype=dtype, count=count)
+    return header, columns
+
+
+def _decode_coordinates(values: np.ndarray) -> List[Any]:
+    missing = values == MISSING_COORDINATE
+    degrees = (values.astype(np.float64) / 1_000_000).tolist()
+    return ["" if miss else (0 if value == 0 else value) for value, miss in zip(degrees, missing.tolist())]
+
+
+def _decode_vocab(codes: np.ndarray, vocab: List[str]) -> List[str]:
+    return np.array(vocab, dtype=object)[codes.astype(np.intp)].tolist() if len(codes) else []
+
+
+def read_records(path: str) -> List[Dict[str, Any]]:
+    """Rebuild processed records (the all_records.json shape) from a snapshot"""
+    from .columnar import process_devices_columnar
+
+    header, columns = read_columns(path)
+    generated_at = datetime.fromisoformat(header["generated_at"])
+    vocabs = {name: column.get("vocab") for name, column in header["columns"].items()}
+
+    imeis = columns["imei"]
+    imeis = _decode_vocab(imeis, vocabs["imei"]) if vocabs["imei"] is not None else [str(v) for v in imeis.tolist()]
+    latitudes = _decode_coordinates(columns["lat_e6"])
+    longitudes = _decode_coordinates(columns["lon_e6"])
+    hearttimes = ["" if value == MISSING_HEARTTIME else value for value in columns["hearttime"].tolist()]
+    datastatus = [
+        None if value == STATUS_NONE else ("" if value == STATUS_OTHER else value)
+        for value in columns["datastatus"].tolist()
+    ]
+    descriptions = _decode_vocab(columns["datastatus_description"], vocabs["datastatus_description"])
+    statuses = _decode_vocab(columns["status"], vocabs["status"])
+
+    devices = [
+        {"imei": imei, "latitude": lat, "longitude": lon, "datastatus": status, "hearttime": hearttime}
+        for imei, lat, lon, status, hearttime in zip(imeis, latitudes, longitudes, datastatus, hearttimes)
+    ]
+    records = process_devices_columnar(devices, generated_at)
+    for record, description, status in zip(records, descriptions, statuses):
+        record["datastatus_description"] = description
+        record["status"] = status
+    return records
+
+
+# DeviceData limits the loader enforces (DecimalField(9, 6), CharField max_length)
+MAX_COORDINATE_E6 = 1000 * 1_000_000
+GMT7_OFFSET_SECONDS = 7 * 3600
+# Beyond 2100 the regular path handles the dates
+MAX_FAST_HEARTTIME = 4102444800
+
+
+def read_device_rows(path: str, max_lengths: Dict[str, int]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """DeviceData column values straight from the typed columns, for the bulk loader.
+
+    Skips rebuilding and re-parsing the display strings. Returns ``(rows,
+    records)``: ``rows`` are ready for ``bulk_load_device_data(...,
+    prepared=True)``; ``records`` are entries with missing or out-of-range
+    values, decoded for the regular per-record path so they are handled
+    (mostly reported as errors) just as they would be from JSON.
+    """
+    header, columns = read_columns(path)
+    count = header["count"]
+    vocabs = {name: column.get("vocab") for name, column in header["columns"].items()}
+
+    imeis = columns["imei"]
+    imeis = _decode_vocab(imeis, vocabs["imei"]) if vocabs["imei"] is not None else [str(v) for v in imeis.tolist()]
+    descriptions = _decode_vocab(columns["datastatus_description"], vocabs["datastatus_description"])
+    statuses = _decode_vocab(columns["status"], vocabs["status"])
+
+    lat = columns["lat_e6"].astype(np.int64)
+    lon = columns["lon_e6"].astype(np.int64)
+    hearttime = columns["hearttime"].astype(np.int64)
+    datastatus = columns["datastatus"]
+
+    fast = (
+        (lat != MISSING_COORDINATE) & (lon != MISSING_COORDINATE)
+        & (np.abs(lat) < MAX_COORDINATE_E6) & (np.abs(lon) < MAX_COORDINATE_E6)
+        & (hearttime != MISSING_HEARTTIME) & (hearttime < MAX_FAST_HEARTTIME) & (datastatus < STATUS_OTHER)
+    )
+    too_long = lambda value, field: len(value) > max_lengths[field]  # noqa: E731
+    imei_ok = np.fromiter((not too_long(v, "imei") for v in imeis), dtype=bool, count=count)
+    description_ok = np.fromiter(
+        (not too_long(v, "datastatus_description") for v in descriptions), dtype=bool, count=count
+    )
+    status_ok = np.fromiter((not too_long(v, "status") for v in statuses), dtype=bool, count=count)
+    fast &= imei_ok & description_ok & status_ok
+
+    # GMT+7 date/time as the processed records showed them (none for a zero hearttime)
+    local = hearttime + GMT7_OFFSET_SECONDS
+    dates = (local // 86400).astype("datetime64[D]").tolist()
+    seconds_of_day = (local % 86400).tolist()
+    last_updates = hearttime.astype("datetime64[s]").astype("datetime64[us]").tolist()
+
+    rows, records = [], []
+    lat_list, lon_list = lat.tolist(), lon.tolist()
+    cells = grid_cells(lat, lon).tolist()
+    hearttime_list, datastatus_list = hearttime.tolist(), datastatus.tolist()
+    for i, ok in enumerate(fast.tolist()):
+        if not ok:
+            records.append({
+                "imei": imeis[i],
+                "latitude": "" if lat_list[i] == MISSING_COORDINATE else lat_list[i] / 1_000_000,
+                "longitude": "" if lon_list[i] == MISSING_COORDINATE else lon_list[i] / 1_000_000,
+                "coordinates": "0,0",
+                "datastatus": None if datastatus_list[i] == STATUS_NONE else (
+                    "" if datastatus_list[i] == STATUS_OTHER else datastatus_list[i]),
+                "datastatus_description": descriptions[i],
+                "hearttime_unix": "" if hearttime_list[i] == MISSING_HEARTTIME else hearttime_list[i],
+                "status": statuses[i],
+            })
+            continue
+        lat_e6, lon_e6, ts = lat_list[i], lon_list[i], hearttime_list[i]
+        seconds = seconds_of_day[i]
+        latitude, longitude = Decimal(lat_e6).scaleb(-6), Decimal(lon_e6).scaleb(-6)
+        rows.append({
+            "imei": imeis[i],
+            "latitude": latitude,
+            "longitude": longitude,
+            "coordinates": coordinates_text(latitude, longitude),
+            "datastatus": datastatus_list[i],
+            "datastatus_description": descriptions[i],
+            "hearttime_date": dates[i] if ts else None,
+            "hearttime_time": time(seconds // 3600, seconds % 3600 // 60, seconds % 60) if ts else None,
+            "hearttime_unix": ts,
+            "status": statuses[i],
+            "last_update_detailed_db": last_updates[i].replace(tzinfo=timezone.utc),
+            "last_update_relative_db": last_updates[i].replace(tzinfo=timezone.utc),
+            "grid_cell": cells[i],
+        })
+    return rows, records
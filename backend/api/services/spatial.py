@@ -0,0 +1,130 @@
+"""Integer grid cells over latitude/longitude for viewport queries.
+
+The globe is cut into GRID_CELL_MICRODEGREES squares numbered row-major
+from the south-west corner. The loader stores each device's cell in
+DeviceData.grid_cell (indexed), so a bounding box resolves to one
+contiguous range of cell numbers per grid row it spans. Those ranges are
+scanned on the index, and the exact DecimalField bounds then drop devices
+from the partially covered edge cells. Cells are computed in integer
+microdegrees, so Decimal and float inputs agree on every boundary.
+"""
+from decimal import Decimal, ROUND_FLOOR
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from django.db.models import Q, QuerySet
+
+from api.models import DeviceData
+from api.services.device_list import DEVICE_LIST_FIELDS, serialize_device_rows
+
+# 0.05 degrees: about 5.5 km north-south, a few streets to a district on a city map
+GRID_CELL_MICRODEGREES = 50000
+GRID_ROWS = 180000000 // GRID_CELL_MICRODEGREES
+GRID_COLUMNS = 360000000 // GRID_CELL_MICRODEGREES
+
+# Devices returned by one bounding-box query at most
+MAX_BBOX_DEVICES = 10000
+
+# Boxes spanning more grid rows skip the cell ranges (they cover most of the fleet anyway)
+MAX_CELL_ROWS = 100
+
+BBOX_PARAMS = ['min_lat', 'min_lon', 'max_lat', 'max_lon']
+
+Bbox = Tuple[Decimal, Decimal, Decimal, Decimal]
+
+
+def _microdegrees(value) -> int:
+    return int((Decimal(str(value)) * 1000000).to_integral_value(ROUND_FLOOR))
+
+
+def _cell_row(latitude) -> int:
+    return min(max((_microdegrees(latitude) + 90000000) // GRID_CELL_MICRODEGREES, 0), GRID_ROWS - 1)
+
+
+def _cell_column(longitude) -> int:
+    return min(max((_microdegrees(longitude) + 180000000) // GRID_CELL_MICRODEGREES, 0), GRID_COLUMNS - 1)
+
+
+def grid_cell(latitude, longitude) -> int:
+    """Grid cell number of a position (out-of-range coordinates are clamped to the edge cells)"""
+    return _cell_row(latitude) * GRID_COLUMNS + _cell_column(longitude)
+
+
+def coordinates_text(latitude: Decimal, longitude: Decimal) -> str:
+    """DeviceData.coordinates for a stored position: plain decimals without trailing zeros, "0,0" without a fix"""
+    if not latitude or not longitude:
+        return '0,0'
+    return f"{format(latitude.normalize(), 'f')},{format(longitude.normalize(), 'f')}"
+
+
+def grid_cells(latitudes_e6: np.ndarray, longitudes_e6: np.ndarray) -> np.ndarray:
+    """grid_cell of many positions given as integer microdegrees"""
+    rows = np.clip((latitudes_e6 + 90000000) // GRID_CELL_MICRODEGREES, 0, GRID_ROWS - 1)
+    columns = np.clip((longitudes_e6 + 180000000) // GRID_CELL_MICRODEGREES, 0, GRID_COLUMNS - 1)
+    return rows * GRID_COLUMNS + columns
+
+
+def covering_cell_ranges(bbox: Bbox) -> Optional[List[Tuple[int, int]]]:
+    """Inclusive (first, last) cell ranges covering ``bbox``, or None when it spans too many rows.
+
+    A box whose min_lon is greater than its max_lon crosses the antimeridian
+    and gets two ranges per row.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    first_row, last_row = _cell_row(min_lat), _cell_row(max_lat)
+    if last_row - first_row + 1 > MAX_CELL_ROWS:
+        return None
+    if min_lon <= max_lon:
+        column_spans = [(_cell_column(min_lon), _cell_column(max_lon))]
+    else:
+        column_spans = [(_cell_column(min_lon), GRID_COLUMNS - 1), (0, _cell_column(max_lon))]
+    return [
+        (row * GRID_COLUMNS + first, row * GRID_COLUMNS + last)
+        for row in range(first_row, last_row + 1)
+        for first, last in column_spans
+    ]
+
+
+def parse_bbox(params: Dict[str, str]) -> Bbox:
+    """(min_lat, min_lon, max_lat, max_lon) from query parameters; raises ValueError"""
+    try:
+        min_lat, min_lon, max_lat, max_lon = (Decimal(params[name]) for name in BBOX_PARAMS)
+    except (KeyError, ArithmeticError):
+        raise ValueError(f'{", ".join(BBOX_PARAMS)} are required numbers')
+    if not all(value.is_finite() for value in (min_lat, min_lon, max_lat, max_lon)):
+        raise ValueError('Bounding box coordinates must be finite')
+    if not -90 <= min_lat <= max_lat <= 90:
+        raise ValueError('Latitudes must satisfy -90 <= min_lat <= max_lat <= 90')
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise ValueError('Longitudes must be between -180 and 180')
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def filter_bbox(queryset: QuerySet, bbox: Bbox) -> QuerySet:
+    """Devices positioned inside ``bbox`` (edges included); 0,0 placeholders are never inside"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    ranges = covering_cell_ranges(bbox)
+    if ranges is not None:
+        cells = Q()
+        for first, last in ranges:
+            cells |= Q(grid_cell__range=(first, last))
+        queryset = queryset.filter(cells)
+
+    queryset = queryset.filter(latitude__gte=min_lat, latitude__lte=max_lat)
+    if min_lon <= max_lon:
+        queryset = queryset.filter(longitude__gte=min_lon, longitude__lte=max_lon)
+    else:
+        queryset = queryset.filter(Q(longitude__gte=min_lon) | Q(longitude__lte=max_lon))
+    return queryset.exclude(latitude=0, longitude=0)
+
+
+def devices_in_bbox(bbox: Bbox, limit: int = MAX_BBOX_DEVICES) -> Tuple[List[Dict[str, Any]], bool]:
+    """Records of the devices inside ``bbox`` and whether ``limit`` cut them off.
+
+    Ordered by cell, so the cell ranges are read in one pass over the
+    grid_cell index and a truncated result is a spatially coherent part of
+    the box rather than a sample from all over it.
+    """
+    queryset = filter_bbox(DeviceData.objects.order_by('grid_cell', 'ranking_id'), bbox)
+    rows = list(queryset.values_list(*DEVICE_LIST_FIELDS)[:limit + 1])
+    return serialize_device_rows(rows[:limit]), len(rows) > limit
@@ -0,0 +1,59 @@
+"""Elapsed-time labels ("XdYhZmin" and "5min ago") shared by processing,
+the device list and exports.
+
+Both labels only depend on the whole minutes since the heartbeat, so callers
+take one reference ``now`` (unix seconds) per request or batch and the rest
+is integer arithmetic.
+"""
+import time
+from typing import Optional, Tuple
+
+MINS_IN_YEAR = 365 * 24 * 60
+MINS_IN_MONTH = 30 * 24 * 60
+MINS_IN_DAY = 24 * 60
+
+# Range datetime can represent; the datetime-based labels were empty outside it
+MIN_TIMESTAMP = -62135596800
+MAX_TIMESTAMP = 253402300799
+
+
+def now_timestamp() -> int:
+    return int(time.time())
+
+
+def format_elapsed(mins: int) -> str:
+    days, rest = divmod(mins, MINS_IN_DAY)
+    return f"{days}d{rest // 60}h{rest % 60}min"
+
+
+def format_relative(mins: int) -> str:
+    if mins >= MINS_IN_YEAR:
+        return f"{mins // MINS_IN_YEAR}y ago"
+    if mins >= MINS_IN_MONTH:
+        return f"{mins // MINS_IN_MONTH}m ago"
+    if mins >= MINS_IN_DAY:
+        return f"{mins // MINS_IN_DAY}d ago"
+    if mins >= 60:
+        return f"{mins // 60}h ago"
+    return f"{mins}min ago"
+
+
+def minutes_since(unix_timestamp, now: int) -> Optional[int]:
+    """Whole minutes from ``unix_timestamp`` to ``now``; None when there is no valid timestamp"""
+    if not unix_timestamp or str(unix_timestamp) in ['', '0', 'None', 'null']:
+        return None
+    try:
+        timestamp = int(unix_timestamp)
+    except (ValueError, TypeError):
+        return None
+    if not MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP:
+        return None
+    return (now - timestamp) // 60
+
+
+def time_labels(unix_timestamp, now: int) -> Tuple[str, str]:
+    """(TimeSinceUpdate, TimeAgo) for a heartbeat; empty strings when there is none"""
+    mins = minutes_since(unix_timestamp, now)
+    if mins is None:
+        return '', ''
+    return format_elapsed(mins), format_relative(mins)
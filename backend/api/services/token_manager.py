@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional
+
+import aiohttp
+import requests
+
+logger = logging.getLogger(__name__)
+
+PROTRACK_BASE_URL = "https://api.protrack365.com"
+PROTRACK_ACCOUNT = os.getenv('PROTRACK_ACCOUNT', 'bajajtrack')
+PROTRACK_PASSWORD = os.getenv('PROTRACK_PASSWORD', 'bajajrecombodia')
+
+# Key used to share the token between gunicorn workers through Django's cache
+SHARED_TOKEN_CACHE_KEY = 'protrack:access_token'
+SHARED_TOKEN_LOCK_KEY = 'protrack:access_token:lock'
+
+
+def build_auth_endpoint(account: str, password: str, unix_time: Optional[int] = None) -> str:
+    """Build the signed /api/authorization URL (signature = md5(md5(password) + time))"""
+    if unix_time is None:
+        unix_time = int(time.time())
+    first_hash = hashlib.md5(password.encode()).hexdigest()
+    signature = hashlib.md5((first_hash + str(unix_time)).encode()).hexdigest()
+    return f"{PROTRACK_BASE_URL}/api/authorization?time={unix_time}&account={account}&signature={signature}"
+
+
+def parse_auth_response(data: Dict[str, Any], default_ttl: int):
+    """Return (token, expires_in) from an authorization response"""
+    if 'record' in data and 'access_token' in data['record']:
+        record = data['record']
+        try:
+            expires_in = int(record.get('expires_in') or default_ttl)
+        except (ValueError, TypeError):
+            expires_in = default_ttl
+        return record['access_token'], expires_in
+    logger.error(f"Invalid response format: {data}")
+    raise ValueError("Invalid response format from authorization API")
+
+
+def is_auth_error(status: Optional[int], data: Any) -> bool:
+    """Whether an API response means the access token was rejected"""
+    if status == 401:
+        return True
+    if isinstance(data, dict) and data.get('code') not in (None, 0, '0'):
+        return 'token' in str(data.get('message', '')).lower()
+    return False
+
+
+class TokenManager:
+    """Cache the ProTrack365 access token and refresh it ahead of expiry.
+
+    The token is kept in process and, when ``shared_cache`` is enabled, in
+    Django's default cache so every gunicorn worker reuses the same token.
+    A cache-level lock stops parallel workers from re-authenticating at once.
+    """
+
+    def __init__(self, account: str = PROTRACK_ACCOUNT, password: str = PROTRACK_PASSWORD,
+                 refresh_margin: int = 300, default_ttl: int = 7200, shared_cache: bool = True):
+        self.account = account
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.shared_cache = shared_cache
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._async_locks = weakref.WeakKeyDictionary()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    # ---- state helpers -------------------------------------------------
+
+    def _is_valid(self, margin: float = 0) -> bool:
+        return bool(self._token) and time.time() < self._expires_at - margin
+
+    def _store(self, token: str, expires_in: int):
+        self._token = token
+        self._expires_at = time.time() + expires_in
+        self._write_shared()
+
+    def _read_shared(self) -> bool:
+        """Adopt a token another worker stored in the shared cache"""
+        if not self.shared_cache:
+            return False
+        try:
+            from django.core.cache import cache
+            entry = cache.get(SHARED_TOKEN_CACHE_KEY)
+        except Exception as e:
+            logger.debug(f"Shared token cache unavailable: {e}")
+            return False
+        if entry and entry.get('expires_at', 0) > time.time():
+            self._token = entry['token']
+            self._expires_at = entry['expires_at']
+            return True
+        return False
+
+    def _write_shared(self):
+        if not self.shared_cache:
+            return
+        try:
+            from django.core.cache import cache
+            ttl = max(int(self._expires_at - time.time()), 1)
+            cache.set(SHARED_TOKEN_CACHE_KEY, {'token': self._token, 'expires_at': self._expires_at}, ttl)
+        except Exception as e:
+            logger.debug(f"Could not share token through cache: {e}")
+
+    def _acquire_shared_lock(self) -> bool:
+        if not self.shared_cache:
+            return True
+        try:
+            from django.core.cache import cache
+            return cache.add(SHARED_TOKEN_LOCK_KEY, os.getpid(), 30)
+        except Exception:
+            return True
+
+    def _release_shared_lock(self):
+        if not self.shared_cache:
+            return
+        try:
+            from django.core.cache import cache
+            cache.delete(SHARED_TOKEN_LOCK_KEY)
+        except Exception:
+            pass
+
+    def _wait_for_shared_token(self, stale_token: Optional[str] = None, timeout: float = 10) -> bool:
+        """Another worker holds the refresh lock; wait for the token it stores"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._read_shared() and self._token != stale_token:
+                return True
+            time.sleep(0.2)
+        return False
+
+    def invalidate(self, token: Optional[str] = None):
+        """Drop the cached token (only if it is still ``token`` when given)"""
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+                if self.shared_cache:
+                    try:
+                        from django.core.cache import cache
+                        cache.delete(SHARED_TOKEN_CACHE_KEY)
+                    except Exception:
+                        pass
+
+    def current_token(self, fallback: Optional[str] = None) -> Optional[str]:
+        """The cached token while it is valid, else ``fallback``; never authenticates"""
+        token = self._token
+        return token if token and self._is_valid() else fallback
+
+    # ---- synchronous API -----------------------------------------------
+
+    def _fetch_token(self):
+        endpoint = build_auth_endpoint(self.account, self.password)
+        try:
+            response = requests.get(endpoint, timeout=30)
+            response.raise_for_status()
+            token, expires_in = parse_auth_response(response.json(), self.default_ttl)
+            logger.info("Successfully obtained access token")
+            return token, expires_in
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error fetching token: {e}")
+            raise
+        except KeyError as e:
+            logger.error(f"Missing key in response: {e}")
+            raise
+
+    def get_token(self, force: bool = False, stale_token: Optional[str] = None) -> str:
+        """Return a valid access token, authenticating only when needed"""
+        with self._lock:
+            if stale_token and self._token != stale_token and self._is_valid():
+                return self._token
+            if not force:
+                if self._is_valid(self.refresh_margin):
+                    return self._token
+                if self._read_shared() and self._is_valid(self.refresh_margin):
+                    return self._token
+
+            acquired = self._acquire_shared_lock()
+            if not acquired and self._wait_for_shared_token(stale_token):
+                return self._token
+            try:
+                token, expires_in = self._fetch_token()
+                self._store(token, expires_in)
+                return token
+            finally:
+                if acquired:
+                    self._release_shared_lock()
+
+    # ---- asynchronous API ----------------------------------------------
+
+    def _async_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        lock = self._async_locks.get(loop)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._async_locks[loop] = lock
+        return lock
+
+    async def _fetch_token_async(self, session: Optional[aiohttp.ClientSession] = None):
+        endpoint = build_auth_endpoint(self.account, self.password)
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        try:
+            async with session.get(endpoint, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+            token, expires_in = parse_auth_response(data, self.default_ttl)
+            logger.info("Successfully refreshed access token")
+            return token, expires_in
+        finally:
+            if own_session:
+                await session.close()
+
+    async def _refresh_async(self, session: Optional[aiohttp.ClientSession] = None) -> str:
+        acquired = await asyncio.to_thread(self._acquire_shared_lock)
+        try:
+            if not acquired and await asyncio.to_thread(self._wait_for_shared_token, self._token):
+                return self._token
+            token, expires_in = await self._fetch_token_async(session)
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            await asyncio.to_thread(self._write_shared)
+            return token
+        finally:
+            if acquired:
+                await asyncio.to_thread(self._release_shared_lock)
+
+    async def get_token_async(self, session: Optional[aiohttp.ClientSession] = None,
+                              force: bool = False, stale_token: Optional[str] = None) -> str:
+        """Async variant of ``get_token``.
+
+        A token that is still valid but inside the refresh margin is returned
+        immediately while a single background task renews it.
+        """
+        async with self._async_lock():
+            if stale_token and self._token != stale_token and self._is_valid():
+                return self._token
+            if not force and not self._is_valid():
+                await asyncio.to_thread(self._read_shared)
+            if force or not self._is_valid():
+                return await self._refresh_async(session)
+
+        if not self._is_valid(self.refresh_margin) and (self._refresh_task is None or self._refresh_task.done()):
+            # Own session: the caller's session may be closed before this finishes
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+        return self._token
+
+    async def _background_refresh(self):
+        try:
+            async with self._async_lock():
+                if not self._is_valid(self.refresh_margin):
+                    await self._refresh_async()
+        except Exception as e:
+            logger.warning(f"Background token refresh failed: {e}")
+
+
+_default_manager: Optional[TokenManager] = None
+_default_manager_lock = threading.Lock()
+
+
+def get_token_manager() -> TokenManager:
+    """Return the process-wide token manager"""
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = TokenManager()
+        return _default_manager
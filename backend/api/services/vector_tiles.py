@@ -0,0 +1,411 @@
+"""Mapbox Vector Tiles (MVT 2.1) of the device layer, kept up to date per load.
+
+The pyramid covers zooms MIN_TILE_ZOOM..MAX_TILE_ZOOM and is stored in
+DeviceTile, one row per tile that ever held a device. Each tile has one
+``devices`` layer with a point per positioned device, with the
+``datastatus`` and ``hearttime_unix`` attributes and the numeric IMEI as
+feature id. Map clients overzoom past MAX_TILE_ZOOM.
+
+After every committed load the devices_changed receiver re-encodes only
+the tiles holding a changed device at its new or previous position. Those
+tiles are stamped with the snapshot version; the others keep theirs, and
+with them their ETag. The low zoom tiles hold most of the fleet, so the
+process keeps the points of every positioned device in memory
+(FleetPoints) and patches them with the changed rows when the snapshot
+moved on by exactly that load; only a first update, or one after another
+process loaded, reads DeviceData. Each zoom then bins just the devices of
+the previous zoom's dirty tiles. A tile that lost its last device is kept as an empty
+tile, so the highest version in the table is always the version the
+pyramid was last brought up to. That version goes into the tile URLs
+handed out by the TileJSON endpoint, which makes those URLs immutable.
+An empty table (new deployment, or cleared DeviceData) is rebuilt in full
+on the next load.
+
+The protobuf encoding is written out by hand; a tile only needs varints,
+zigzag integers and length-delimited fields. All dirty tiles of a zoom
+level are encoded in one pass of NumPy array operations (encode_tiles):
+the low zooms hold the whole fleet and are rewritten after every load.
+"""
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Max
+from django.dispatch import receiver
+
+from api.models import DeviceData, DeviceTile
+from api.services.clusters import mercator_xy
+from api.services.response_cache import get_snapshot
+from api.signals import devices_changed
+
+logger = logging.getLogger(__name__)
+
+MIN_TILE_ZOOM = 0
+MAX_TILE_ZOOM = 14
+# Tile coordinate space: 4096 units per side, as in the MVT spec's examples
+EXTENT_BITS = 12
+TILE_EXTENT = 1 << EXTENT_BITS
+LAYER_NAME = 'devices'
+ATTRIBUTES = ('datastatus', 'hearttime_unix')
+MVT_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+# Tiles per bulk upsert
+TILE_WRITE_BATCH = 500
+# Feature ids are the numeric IMEIs that fit an int64; other devices get none
+NO_FEATURE_ID = -1
+
+# Protobuf wire types and MVT geometry commands
+_VARINT, _LENGTH_DELIMITED = 0, 2
+_POINT = 1
+_MOVE_TO_ONE = (1 << 3) | 1
+# Widest varints: uint64, value indexes (< 2**21), zigzagged tile coordinates (< 2**14)
+_UINT64_BYTES, _INDEX_BYTES, _COORDINATE_BYTES = 10, 3, 2
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _key(field: int, wire_type: int) -> int:
+    return (field << 3) | wire_type
+
+
+def _uint_field(field: int, value: int) -> bytes:
+    return _varint(_key(field, _VARINT)) + _varint(value)
+
+
+def _bytes_field(field: int, payload: bytes) -> bytes:
+    return _varint(_key(field, _LENGTH_DELIMITED)) + _varint(len(payload)) + payload
+
+
+# A tile is encoded as a whole with NumPy: every field of every feature is a
+# block of byte columns plus a mask of the bytes in use (varints are padded
+# to their widest form). Concatenating the blocks and keeping the masked
+# bytes in row order yields the features back to back.
+Columns = Tuple[np.ndarray, np.ndarray]
+
+
+def _varint_columns(values: np.ndarray, width: int) -> Columns:
+    """(bytes, mask) of the varints of non-negative ``values`` below ``2 ** (7 * width)``"""
+    groups = values.astype(np.uint64)[:, None] >> (np.arange(width, dtype=np.uint64) * np.uint64(7))
+    used = np.ones(groups.shape, dtype=bool)
+    used[:, 1:] = groups[:, 1:] > 0
+    continued = np.zeros(groups.shape, dtype=bool)
+    continued[:, :-1] = used[:, 1:]
+    return (groups & np.uint64(0x7f)) | (continued.astype(np.uint64) << np.uint64(7)), used
+
+
+def _byte_column(count: int, value) -> Columns:
+    return (np.broadcast_to(np.asarray(value, dtype=np.uint64), (count,))[:, None],
+            np.ones((count, 1), dtype=bool))
+
+
+def _length_delimited(field: int, blocks: List[Columns]) -> List[Columns]:
+    """Blocks of a length-delimited field holding ``blocks`` (payloads shorter than 128 bytes)"""
+    count = len(blocks[0][0])
+    length = sum(mask.sum(axis=1) for _, mask in blocks)
+    return [_byte_column(count, _key(field, _LENGTH_DELIMITED)), _byte_column(count, length)] + blocks
+
+
+def _join(blocks: List[Columns]) -> Tuple[bytes, np.ndarray]:
+    """The bytes in use of all rows back to back, and the byte count of every row"""
+    data = np.hstack([block for block, _ in blocks])
+    mask = np.hstack([mask for _, mask in blocks])
+    return data[mask].astype(np.uint8).tobytes(), mask.sum(axis=1)
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    return np.where(values >= 0, values * 2, -values * 2 - 1)
+
+
+def encode_tiles(counts: np.ndarray, feature_ids: np.ndarray, x: np.ndarray, y: np.ndarray,
+                 datastatus: np.ndarray, hearttime_unix: np.ndarray) -> List[bytes]:
+    """One-layer tiles of consecutive runs of points: the first ``counts[0]`` entries form the first tile, etc.
+
+    The point arrays are int64, with x/y in tile units. Every tile gets its
+    own value table, shared by both attributes; each tile is then a slice
+    of the encoded features and values of all of them.
+    """
+    tile_count, count = len(counts), len(x)
+    tile_of = np.repeat(np.arange(tile_count), counts)
+
+    # Value indexes per tile: number the distinct (tile, value) pairs in order and restart at every tile
+    pair_tiles = np.concatenate((tile_of, tile_of))
+    pair_values = np.concatenate((datastatus, hearttime_unix)).astype(np.int64)
+    order = np.lexsort((pair_values, pair_tiles))
+    sorted_tiles, sorted_values = pair_tiles[order], pair_values[order]
+    distinct = np.ones(len(order), dtype=bool)
+    distinct[1:] = (sorted_tiles[1:] != sorted_tiles[:-1]) | (sorted_values[1:] != sorted_values[:-1])
+    pair_ids = np.cumsum(distinct) - 1
+    values_per_tile = np.bincount(sorted_tiles[distinct], minlength=tile_count)
+    first_value = np.concatenate(([0], np.cumsum(values_per_tile)))
+    indexes = np.empty(len(order), dtype=np.int64)
+    indexes[order] = pair_ids - first_value[sorted_tiles]
+
+    with_id = feature_ids != NO_FEATURE_ID
+    id_key, id_key_mask = _byte_column(count, _key(1, _VARINT))
+    id_bytes, id_mask = _varint_columns(np.where(with_id, feature_ids, 0), _UINT64_BYTES)
+    features, feature_sizes = _join(_length_delimited(2, [
+        (id_key, id_key_mask & with_id[:, None]),
+        (id_bytes, id_mask & with_id[:, None]),
+        *_length_delimited(2, [
+            _byte_column(count, 0), _varint_columns(indexes[:count], _INDEX_BYTES),
+            _byte_column(count, 1), _varint_columns(indexes[count:], _INDEX_BYTES),
+        ]),
+        _byte_column(count, _key(3, _VARINT)), _byte_column(count, _POINT),
+        *_length_delimited(4, [
+            _byte_column(count, _MOVE_TO_ONE),
+            _varint_columns(_zigzag(x.astype(np.int64)), _COORDINATE_BYTES),
+            _varint_columns(_zigzag(y.astype(np.int64)), _COORDINATE_BYTES),
+        ]),
+    ]))
+
+    # Value messages: uint_value, or sint_value for negative integers
+    values = sorted_values[distinct]
+    negative = values < 0
+    value_messages, value_sizes = _join(_length_delimited(4, [
+        _byte_column(len(values), np.where(negative, _key(6, _VARINT), _key(5, _VARINT))),
+        _varint_columns(np.where(negative, _zigzag(values), values), _UINT64_BYTES),
+    ]))
+
+    feature_offsets = np.concatenate(([0], np.cumsum(feature_sizes)))[np.concatenate(([0], np.cumsum(counts)))].tolist()
+    value_offsets = np.concatenate(([0], np.cumsum(value_sizes)))[first_value].tolist()
+    header = _uint_field(15, 2) + _bytes_field(1, LAYER_NAME.encode())
+    keys = b''.join(_bytes_field(3, name.encode()) for name in ATTRIBUTES)
+    extent = _uint_field(5, TILE_EXTENT)
+    tiles = []
+    for tile in range(tile_count):
+        layer = b''.join((
+            header,
+            features[feature_offsets[tile]:feature_offsets[tile + 1]],
+            keys,
+            value_messages[value_offsets[tile]:value_offsets[tile + 1]],
+            extent,
+        ))
+        tiles.append(_bytes_field(3, layer))
+    return tiles
+
+
+def world_pixels(latitudes: np.ndarray, longitudes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Integer positions in tile units at MAX_TILE_ZOOM; shift right by (MAX_TILE_ZOOM - z) for zoom z"""
+    x, y = mercator_xy(latitudes, longitudes)
+    size = TILE_EXTENT << MAX_TILE_ZOOM
+    return (np.minimum((x * size).astype(np.int64), size - 1),
+            np.minimum((y * size).astype(np.int64), size - 1))
+
+
+def _has_position(latitude, longitude, coordinates: Optional[str] = None) -> bool:
+    if latitude is None or longitude is None or coordinates == '0,0':
+        return False
+    latitude, longitude = float(latitude), float(longitude)
+    return not (latitude == 0 and longitude == 0) and -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+def _feature_id(imei: str) -> int:
+    return int(imei) if imei.isdigit() and int(imei) < 2 ** 63 else NO_FEATURE_ID
+
+
+def _point_columns(devices: List[Tuple[Any, ...]]) -> List[np.ndarray]:
+    """world x, world y, feature id, datastatus and hearttime_unix of (imei, lat, lon, datastatus, hearttime_unix)"""
+    world_x, world_y = world_pixels(np.array([device[1] for device in devices], dtype=np.float64),
+                                    np.array([device[2] for device in devices], dtype=np.float64))
+    return [
+        world_x,
+        world_y,
+        np.array([_feature_id(device[0]) for device in devices], dtype=np.int64),
+        np.array([device[3] for device in devices], dtype=np.int64),
+        np.array([device[4] for device in devices], dtype=np.int64),
+    ]
+
+
+class FleetPoints:
+    """Tile inputs of every positioned device at one snapshot version"""
+
+    def __init__(self, version: int, devices: List[Tuple[Any, ...]]):
+        self.version = version
+        self.index = {device[0]: i for i, device in enumerate(devices)}
+        self.columns = _point_columns(devices)
+        # Devices that lost their position keep their slot
+        self.positioned = np.ones(len(devices), dtype=bool)
+
+    @classmethod
+    def load(cls, version: int) -> 'FleetPoints':
+        return cls(version, list(
+            DeviceData.objects
+            .exclude(latitude=0, longitude=0)
+            .exclude(coordinates='0,0')
+            .filter(latitude__gte=-90, latitude__lte=90, longitude__gte=-180, longitude__lte=180)
+            .values_list('imei', 'latitude', 'longitude', 'datastatus', 'hearttime_unix')
+            .iterator(chunk_size=5000)
+        ))
+
+    def apply(self, version: int, rows: List[Dict[str, Any]]):
+        """Move on to ``version`` by applying its changed rows (devices_changed ``rows``)"""
+        slots, updated, added = [], [], {}
+        for row in rows:
+            imei = row['imei']
+            positioned = _has_position(row['latitude'], row['longitude'], row.get('coordinates'))
+            device = (imei, row['latitude'], row['longitude'], row['datastatus'], row['hearttime_unix'])
+            slot = self.index.get(imei)
+            if slot is None:
+                added.pop(imei, None)
+                if positioned:
+                    added[imei] = device
+                continue
+            self.positioned[slot] = positioned
+            if positioned:
+                slots.append(slot)
+                updated.append(device)
+        if updated:
+            for column, values in zip(self.columns, _point_columns(updated)):
+                column[slots] = values
+        if added:
+            self.index.update((imei, len(self.positioned) + i) for i, imei in enumerate(added))
+            self.columns = [np.concatenate((column, values))
+                            for column, values in zip(self.columns, _point_columns(list(added.values())))]
+            self.positioned = np.concatenate((self.positioned, np.ones(len(added), dtype=bool)))
+        self.version = version
+
+
+# Points of the version this process last brought the pyramid to; the lock also serializes updates
+_points: Optional[FleetPoints] = None
+_points_lock = threading.Lock()
+
+
+def _fleet_points(version: int, rows: Optional[List[Dict[str, Any]]]) -> FleetPoints:
+    """Points at ``version``: the kept ones patched with ``rows`` when they are one load behind, else read afresh"""
+    global _points
+    points = _points
+    if rows is not None and points is not None and points.version == version - 1:
+        points.apply(version, rows)
+    else:
+        points = FleetPoints.load(version)
+    _points = points
+    return points
+
+
+def _changed_positions(rows: List[Dict[str, Any]], previous: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """Current and previous positions of the changed devices, as world pixels"""
+    positions = [(row['latitude'], row['longitude']) for row in rows
+                 if _has_position(row['latitude'], row['longitude'], row.get('coordinates'))]
+    positions.extend((before[2], before[3]) for before in previous.values()
+                     if before is not None and _has_position(before[2], before[3]))
+    latitudes = np.array([latitude for latitude, _ in positions], dtype=np.float64)
+    longitudes = np.array([longitude for _, longitude in positions], dtype=np.float64)
+    return world_pixels(latitudes, longitudes)
+
+
+def update_device_tiles(rows: Optional[List[Dict[str, Any]]] = None,
+                        previous: Optional[Dict[str, Any]] = None) -> Dict[str, int]:
+    """Re-encode the tiles holding ``rows`` now or ``previous``ly; every tile when ``rows`` is None.
+
+    ``rows``/``previous`` are the devices_changed arguments. The whole
+    pyramid is also rebuilt when the table is empty. Returns the number of
+    tiles written and how many of them are empty.
+    """
+    with _points_lock:
+        return _update_device_tiles(rows, previous)
+
+
+def _update_device_tiles(rows, previous) -> Dict[str, int]:
+    version, _ = get_snapshot()
+    full = rows is None or not DeviceTile.objects.exists()
+    points = _fleet_points(version, None if full else rows)
+    world_x, world_y, feature_ids, datastatus, hearttime_unix = points.columns
+    if not full:
+        changed_x, changed_y = _changed_positions(rows, previous or {})
+
+    tiles, empty = [], 0
+    candidates = np.flatnonzero(points.positioned)
+    for zoom in range(MIN_TILE_ZOOM, MAX_TILE_ZOOM + 1):
+        shift = MAX_TILE_ZOOM - zoom
+        keys = ((world_y[candidates] >> (shift + EXTENT_BITS)) << zoom) + (world_x[candidates] >> (shift + EXTENT_BITS))
+        if full:
+            dirty = np.unique(keys)
+        else:
+            dirty = np.unique(((changed_y >> (shift + EXTENT_BITS)) << zoom) + (changed_x >> (shift + EXTENT_BITS)))
+        in_dirty = np.flatnonzero(np.isin(keys, dirty))
+        in_dirty = in_dirty[np.argsort(keys[in_dirty], kind='stable')]
+        members, member_keys = candidates[in_dirty], keys[in_dirty]
+        # Devices per dirty tile; dirty tiles without devices are written empty (see the module docstring)
+        occupied, counts = np.unique(member_keys, return_counts=True)
+        tile_counts = np.zeros(len(dirty), dtype=np.int64)
+        tile_counts[np.searchsorted(dirty, occupied)] = counts
+
+        encoded = encode_tiles(
+            tile_counts,
+            feature_ids[members],
+            (world_x[members] >> shift) & (TILE_EXTENT - 1),
+            (world_y[members] >> shift) & (TILE_EXTENT - 1),
+            datastatus[members],
+            hearttime_unix[members],
+        )
+        for key, features, data in zip(dirty.tolist(), tile_counts.tolist(), encoded):
+            tiles.append(DeviceTile(zoom=zoom, x=key & ((1 << zoom) - 1), y=key >> zoom,
+                                    data=data, features=features, version=version))
+            empty += not features
+        if not full:
+            # The next zoom's dirty tiles lie inside these ones
+            candidates = np.sort(members)
+
+    with transaction.atomic():
+        if full:
+            DeviceTile.objects.all().delete()
+        DeviceTile.objects.bulk_create(
+            tiles,
+            batch_size=TILE_WRITE_BATCH,
+            update_conflicts=True,
+            unique_fields=['zoom', 'x', 'y'],
+            update_fields=['data', 'features', 'version'],
+        )
+    return {'tiles': len(tiles), 'empty': empty, 'full': full}
+
+
+def clear_device_tiles():
+    """Drop the pyramid (after DeviceData was cleared); the next load rebuilds it"""
+    global _points
+    _points = None
+    DeviceTile.objects.all().delete()
+
+
+def get_tile_version() -> int:
+    """Snapshot version the pyramid was last brought up to (0 before the first build)"""
+    return DeviceTile.objects.aggregate(version=Max('version'))['version'] or 0
+
+
+def get_tile(zoom: int, x: int, y: int) -> Optional[Tuple[bytes, int]]:
+    """(data, version) of a tile, or None for a tile that never held a device"""
+    tile = DeviceTile.objects.filter(zoom=zoom, x=x, y=y).values_list('data', 'version').first()
+    if tile is None:
+        return None
+    return bytes(tile[0]), tile[1]
+
+
+def parse_tile_address(zoom: int, x: int, y: int):
+    """Raise ValueError unless zoom/x/y address a tile of the pyramid"""
+    if not MIN_TILE_ZOOM <= zoom <= MAX_TILE_ZOOM:
+        raise ValueError(f'zoom must be between {MIN_TILE_ZOOM} and {MAX_TILE_ZOOM}')
+    if not (0 <= x < 1 << zoom and 0 <= y < 1 << zoom):
+        raise ValueError(f'x and y must be between 0 and {(1 << zoom) - 1} at zoom {zoom}')
+
+
+# Connected after fleet_stats' receiver (see ApiConfig.ready), so tiles get the new snapshot version
+@receiver(devices_changed)
+def update_tiles_on_devices_changed(sender, rows, previous=None, **kwargs):
+    try:
+        counts = update_device_tiles(rows, previous or {})
+        logger.info(f"Device tiles: {counts['tiles']} encoded ({counts['empty']} empty)"
+                    f"{' in a full rebuild' if counts['full'] else ''}")
+    except Exception as e:
+        # An incremental pyramid that missed a load stays wrong; drop it so the next load rebuilds it
+        logger.warning(f"Could not update device tiles, clearing them for a full rebuild: {e}")
+        try:
+            clear_device_tiles()
+        except Exception as e:
+            logger.warning(f"Could not clear device tiles: {e}")
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent by the device loader once the changed rows of a load are committed.
+# Receivers get ``rows``: the DeviceData column values (dicts keyed by
+# DEVICE_COLUMNS) of every device that was created or whose hearttime,
+# datastatus or position changed, and ``previous``: imei -> the
+# (hearttime_unix, datastatus, latitude, longitude) stored before the load,
+# None for new devices. Unchanged devices are never included.
+devices_changed = Signal()
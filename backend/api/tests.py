@@ -1,3 +1,1644 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import gzip
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from api.models import DeviceData
+from api.services.device_query import filter_devices
+from api.services.response_cache import RESPONSE_CACHE_ALIAS, label_time
+from api.services.spatial import grid_cell
+
+DAY = 86400
+
+
+def make_device(number, hearttime_unix, datastatus=1, description='Online', latitude=11.55, longitude=104.92):
+    return DeviceData(
+        imei=f'35{number:013d}',
+        latitude=latitude,
+        longitude=longitude,
+        coordinates=f'{latitude},{longitude}',
+        datastatus=datastatus,
+        datastatus_description=description,
+        hearttime_unix=hearttime_unix,
+        status='Active',
+        grid_cell=grid_cell(latitude, longitude),
+    )
+
+
+class DeviceQueryPlanTests(TestCase):
+    """EXPLAIN the queries behind /api/devices/query/: every filter must be answered from an index"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = label_time()
+        devices = []
+        for number in range(500):
+            stale = number % 25 == 0
+            no_position = number % 50 == 1
+            devices.append(make_device(
+                number,
+                cls.now - (30 * DAY if stale else 60),
+                datastatus=number % 4 + 1,
+                latitude=0 if no_position else 11.55,
+                longitude=0 if no_position else 104.92,
+            ))
+        DeviceData.objects.bulk_create(devices)
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # The test table is tiny; make the planner show which index it would use
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def plans(self, filters):
+        """EXPLAIN output of the count, first-page and next-page queries for ``filters``"""
+        queryset = filter_devices(DeviceData.objects.all(), filters, self.now)
+        page = queryset.order_by('hearttime_unix', 'ranking_id')
+        next_page = page.filter(hearttime_unix__gte=self.now - DAY).exclude(
+            hearttime_unix=self.now - DAY, ranking_id__lte=1,
+        )
+        return [queryset.order_by().explain(), page[:51].explain(), next_page[:51].explain()]
+
+    def assertUsesIndex(self, filters, expected):
+        """Every plan for ``filters`` avoids a table scan and mentions one of ``expected``"""
+        for plan in self.plans(filters):
+            self.assertTrue(any(text in plan for text in expected), f'{filters}: index not used:\n{plan}')
+            if connection.vendor == 'sqlite':
+                self.assertNotRegex(plan, r'SCAN api_devicedata\s*($|\n)')
+            else:
+                self.assertNotIn('Seq Scan', plan)
+
+    def test_staleness_uses_heart_index(self):
+        self.assertUsesIndex({'stale_minutes': 7 * 24 * 60}, ['devicedata_heart_idx'])
+        self.assertUsesIndex({'fresh_minutes': 5}, ['devicedata_heart_idx'])
+
+    def test_datastatus_uses_composite_index(self):
+        self.assertUsesIndex({'datastatus': [3]}, ['devicedata_status_heart_idx'])
+        self.assertUsesIndex({'datastatus': [3], 'stale_minutes': 10}, ['devicedata_status_heart_idx'])
+
+    def test_imei_prefix_uses_imei_index(self):
+        # The unique index has a backend-generated name; match its range condition instead
+        self.assertUsesIndex({'imei_prefix': '350000000001'}, ['(imei>? AND imei<?)', '((imei)::text >='])
+
+    def test_missing_coordinates_uses_partial_index(self):
+        self.assertUsesIndex({'has_coordinates': False}, ['devicedata_no_coords_idx'])
+
+
+class DeviceQueryViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        DeviceData.objects.bulk_create(
+            [make_device(number, now - 8 * DAY - number) for number in range(5)]
+            + [make_device(number, now - 60, datastatus=2, description='Static') for number in range(5, 10)]
+            + [make_device(10, now - 9 * DAY, latitude=0, longitude=0)]
+        )
+
+    def setUp(self):
+        caches[RESPONSE_CACHE_ALIAS].clear()
+
+    def query(self, **params):
+        return self.client.get('/api/devices/query/', params, HTTP_HOST='localhost')
+
+    def test_offline_more_than_seven_days(self):
+        body = self.query(stale_minutes=7 * 24 * 60).json()
+        self.assertEqual(body['count'], 6)
+        imeis = [device['imei'] for device in body['data']]
+        # Longest silent first
+        self.assertEqual(imeis[0], make_device(10, 0).imei)
+        self.assertEqual(len(imeis), 6)
+
+    def test_filters_combine(self):
+        body = self.query(stale_minutes=7 * 24 * 60, has_coordinates='true', imei_prefix='3500000000000').json()
+        self.assertEqual(body['count'], 5)
+        body = self.query(datastatus='2', has_coordinates='false').json()
+        self.assertEqual(body['count'], 0)
+        body = self.query(status='Static').json()
+        self.assertEqual(sorted(device['ranking_id'] for device in body['data']),
+                         sorted(DeviceData.objects.filter(datastatus=2).values_list('ranking_id', flat=True)))
+
+    def test_cursor_walks_every_match_once(self):
+        seen, cursor = [], ''
+        while True:
+            body = self.query(per_page=4, cursor=cursor).json()
+            # Only the first page is counted
+            self.assertEqual(body['count'] is None, bool(cursor))
+            seen += [device['ranking_id'] for device in body['data']]
+            cursor = body['pagination']['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), sorted(DeviceData.objects.values_list('ranking_id', flat=True)))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.query(stale_minutes='week').status_code, 400)
+        self.assertEqual(self.query(has_coordinates='maybe').status_code, 400)
+        self.assertEqual(self.query(cursor='12').status_code, 400)
+
+
+class DeviceLookupViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        DeviceData.objects.bulk_create([make_device(number, now - number * 60) for number in range(20)])
+        cls.imeis = [make_device(number, 0).imei for number in (7, 3, 15, 3)]
+
+    def setUp(self):
+        from api.services import fleet_index
+
+        # Snapshot versions restart with every test database; drop indexes of earlier tests
+        caches[RESPONSE_CACHE_ALIAS].clear()
+        fleet_index._index = None
+
+    def lookup(self, body):
+        return self.client.post('/api/devices/lookup/', body, content_type='application/json', HTTP_HOST='localhost')
+
+    def test_index_and_database_agree(self):
+        from api.services import fleet_index
+
+        body = self.lookup({'imeis': self.imeis + ['unknown']}).json()
+        self.assertEqual(body['source'], 'index')
+        self.assertEqual([device['imei'] for device in body['data']], self.imeis[:3])
+        self.assertEqual(body['missing'], ['unknown'])
+
+        with mock.patch.object(fleet_index, 'get_fleet_index', return_value=None):
+            fallback = self.lookup({'imeis': self.imeis + ['unknown']}).json()
+        self.assertEqual(fallback['source'], 'database')
+        self.assertEqual(fallback['data'], body['data'])
+
+    def test_bad_body(self):
+        self.assertEqual(self.lookup({'imeis': '350000000000007'}).status_code, 400)
+        self.assertEqual(self.lookup('not json').status_code, 400)
+
+
+class DeviceProjectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        DeviceData.objects.bulk_create([make_device(number, now - number * 60) for number in range(30)])
+
+    def setUp(self):
+        caches[RESPONSE_CACHE_ALIAS].clear()
+
+    def get(self, params, **headers):
+        return self.client.get('/api/devices/', params, HTTP_HOST='localhost', **headers)
+
+    def test_fields_and_columns_layout(self):
+        full = self.get({'cursor': ''}).json()['data']
+        projected = self.get({'cursor': '', 'fields': 'imei,latitude,TimeAgo'}).json()['data']
+        self.assertEqual(projected, [{key: device[key] for key in ('imei', 'latitude', 'TimeAgo')} for device in full])
+
+        columnar = self.get({'cursor': '', 'layout': 'columns'}).json()
+        self.assertNotIn('data', columnar)
+        self.assertEqual([dict(zip(columnar['columns'], row)) for row in columnar['rows']], full)
+
+        self.assertEqual(self.get({'fields': 'imei,password'}).status_code, 400)
+
+    def test_cursor_walks_every_device_once(self):
+        seen, cursor, pages = [], '', 0
+        while True:
+            # A stray page parameter is ignored in cursor mode
+            pagination = (body := self.get({'cursor': cursor, 'per_page': 7, 'page': 3}).json())['pagination']
+            pages += 1
+            self.assertIsNone(pagination['current_page'])
+            self.assertEqual((pagination['total_records'], pagination['total_pages']), (30, 5))
+            self.assertEqual(pagination['has_previous'], bool(cursor))
+            seen += [device['ranking_id'] for device in body['data']]
+            cursor = pagination['next_cursor']
+            self.assertEqual(pagination['has_next'], cursor is not None)
+            if cursor is None:
+                break
+        self.assertEqual(pages, 5)
+        self.assertEqual(seen, sorted(DeviceData.objects.values_list('ranking_id', flat=True)))
+
+    def test_gzip_negotiation(self):
+        plain = self.get({'cursor': ''})
+        compressed = self.get({'cursor': ''}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        self.assertTrue(compressed['ETag'].startswith('W/'))
+        revalidated = self.get({'cursor': ''}, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=compressed['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+
+class DeviceBboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        devices = []
+        for number in range(400):
+            # A 20 x 20 lattice around Phnom Penh, 0.013 degrees apart (cells are 0.05)
+            latitude = round(11.4 + number // 20 * 0.013, 6)
+            longitude = round(104.8 + number % 20 * 0.013, 6)
+            devices.append(make_device(number, now, latitude=latitude, longitude=longitude))
+        devices.append(make_device(400, now, latitude=0, longitude=0))
+        DeviceData.objects.bulk_create(devices)
+
+    def setUp(self):
+        caches[RESPONSE_CACHE_ALIAS].clear()
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, **params):
+        params.update(min_lat=min_lat, min_lon=min_lon, max_lat=max_lat, max_lon=max_lon)
+        return self.client.get('/api/devices/bbox/', params, HTTP_HOST='localhost')
+
+    def test_matches_exact_filter(self):
+        boxes = [('11.45', '104.85', '11.5', '104.9'), ('11.413', '104.8', '11.426', '104.813'),
+                 ('11.3', '104.7', '11.7', '105.1'), ('0', '0', '1', '1')]
+        for box in boxes:
+            min_lat, min_lon, max_lat, max_lon = (Decimal(value) for value in box)
+            expected = sorted(
+                ranking_id for ranking_id, latitude, longitude in
+                DeviceData.objects.exclude(latitude=0, longitude=0).values_list('ranking_id', 'latitude', 'longitude')
+                if min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon
+            )
+            body = self.bbox(*box, fields='ranking_id').json()
+            self.assertEqual(sorted(device['ranking_id'] for device in body['data']), expected, box)
+
+    def test_limit_and_validation(self):
+        body = self.bbox('11.3', '104.7', '11.7', '105.1', limit=10).json()
+        self.assertEqual((body['count'], body['truncated']), (10, True))
+        self.assertEqual(self.bbox('12', '104', '11', '105').status_code, 400)
+        self.assertEqual(self.client.get('/api/devices/bbox/', {'min_lat': '11'}, HTTP_HOST='localhost').status_code, 400)
+
+    def test_uses_grid_cell_index(self):
+        from api.services.spatial import filter_bbox, parse_bbox
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+        bbox = parse_bbox({'min_lat': '11.45', 'min_lon': '104.85', 'max_lat': '11.5', 'max_lon': '104.9'})
+        plan = filter_bbox(DeviceData.objects.order_by('grid_cell', 'ranking_id'), bbox)[:100].explain()
+        self.assertIn('grid_cell', plan)
+        self.assertNotRegex(plan, r'SCAN api_devicedata\s*($|\n)|Seq Scan')
+
+    def test_loader_fills_grid_cell(self):
+        from api.services.device_loader import build_device_row
+        from django.utils import timezone
+
+        row = build_device_row({'imei': '1', 'latitude': '11.55', 'longitude': '104.92', 'hearttime_unix': 0},
+                               timezone.now())
+        self.assertEqual(row['grid_cell'], grid_cell(Decimal('11.55'), Decimal('104.92')))
+
+    def test_snapshot_load_fills_grid_cell(self):
+        import os
+        import tempfile
+        from api.services.device_loader import bulk_load_device_data, device_max_lengths
+        from api.services.snapshot_archive import SnapshotWriter, read_device_rows
+
+        positions = [('11.55', '104.92'), ('-33.868820', '151.209296'), ('0', '0'), ('89.999999', '-180')]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'all_records.snap')
+            writer = SnapshotWriter(path)
+            writer.write({'imei': f'86{number:013d}', 'latitude': lat, 'longitude': lon, 'datastatus': 1,
+                          'datastatus_description': 'Online', 'hearttime_unix': 1700000000 + number, 'status': 'Active'}
+                         for number, (lat, lon) in enumerate(positions))
+            writer.close()
+            rows, records = read_device_rows(path, device_max_lengths())
+        self.assertEqual(records, [])
+        counts = bulk_load_device_data(rows, prepared=True)
+        self.assertEqual((counts['created'], counts['errors']), (4, 0))
+        stored = dict(DeviceData.objects.filter(imei__startswith='86').values_list('latitude', 'grid_cell'))
+        self.assertEqual(stored, {Decimal(lat): grid_cell(Decimal(lat), Decimal(lon)) for lat, lon in positions})
+
+
+class NearestDevicesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        positions = [(11.55 + (number % 17) * 0.07 - 0.5, 104.92 + (number // 17) * 0.09 - 0.5) for number in range(200)]
+        devices = [make_device(number, now, latitude=round(lat, 6), longitude=round(lon, 6))
+                   for number, (lat, lon) in enumerate(positions)]
+        devices.append(make_device(200, now, latitude=0, longitude=0))
+        placeholder = make_device(201, now, latitude=11.55, longitude=104.92)
+        placeholder.coordinates = '0,0'
+        devices.append(placeholder)
+        DeviceData.objects.bulk_create(devices)
+
+    def setUp(self):
+        from api.services import nearest
+
+        caches[RESPONSE_CACHE_ALIAS].clear()
+        nearest._index = None
+
+    def nearest(self, **params):
+        return self.client.get('/api/devices/nearest/', params, HTTP_HOST='localhost')
+
+    def test_matches_haversine_scan(self):
+        import math
+
+        def haversine(lat1, lon1, lat2, lon2):
+            lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+            a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+            return 2 * 6371.0088 * math.asin(math.sqrt(a))
+
+        candidates = DeviceData.objects.exclude(coordinates='0,0').exclude(latitude=0, longitude=0)
+        for lat, lon, k in ((11.55, 104.92, 5), (12.3, 105.7, 12), (0.0, 0.0, 3)):
+            expected = sorted(haversine(lat, lon, float(device.latitude), float(device.longitude))
+                              for device in candidates)[:k]
+            body = self.nearest(lat=lat, lon=lon, k=k).json()
+            self.assertEqual(len(body['data']), k)
+            for device, distance in zip(body['data'], expected):
+                self.assertAlmostEqual(device['distance_km'], distance, delta=0.001)
+            self.assertNotIn(make_device(201, 0).imei, [device['imei'] for device in body['data']])
+
+    def test_radius_and_validation(self):
+        self.assertEqual(self.nearest(lat=0, lon=0, max_km=100).json()['count'], 0)
+        self.assertEqual(self.nearest(lat=95, lon=0).status_code, 400)
+        self.assertEqual(self.nearest(lat=11, lon=104, k=1000).status_code, 400)
+        self.assertEqual(self.nearest(lon=104).status_code, 400)
+
+
+class GeofenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        DeviceData.objects.bulk_create([
+            make_device(0, now, latitude=11.55, longitude=104.92),  # inside the square and the circle
+            make_device(1, now, latitude=11.60, longitude=104.80),  # inside the square only
+            make_device(2, now, latitude=12.50, longitude=104.92),  # outside both
+        ])
+
+    def create(self, payload):
+        return self.client.post('/api/geofences/', payload, content_type='application/json', HTTP_HOST='localhost')
+
+    def memberships(self):
+        from api.models import GeofenceMembership
+
+        return set(GeofenceMembership.objects.values_list('geofence__name', 'imei'))
+
+    def test_enter_and_exit_events(self):
+        from api.models import GeofenceEvent
+        from api.services.geofences import evaluate_geofences
+
+        square = [[11.5, 104.75], [11.5, 105.0], [11.7, 105.0], [11.7, 104.75]]
+        self.assertEqual(self.create({'name': 'Depot', 'kind': 'polygon', 'points': square}).status_code, 201)
+        self.create({'name': 'Zone', 'kind': 'circle', 'center_latitude': 11.55, 'center_longitude': 104.92,
+                     'radius_m': 2000})
+        imei = [make_device(number, 0).imei for number in range(3)]
+
+        # The first evaluation only records who is inside
+        evaluate_geofences()
+        self.assertEqual(self.memberships(), {('Depot', imei[0]), ('Depot', imei[1]), ('Zone', imei[0])})
+        self.assertFalse(GeofenceEvent.objects.exists())
+
+        DeviceData.objects.filter(imei=imei[0]).update(latitude=12.5)  # leaves both
+        DeviceData.objects.filter(imei=imei[2]).update(latitude=11.55)  # enters both
+        DeviceData.objects.filter(imei=imei[1]).update(latitude=0, longitude=0)  # loses its position
+        counts = evaluate_geofences()
+        self.assertEqual((counts['entered'], counts['exited']), (2, 2))
+        self.assertEqual(self.memberships(), {('Depot', imei[1]), ('Depot', imei[2]), ('Zone', imei[2])})
+
+        events = self.client.get('/api/geofences/events/', {'imei': imei[2]}, HTTP_HOST='localhost').json()['data']
+        self.assertEqual(sorted((event['geofence_name'], event['event']) for event in events),
+                         [('Depot', 'enter'), ('Zone', 'enter')])
+        listed = self.client.get('/api/geofences/', HTTP_HOST='localhost').json()['data']
+        self.assertEqual([(fence['name'], fence['members']) for fence in listed], [('Depot', 2), ('Zone', 1)])
+
+    def test_polygon_ray_casting(self):
+        from api.services.geofences import points_in_polygon
+
+        # A U shape opening north: the notch between the arms (longitude 1-2) is outside
+        u_shape = np.array([[0, 0], [0, 3], [3, 3], [3, 2], [1, 2], [1, 1], [3, 1], [3, 0]], dtype=float)
+        latitudes = np.array([0.5, 1.5, 2.5, 2.5, 4.0])
+        longitudes = np.array([1.5, 1.5, 0.5, 2.5, 1.5])
+        self.assertEqual(points_in_polygon(latitudes, longitudes, u_shape[:, 0], u_shape[:, 1]).tolist(),
+                         [True, False, True, True, False])
+
+    def test_invalid_geofence(self):
+        self.assertEqual(self.create({'name': 'Bad', 'kind': 'polygon', 'points': [[1, 2], [3, 4]]}).status_code, 400)
+        self.assertEqual(self.create({'name': 'Bad', 'kind': 'circle', 'radius_m': 5}).status_code, 400)
+        self.assertEqual(self.create({'name': 'Bad', 'kind': 'hexagon'}).status_code, 400)
+
+
+class DeviceClusterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = label_time()
+        devices = [make_device(number, now, datastatus=number % 2, description=('Offline', 'Online')[number % 2],
+                               latitude=round(11.0 + (number % 20) * 0.05, 6),
+                               longitude=round(104.5 + (number // 20) * 0.05, 6))
+                   for number in range(300)]
+        devices.append(make_device(300, now, latitude=0, longitude=0))
+        DeviceData.objects.bulk_create(devices)
+
+    def setUp(self):
+        from api.services import clusters
+
+        caches[RESPONSE_CACHE_ALIAS].clear()
+        clusters._index = None
+
+    def clusters(self, **params):
+        return self.client.get('/api/devices/clusters/', params, HTTP_HOST='localhost')
+
+    def test_every_zoom_accounts_for_every_device(self):
+        for zoom in (0, 3, 8, 10):
+            body = self.clusters(zoom=zoom, bbox='104.45,10.95,105.25,12').json()
+            self.assertEqual(body['devices'], 300)
+            statuses = {}
+            for cluster in body['data']:
+                self.assertEqual(sum(cluster['statuses'].values()), cluster['count'])
+                for status, count in cluster['statuses'].items():
+                    statuses[status] = statuses.get(status, 0) + count
+            self.assertEqual(statuses, {'Offline': 150, 'Online': 150})
+        self.assertEqual(self.clusters(zoom=0).json()['count'], 1)
+        # Devices 0.05 degrees apart are separate cells (about 0.02 degrees) at zoom 12
+        body = self.clusters(zoom=12, bbox='104.49,10.99,104.56,11.06').json()
+        self.assertEqual((body['count'], body['devices']), (4, 4))
+
+    def test_single_devices_and_centroids(self):
+        body = self.clusters(zoom=16, bbox='104.495,10.995,104.505,11.005').json()
+        self.assertEqual(body['data'], [{'latitude': 11.0, 'longitude': 104.5, 'count': 1,
+                                         'statuses': {'Offline': 1}, 'imei': make_device(0, 0).imei}])
+        cluster, = self.clusters(zoom=0).json()['data']
+        self.assertAlmostEqual(cluster['latitude'], 11.475, places=6)
+        self.assertAlmostEqual(cluster['longitude'], 104.85, places=6)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.clusters().status_code, 400)
+        self.assertEqual(self.clusters(zoom=30).status_code, 400)
+        self.assertEqual(self.clusters(zoom=5, bbox='1,2,3').status_code, 400)
+        self.assertEqual(self.clusters(zoom=16, bbox='-180,-85,180,85').status_code, 400)
+
+
+
+def read_varints(data):
+    """Values of a packed varint field"""
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def decode_protobuf(data):
+    """{field: [values]} of one protobuf message (varints as ints, length-delimited fields as bytes)"""
+    fields, position = {}, 0
+
+    def varint():
+        nonlocal position
+        value = shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                return value
+
+    while position < len(data):
+        key = varint()
+        if key & 7 == 0:
+            value = varint()
+        else:
+            length = varint()
+            value, position = data[position:position + length], position + length
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_tile(data):
+    """[(feature id, x, y, {attribute: value})] of the devices layer of a vector tile"""
+    layer = decode_protobuf(decode_protobuf(data)[3][0])
+    assert layer[15] == [2] and layer[1] == [b'devices'] and layer[5] == [4096]
+    keys = [key.decode() for key in layer[3]]
+    values = []
+    for value in layer.get(4, []):
+        message = decode_protobuf(value)
+        values.append(message[5][0] if 5 in message else unzigzag(message[6][0]))
+    points = []
+    for feature in layer.get(2, []):
+        message = decode_protobuf(feature)
+        tags = read_varints(message[2][0])
+        command, x, y = read_varints(message[4][0])
+        assert message[3] == [1] and command == 9
+        points.append((message.get(1, [None])[0], unzigzag(x), unzigzag(y),
+                       {keys[tags[i]]: values[tags[i + 1]] for i in range(0, len(tags), 2)}))
+    return points
+
+
+class DeviceTileTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = label_time()
+        devices = [make_device(number, cls.now - number, datastatus=number % 3,
+                               latitude=round(11.0 + number * 0.01, 6), longitude=round(104.5 + number * 0.01, 6))
+                   for number in range(50)]
+        devices.append(make_device(50, cls.now, latitude=0, longitude=0))
+        DeviceData.objects.bulk_create(devices)
+
+    def setUp(self):
+        from api.services.vector_tiles import update_device_tiles
+
+        caches[RESPONSE_CACHE_ALIAS].clear()
+        self.assertTrue(update_device_tiles()['full'])
+
+    def tile(self, zoom, x, y, **params):
+        return self.client.get(f'/api/tiles/{zoom}/{x}/{y}.mvt', params, HTTP_HOST='localhost')
+
+    def test_tiles_hold_every_positioned_device(self):
+        from api.models import DeviceTile
+        from api.services.vector_tiles import MAX_TILE_ZOOM, encode_tiles
+
+        columns = ([7, -1, 8, 9], [0, 4095, 5, 6], [4095, 17, 5, 6], [-2, 1, 1, 3], [0, 1700000000, 1, 1700000000])
+        first, empty, last = encode_tiles(np.array([2, 0, 2]), *(np.array(column) for column in columns))
+        self.assertEqual(decode_tile(first), [(7, 0, 4095, {'datastatus': -2, 'hearttime_unix': 0}),
+                                              (None, 4095, 17, {'datastatus': 1, 'hearttime_unix': 1700000000})])
+        self.assertEqual(decode_tile(empty), [])
+        self.assertEqual(decode_tile(last), [(8, 5, 5, {'datastatus': 1, 'hearttime_unix': 1}),
+                                             (9, 6, 6, {'datastatus': 3, 'hearttime_unix': 1700000000})])
+        for zoom in (0, 6, MAX_TILE_ZOOM):
+            tiles = DeviceTile.objects.filter(zoom=zoom)
+            points = [point for tile in tiles for point in decode_tile(bytes(tile.data))]
+            self.assertEqual(len(points), 50)
+            self.assertEqual(sum(tile.features for tile in tiles), 50)
+        device = make_device(3, self.now - 3, datastatus=0)
+        points = decode_tile(bytes(DeviceTile.objects.get(zoom=0).data))
+        self.assertIn((int(device.imei), {'datastatus': 0, 'hearttime_unix': self.now - 3}),
+                      [(feature_id, attributes) for feature_id, _, _, attributes in points])
+        # Device 0 (11.0, 104.5) on the single world tile: x = (104.5 + 180) / 360 * 4096, y in Web Mercator
+        self.assertIn((3236, 1922), [(x, y) for _, x, y, _ in points])
+
+    def test_load_rewrites_only_tiles_of_changed_devices(self):
+        from api.models import DeviceTile
+        from api.services.fleet_stats import refresh_fleet_stats
+        from api.services.vector_tiles import EXTENT_BITS, MAX_TILE_ZOOM, get_tile_version, update_device_tiles, world_pixels
+
+        before = dict(((zoom, x, y), version) for zoom, x, y, version
+                      in DeviceTile.objects.values_list('zoom', 'x', 'y', 'version'))
+        pixel_x, pixel_y = world_pixels(np.array([11.49]), np.array([104.99]))
+        old_tile = DeviceTile.objects.get(zoom=MAX_TILE_ZOOM, x=int(pixel_x[0]) >> EXTENT_BITS,
+                                          y=int(pixel_y[0]) >> EXTENT_BITS)
+        self.assertEqual(old_tile.features, 1)
+        moved = DeviceData.objects.get(imei=make_device(49, 0).imei)
+        previous = {moved.imei: (moved.hearttime_unix, moved.datastatus, moved.latitude, moved.longitude)}
+        moved.latitude, moved.longitude, moved.hearttime_unix = Decimal('13.5'), Decimal('106.5'), self.now + 60
+        moved.save()
+        version = refresh_fleet_stats().version
+
+        counts = update_device_tiles([{'imei': moved.imei, 'latitude': moved.latitude, 'longitude': moved.longitude,
+                                       'coordinates': '13.5,106.5', 'datastatus': moved.datastatus,
+                                       'hearttime_unix': moved.hearttime_unix}], previous)
+        self.assertFalse(counts['full'])
+        after = dict(((zoom, x, y), version) for zoom, x, y, version
+                     in DeviceTile.objects.values_list('zoom', 'x', 'y', 'version'))
+        rewritten = {address for address, tile_version in after.items() if tile_version == version}
+        self.assertEqual(counts['tiles'], len(rewritten))
+        # Low zooms hold both positions in one tile; at most two tiles per zoom change
+        self.assertLessEqual(len(rewritten), 2 * (MAX_TILE_ZOOM + 1))
+        self.assertTrue(all(after[address] == before[address] for address in before if address not in rewritten))
+        self.assertEqual(get_tile_version(), version)
+
+        old_tile.refresh_from_db()
+        self.assertEqual((old_tile.version, old_tile.features, decode_tile(bytes(old_tile.data))), (version, 0, []))
+
+    def test_update_patches_points_instead_of_reading_the_fleet(self):
+        from api.models import DeviceTile
+        from api.services.device_loader import bulk_load_device_data
+        from api.services.vector_tiles import FleetPoints, update_device_tiles
+
+        def pyramid():
+            return {(zoom, x, y): sorted(decode_tile(bytes(data)))
+                    for zoom, x, y, data in DeviceTile.objects.values_list('zoom', 'x', 'y', 'data')}
+
+        # Moved, lost its position, gained one, and a new device
+        records = [tracking_record(7, self.now + 60, latitude=12.25, longitude=105.75),
+                   tracking_record(8, self.now + 60, latitude=0, longitude=0),
+                   tracking_record(50, self.now + 60, latitude=10.5, longitude=103.5),
+                   tracking_record(51, self.now + 60, datastatus=4, latitude=-33.86882, longitude=151.209296)]
+        with mock.patch.object(FleetPoints, 'load', side_effect=AssertionError('read the whole fleet')), \
+                self.captureOnCommitCallbacks(execute=True):
+            bulk_load_device_data(records)
+        updated = pyramid()
+        self.assertEqual(sum(features for features in DeviceTile.objects.filter(zoom=0).values_list('features',
+                                                                                                    flat=True)), 51)
+
+        self.assertTrue(update_device_tiles()['full'])
+        # Tiles that only lost devices stay as empty tiles in the updated pyramid
+        self.assertEqual({address: points for address, points in updated.items() if points}, pyramid())
+
+    def test_cache_headers_and_conditional_get(self):
+        from api.services.vector_tiles import get_tile_version
+
+        tilejson = self.client.get('/api/tiles/', HTTP_HOST='localhost').json()
+        version = get_tile_version()
+        self.assertTrue(tilejson['tiles'][0].endswith(f'/api/tiles/{{z}}/{{x}}/{{y}}.mvt?v={version}'))
+
+        response = self.tile(0, 0, 0, v=version)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(len(decode_tile(response.content)), 50)
+
+        response = self.tile(0, 0, 0, v=version - 1)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.client.get('/api/tiles/0/0/0.mvt', HTTP_HOST='localhost',
+                                         HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.tile(1, 0, 0).status_code, 204)
+        self.assertEqual(self.tile(1, 2, 0).status_code, 404)
+        self.assertEqual(self.tile(20, 0, 0).status_code, 404)
+
+
+class FakeProTrack:
+    """Local stand-in for the ProTrack365 track and authorization endpoints.
+
+    The track endpoint answers 401 unless the request carries ``token``, and
+    500 for any batch containing one of ``bad_imeis``.
+    """
+
+    def __init__(self, token='fresh', bad_imeis=(), hearttime_unix=1700000000):
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer
+
+        self.token = token
+        self.bad_imeis = set(bad_imeis)
+        self.hearttime_unix = hearttime_unix
+        self.track_requests = 0
+        self.auth_requests = 0
+        app = web.Application()
+        app.router.add_get('/api/track', self.track)
+        app.router.add_get('/api/authorization', self.authorize)
+        self.server = TestServer(app)
+
+    async def __aenter__(self):
+        self.authorized = asyncio.Event()
+        await self.server.start_server()
+        base_url = str(self.server.make_url('')).rstrip('/')
+        self.track_endpoint = f'{base_url}/api/track'
+        self.base_url_patch = mock.patch('api.services.token_manager.PROTRACK_BASE_URL', base_url)
+        self.base_url_patch.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.base_url_patch.stop()
+        await self.server.close()
+
+    async def track(self, request):
+        from aiohttp import web
+
+        self.track_requests += 1
+        if request.query.get('access_token') != self.token:
+            # Like a slow upstream, the body is only finished once a new token was issued,
+            # so a client still reading it holds its connection until then
+            response = web.StreamResponse(status=401, headers={'Content-Type': 'application/json'})
+            await response.prepare(request)
+            try:
+                await response.write(b'{"code": 10001, ')
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.authorized.wait(), timeout=5)
+                await response.write(b'"message": "access_token expired"}')
+                await response.write_eof()
+            except ConnectionResetError:
+                pass
+            return response
+        imeis = request.query['imeis'].split(',')
+        if self.bad_imeis.intersection(imeis):
+            return web.json_response({'code': 50000, 'message': 'internal error'}, status=500)
+        return web.json_response({'code': 0, 'record': [
+            {'imei': imei, 'latitude': 11.55, 'longitude': 104.92, 'datastatus': 2,
+             'hearttime': self.hearttime_unix}
+            for imei in imeis
+        ]})
+
+    async def authorize(self, request):
+        from aiohttp import web
+
+        self.auth_requests += 1
+        self.authorized.set()
+        return web.json_response({'code': 0, 'record': {'access_token': self.token, 'expires_in': 7200}})
+
+
+def device_imeis(count):
+    return [make_device(number, 0).imei for number in range(count)]
+
+
+class TokenRefreshTests(TestCase):
+    def test_expired_token_is_refreshed_once_with_a_small_pool(self):
+        from api.services.protrack_service import create_track_session, get_track_info_concurrent
+        from api.services.token_manager import TokenManager
+
+        imeis = device_imeis(600)
+
+        async def fetch():
+            # Six batches over two connections: every connection holds a 401 when the refresh starts
+            async with FakeProTrack() as api, create_track_session(2) as session:
+                results = await asyncio.wait_for(get_track_info_concurrent(
+                    imeis, 'expired', api.track_endpoint,
+                    token_manager=TokenManager(shared_cache=False), session=session,
+                ), timeout=10)
+                return api, results
+
+        with self.assertLogs('api.services.protrack_service', 'WARNING') as logs:
+            api, results = asyncio.run(fetch())
+        # The four batches the limiter let through carry the expired token; the last two start with the new one
+        self.assertEqual(len(logs.output), 4)
+        self.assertEqual(api.auth_requests, 1)
+        self.assertEqual(api.track_requests, 10)
+        self.assertTrue(all('record' in result for result in results))
+        self.assertEqual(sorted(record['imei'] for result in results for record in result['record']), imeis)
+
+    def test_later_batches_use_the_refreshed_token(self):
+        from api.services.concurrency import AdaptiveConcurrencyLimiter
+        from api.services.protrack_service import get_track_info_concurrent
+        from api.services.token_manager import TokenManager
+
+        async def fetch():
+            async with FakeProTrack() as api:
+                results = await get_track_info_concurrent(
+                    device_imeis(300), 'expired', api.track_endpoint,
+                    token_manager=TokenManager(shared_cache=False),
+                    limiter=AdaptiveConcurrencyLimiter(initial=1, max_limit=1),
+                )
+                return api, results
+
+        with self.assertLogs('api.services.protrack_service', 'WARNING') as logs:
+            api, results = asyncio.run(fetch())
+        # Only the first batch is rejected: the others read the new token from the manager
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual((api.auth_requests, api.track_requests), (1, 4))
+        self.assertTrue(all('record' in result for result in results))
+
+
+class ConcurrencyLimiterTests(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('api.services.concurrency.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def limiter(self, **kwargs):
+        from api.services.concurrency import AdaptiveConcurrencyLimiter
+        return AdaptiveConcurrencyLimiter(**kwargs)
+
+    def record(self, limiter, count, latency=1.0, outcome='ok'):
+        for _ in range(count):
+            limiter.record(latency, outcome)
+
+    def test_healthy_windows_grow_the_limit_by_one_up_to_max(self):
+        limiter = self.limiter(initial=2, max_limit=4)
+        # One window is as many requests as the current limit
+        self.record(limiter, 1)
+        self.assertEqual(limiter.limit, 2)
+        self.record(limiter, 1)
+        self.assertEqual(limiter.limit, 3)
+        self.record(limiter, 3 + 4 * 5)
+        self.assertEqual((limiter.limit, limiter.peak_limit), (4, 4))
+
+    def test_failing_window_holds_the_limit(self):
+        limiter = self.limiter(initial=4)
+        self.record(limiter, 4, outcome='error')
+        self.assertEqual((limiter.limit, limiter.decreases), (4, 0))
+
+    def test_throttling_halves_the_limit_once_per_cooldown(self):
+        limiter = self.limiter(initial=16)
+        with self.assertLogs('api.services.concurrency', 'WARNING') as logs:
+            limiter.record(2.0, 'throttled')
+            # The rest of the burst lands inside the cooldown
+            self.now += 1.5
+            limiter.record(2.0, 'throttled')
+            self.assertEqual(limiter.limit, 8)
+            self.now += 0.5
+            limiter.record(2.0, 'throttled')
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual((limiter.decreases, limiter.total_throttled), (2, 3))
+        self.assertIn('concurrency 16 -> 8', logs.output[0])
+
+    def test_slow_window_halves_the_limit(self):
+        limiter = self.limiter(initial=8, latency_target=10.0)
+        with self.assertLogs('api.services.concurrency', 'WARNING') as logs:
+            self.record(limiter, 8, latency=12.0)
+        self.assertEqual((limiter.limit, limiter.decreases), (4, 1))
+        self.assertIn('p95 latency 12.0s over target, concurrency 8 -> 4', logs.output[0])
+
+    def test_limit_never_drops_below_min(self):
+        limiter = self.limiter(initial=3)
+        with self.assertLogs('api.services.concurrency', 'WARNING'):
+            for _ in range(5):
+                self.now += 60
+                limiter.record(1.0, 'throttled')
+        self.assertEqual((limiter.limit, limiter.decreases), (1, 5))
+        self.assertEqual(limiter.snapshot()['concurrency'], 1)
+
+
+class BatchIsolationTests(TestCase):
+    def test_bad_imei_is_isolated_and_quarantined(self):
+        from api.services.protrack_service import get_track_info_concurrent, process_tracking_data
+        from api.services.quarantine import get_quarantined_imeis, update_quarantine
+        from api.services.retry import RetryBudget, RetryPolicy
+
+        imeis = device_imeis(250)
+        bad_imei = imeis[137]
+        budget = RetryBudget(max_retries=50)
+
+        async def fetch():
+            async with FakeProTrack(bad_imeis={bad_imei}) as api:
+                return await get_track_info_concurrent(
+                    imeis, api.token, api.track_endpoint,
+                    retry_policy=RetryPolicy(base_delay=0), retry_budget=budget,
+                )
+
+        with self.assertLogs('api.services', 'WARNING') as logs:
+            results = asyncio.run(fetch())
+        self.assertIn('splitting to isolate bad IMEIs', '\n'.join(logs.output))
+        failed = [result for result in results if 'error' in result]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual((failed[0]['imei_batch'], failed[0]['http_status']), ([bad_imei], 500))
+        self.assertTrue(failed[0]['isolated'])
+        fetched = sorted(record['imei'] for result in results if 'record' in result for record in result['record'])
+        self.assertEqual(fetched, [imei for imei in imeis if imei != bad_imei])
+        self.assertLess(budget.spent, budget.max_retries)
+
+        records = {record['imei']: record for record in process_tracking_data(results, imeis)}
+        self.assertEqual(len(records), 250)
+        self.assertEqual(records[bad_imei]['datastatus_description'], 'API Error')
+
+        with self.assertLogs('api.services.quarantine', 'WARNING'):
+            self.assertEqual(update_quarantine(results), {'quarantined': 1, 'released': 0})
+        self.assertEqual(get_quarantined_imeis(), {bad_imei})
+
+
+class StreamingRefreshTests(TransactionTestCase):
+    def test_batches_are_loaded_while_later_ones_are_fetched(self):
+        from api.services.concurrency import AdaptiveConcurrencyLimiter
+        from api.services.refresh_pipeline import refresh_tracking_data_async
+
+        imeis = device_imeis(500)
+        loads = []
+        loads_seen_by_fetch = []
+
+        async def fetch_batch(session, imei_batch, token, endpoint, token_manager=None):
+            loads_seen_by_fetch.append(len(loads))
+            return {'code': 0, 'record': [
+                {'imei': imei, 'latitude': 11.55, 'longitude': 104.92, 'datastatus': 2, 'hearttime': 1700000000}
+                for imei in imei_batch
+            ]}
+
+        def progress(records_loaded, total, batches_done):
+            loads.append((records_loaded, DeviceData.objects.count(), batches_done))
+
+        token_manager = mock.Mock(get_token_async=mock.AsyncMock(return_value='token'))
+        with mock.patch('api.services.protrack_service.fetch_batch', fetch_batch):
+            # One batch in flight and two scheduled at a time, one DB load per batch
+            result = asyncio.run(refresh_tracking_data_async(
+                imeis, token_manager=token_manager, load_chunk_size=100, progress=progress,
+                limiter=AdaptiveConcurrencyLimiter(initial=1, max_limit=1),
+            ))
+
+        self.assertEqual((result['records'], result['batches'], result['created']), (500, 5, 500))
+        self.assertEqual(loads, [(100 * done, 100 * done, done) for done in range(1, 6)])
+        # The last batches were only fetched after the first ones were in the database
+        self.assertEqual(loads_seen_by_fetch[:2], [0, 0])
+        self.assertGreater(loads_seen_by_fetch[-1], 0)
+
+    def test_archive_failure_still_notifies_and_quarantines(self):
+        import tempfile
+        from api.services import refresh_pipeline
+
+        async def fetch_batch(session, imei_batch, token, endpoint, token_manager=None):
+            return {'code': 0, 'record': [
+                {'imei': imei, 'latitude': 11.55, 'longitude': 104.92, 'datastatus': 2, 'hearttime': 1700000000}
+                for imei in imei_batch
+            ]}
+
+        token_manager = mock.Mock(get_token_async=mock.AsyncMock(return_value='token'))
+        with tempfile.TemporaryDirectory() as folder, \
+                mock.patch('api.services.protrack_service.fetch_batch', fetch_batch), \
+                mock.patch.object(refresh_pipeline.BackgroundRunWriter, 'close', side_effect=OSError('disk full')), \
+                mock.patch.object(refresh_pipeline, 'notify_devices_changed',
+                                  wraps=refresh_pipeline.notify_devices_changed) as notify, \
+                mock.patch.object(refresh_pipeline, 'apply_quarantine_changes',
+                                  wraps=refresh_pipeline.apply_quarantine_changes) as quarantine, \
+                self.assertLogs('api.services.refresh_pipeline', 'ERROR') as logs:
+            result = asyncio.run(refresh_pipeline.refresh_tracking_data_async(
+                device_imeis(10), token_manager=token_manager, archive_folder=folder,
+            ))
+
+        self.assertEqual((result['created'], result['archive_error']), (10, 'disk full'))
+        self.assertIn('disk full', logs.output[0])
+        self.assertEqual(len(notify.call_args.args[0]['rows']), 10)
+        quarantine.assert_called_once()
+
+
+class ColumnarProcessingTests(TestCase):
+    now = datetime(2025, 6, 1, 12, 30, 45, 500000, tzinfo=timezone.utc)
+
+    def devices(self):
+        hearttime = int(self.now.timestamp())
+        typical = [
+            {'imei': make_device(number, 0).imei, 'latitude': round(11 + number / 7, 6),
+             'longitude': round(104 + number / 9, 6), 'datastatus': number % 7,
+             'hearttime': hearttime - number * 3607 if number % 5 else 0}
+            for number in range(40)
+        ]
+        odd = [
+            {'imei': 1, 'latitude': '11.5', 'longitude': '104.9', 'datastatus': '2', 'hearttime': str(hearttime)},
+            {'imei': 2, 'latitude': 0, 'longitude': 104.9, 'datastatus': None, 'hearttime': None},
+            {'imei': 3, 'latitude': 'null', 'longitude': '', 'datastatus': 'x', 'hearttime': ''},
+            {'imei': 4, 'latitude': 11.5, 'longitude': 104.9, 'datastatus': 5, 'hearttime': 'soon'},
+            {'imei': 5, 'latitude': 11.5, 'longitude': 104.9, 'datastatus': 3, 'hearttime': float(hearttime)},
+            {'imei': 6, 'latitude': 11.5, 'longitude': 104.9, 'datastatus': 4, 'hearttime': hearttime + 3600},
+            {'imei': 7, 'latitude': 11.5, 'longitude': 104.9, 'datastatus': 4, 'hearttime': 10 ** 12},
+            {'imei': 8, 'latitude': 11.5, 'longitude': 104.9, 'datastatus': 10 ** 30, 'hearttime': -5},
+            {},
+        ]
+        return typical, typical + odd
+
+    def test_columnar_matches_per_record_processing(self):
+        from api.services.columnar import process_devices_columnar
+        from api.services.protrack_service import process_devices
+
+        # Unparsable hearttimes are logged by the scalar fallback
+        with self.assertLogs('api.services.protrack_service', 'WARNING'):
+            for devices in self.devices():
+                self.assertEqual(process_devices_columnar(devices, self.now), process_devices(devices, self.now))
+        self.assertEqual(process_devices_columnar([], self.now), [])
+
+    def test_whole_run_matches_batch_by_batch(self):
+        from api.services.protrack_service import batch_error, missing_imei_records, process_batch, process_tracking_data
+
+        typical, mixed = self.devices()
+        raw_data = [
+            {'code': 0, 'record': mixed[:20]},
+            batch_error(['35000000000000901', '35000000000000902'], 'HTTP 500', error_type='http'),
+            {'code': 0, 'record': mixed[20:]},
+            {'code': 0, 'record': typical[0]},
+        ]
+        imeis = [str(device['imei']) for device in typical] + ['35000000000000903']
+
+        returned_imeis = set()
+        with self.assertLogs('api.services.protrack_service', 'WARNING'):
+            expected = [record for batch in raw_data for record in process_batch(batch, returned_imeis, self.now)]
+            expected += missing_imei_records(imeis, returned_imeis)
+            self.assertEqual(process_tracking_data(raw_data, imeis, self.now), expected)
+        self.assertEqual(expected[-1]['imei'], '35000000000000903')
+
+    def test_error_batch_matches_scalar_reference(self):
+        from api.services.protrack_service import batch_error, process_batch, process_devices, process_tracking_data
+
+        typical, _ = self.devices()
+        failed = ['35000000000000901', '35000000000000902']
+        raw_data = [{'code': 0, 'record': typical[:10]}, batch_error(failed, 'HTTP 500', error_type='http')]
+        imeis = [str(device['imei']) for device in typical[:10]] + failed
+
+        # Scalar reference: each failed IMEI gets its API error record and nothing else;
+        # a second "can't access" record would overwrite it (and the quarantine status) on load
+        errors = [{'imei': imei, 'latitude': '', 'longitude': '', 'coordinates': '0,0', 'datastatus': None,
+                   'datastatus_description': 'API Error', 'hearttime_date': '', 'hearttime_time': '',
+                   'hearttime_unix': '', 'status': 'API error: HTTP 500'} for imei in failed]
+        expected = process_devices(typical[:10], self.now) + errors
+        self.assertEqual(process_tracking_data(raw_data, imeis, self.now), expected)
+
+        returned_imeis = set()
+        streamed = [record for batch in raw_data for record in process_batch(batch, returned_imeis, self.now)]
+        self.assertEqual(streamed, expected)
+        self.assertEqual(returned_imeis, set(imeis))
+
+
+def tracking_record(number, hearttime_unix, datastatus=2, latitude=11.55, longitude=104.92):
+    """A record as process_tracking_data returns it"""
+    return {
+        'imei': make_device(number, 0).imei,
+        'latitude': latitude,
+        'longitude': longitude,
+        'coordinates': f'{latitude},{longitude}',
+        'datastatus': datastatus,
+        'datastatus_description': 'Online',
+        'hearttime_date': '2025-06-01',
+        'hearttime_time': '19:30:45',
+        'hearttime_unix': hearttime_unix,
+        'status': 'success',
+    }
+
+
+class DeviceLoaderTests(TestCase):
+    def load(self, records, **options):
+        from api.services.device_loader import bulk_load_device_data
+
+        warnings = []
+        counts = bulk_load_device_data(records, warn=warnings.append, **options)
+        return counts, warnings
+
+    def test_duplicate_imeis_in_one_batch(self):
+        counts, warnings = self.load([
+            tracking_record(1, 1700000000), tracking_record(2, 1700000000), tracking_record(1, 1700000600),
+        ])
+        # The last record of an IMEI wins; the earlier one counts as an update of it
+        self.assertEqual(counts, {'created': 2, 'updated': 1, 'unchanged': 0, 'errors': 0, 'appended': 2})
+        self.assertEqual(warnings, [])
+        self.assertEqual(DeviceData.objects.get(imei=make_device(1, 0).imei).hearttime_unix, 1700000600)
+        self.assertEqual(DeviceData.objects.count(), 2)
+
+    def test_bad_rows_are_counted_and_skipped(self):
+        bad = [
+            tracking_record(1, 1700000000, latitude='north'),
+            tracking_record(2, 1700000000, longitude='1e999'),
+            tracking_record(3, 1700000000, latitude=1234.5),
+            tracking_record(4, 1700000000, datastatus=2 ** 31),
+            tracking_record(5, 2 ** 63),
+            tracking_record(6, 'yesterday'),
+            {'latitude': 11.55, 'longitude': 104.92},
+        ]
+        counts, warnings = self.load(bad + [tracking_record(7, 1700000000), tracking_record(8, 0)], chunk_size=4)
+        self.assertEqual(counts, {'created': 2, 'updated': 0, 'unchanged': 0, 'errors': 7, 'appended': 1})
+        self.assertEqual(len(warnings), 7)
+        self.assertEqual(sorted(DeviceData.objects.values_list('imei', flat=True)),
+                         [make_device(7, 0).imei, make_device(8, 0).imei])
+
+    def test_reload_updates_existing_rows(self):
+        from api.models import PositionHistory
+
+        self.load([tracking_record(number, 1700000000) for number in range(3)])
+        counts, _ = self.load([
+            tracking_record(0, 1700000000),
+            tracking_record(1, 1700000900, datastatus=4, latitude=11.6, longitude=104.95),
+            tracking_record(2, 1700000900),
+            tracking_record(3, 1700000900),
+        ])
+        self.assertEqual(counts, {'created': 1, 'updated': 2, 'unchanged': 1, 'errors': 0, 'appended': 3})
+        device = DeviceData.objects.get(imei=make_device(1, 0).imei)
+        self.assertEqual((device.hearttime_unix, device.datastatus, device.latitude, device.longitude),
+                         (1700000900, 4, Decimal('11.600000'), Decimal('104.950000')))
+        self.assertEqual(device.grid_cell, grid_cell(Decimal('11.6'), Decimal('104.95')))
+        self.assertEqual(DeviceData.objects.count(), 4)
+        self.assertEqual(PositionHistory.objects.count(), 6)
+
+
+class SnapshotArchiveTests(TestCase):
+    now = datetime(2025, 6, 1, 12, 30, 45, tzinfo=timezone.utc)
+    devices = [
+        {'imei': '350000000000001', 'latitude': 11.55, 'longitude': 104.92, 'datastatus': 2, 'hearttime': 1748781045},
+        {'imei': '350000000000002', 'latitude': '-33.868820', 'longitude': '151.209296', 'datastatus': '1',
+         'hearttime': '1748700000'},
+        {'imei': '350000000000003', 'latitude': '0.000010', 'longitude': '100.000000', 'datastatus': 3,
+         'hearttime': 1700000000},
+        {'imei': '350000000000004', 'latitude': 0, 'longitude': 0, 'datastatus': 1, 'hearttime': 0},
+        # No position: goes through the per-record path
+        {'imei': '350000000000005', 'latitude': '', 'longitude': '', 'datastatus': None, 'hearttime': ''},
+    ]
+
+    def write_snapshot(self, folder, compression):
+        import os
+        from api.services.columnar import process_devices_columnar
+        from api.services.snapshot_archive import SnapshotWriter
+
+        records = process_devices_columnar(self.devices, self.now)
+        path = os.path.join(folder, f'{compression}.snap')
+        with SnapshotWriter(path, compression=compression, generated_at=self.now) as writer:
+            writer.write(records)
+        return path, records
+
+    def test_round_trip_memmapped_and_gzipped(self):
+        import tempfile
+        from api.services.columnar import process_devices_columnar
+        from api.services.snapshot_archive import read_columns, read_records
+
+        # Values come back normalized: numeric strings as numbers
+        normalized = [dict(device) for device in self.devices]
+        normalized[1].update(latitude=-33.86882, longitude=151.209296, datastatus=1, hearttime=1748700000)
+        normalized[2].update(latitude=0.00001, longitude=100.0)
+        expected = process_devices_columnar(normalized, self.now)
+        for compression, mapped in [('none', True), ('gzip', False)]:
+            with self.subTest(compression=compression), tempfile.TemporaryDirectory() as folder:
+                path, _ = self.write_snapshot(folder, compression)
+                _, columns = read_columns(path)
+                self.assertEqual(isinstance(columns['lat_e6'], np.memmap), mapped)
+                del columns
+                self.assertEqual(read_records(path), expected)
+
+    def test_snapshot_rows_match_json_rows(self):
+        import json
+        import tempfile
+        from api.services.device_loader import build_device_row, device_max_lengths
+        from api.services.snapshot_archive import read_device_rows
+
+        def device_row(record):
+            # What the loader stores for a record, or None when it counts it as an error
+            try:
+                return build_device_row(record, self.now)
+            except (ValueError, TypeError, ArithmeticError):
+                return None
+
+        for compression in ['none', 'gzip']:
+            with self.subTest(compression=compression), tempfile.TemporaryDirectory() as folder:
+                path, records = self.write_snapshot(folder, compression)
+                rows, fallback = read_device_rows(path, device_max_lengths())
+                self.assertEqual(len(fallback), 1)
+                from_snapshot = rows + [device_row(record) for record in fallback]
+                from_json = [device_row(record) for record in json.loads(json.dumps(records))]
+                self.assertEqual(from_snapshot, from_json)
+        self.assertEqual([row and row['coordinates'] for row in from_json],
+                         ['11.55,104.92', '-33.86882,151.209296', '0.00001,100', '0,0', None])
+
+
+class ChangeDetectionTests(TestCase):
+    def setUp(self):
+        from api.services.device_loader import bulk_load_device_data
+
+        self.records = [tracking_record(number, 1700000000 + number) for number in range(5)]
+        bulk_load_device_data(self.records)
+        self.updated_at = dict(DeviceData.objects.values_list('imei', 'updated_at'))
+
+    def reload(self, records):
+        """bulk_load_device_data with its devices_changed signals: (counts, [(rows, previous)])"""
+        from api.services.device_loader import bulk_load_device_data
+        from api.signals import devices_changed
+
+        sent = []
+
+        def receiver(sender, rows, previous, **kwargs):
+            sent.append((rows, previous))
+
+        devices_changed.connect(receiver)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                counts = bulk_load_device_data(records)
+        finally:
+            devices_changed.disconnect(receiver)
+        return counts, sent
+
+    def test_identical_reload_writes_nothing(self):
+        from api.models import PositionHistory
+
+        history = PositionHistory.objects.count()
+        counts, sent = self.reload([dict(record) for record in self.records])
+        self.assertEqual(counts, {'created': 0, 'updated': 0, 'unchanged': 5, 'errors': 0, 'appended': 0})
+        self.assertEqual(sent, [])
+        self.assertEqual(dict(DeviceData.objects.values_list('imei', 'updated_at')), self.updated_at)
+        self.assertEqual(PositionHistory.objects.count(), history)
+
+    def test_position_or_status_change_is_an_update(self):
+        records = [dict(record) for record in self.records]
+        records[1].update(latitude=11.56, longitude=104.93)
+        records[3].update(datastatus=4)
+        counts, sent = self.reload(records)
+        # hearttime is unchanged, so nothing is appended to the position history
+        self.assertEqual(counts, {'created': 0, 'updated': 2, 'unchanged': 3, 'errors': 0, 'appended': 0})
+
+        (rows, previous), = sent
+        changed = [records[1]['imei'], records[3]['imei']]
+        self.assertEqual([row['imei'] for row in rows], changed)
+        self.assertEqual(previous, {
+            changed[0]: (1700000001, 2, Decimal('11.550000'), Decimal('104.920000')),
+            changed[1]: (1700000003, 2, Decimal('11.550000'), Decimal('104.920000')),
+        })
+        stored = {imei: (latitude, datastatus) for imei, latitude, datastatus
+                  in DeviceData.objects.values_list('imei', 'latitude', 'datastatus')}
+        self.assertEqual((stored[changed[0]], stored[changed[1]]),
+                         ((Decimal('11.560000'), 2), (Decimal('11.550000'), 4)))
+        updated_at = dict(DeviceData.objects.values_list('imei', 'updated_at'))
+        self.assertEqual(sorted(imei for imei in updated_at if updated_at[imei] != self.updated_at[imei]), changed)
+
+
+class JobTests(TransactionTestCase):
+    def run_handler(self, handler):
+        """Run ``handler`` as a job in this thread and return the finished Job"""
+        from api.models import Job
+        from api.services.jobs import run_job
+
+        job = Job.objects.create(kind='test')
+        with mock.patch.dict('api.services.jobs._handlers', {'test': handler}):
+            run_job(job.id)
+        job.refresh_from_db()
+        return job
+
+    def backdate(self, job_id):
+        from datetime import timedelta
+        from django.utils import timezone
+        from api.models import Job
+
+        Job.objects.filter(pk=job_id).update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def start_refresh(self):
+        return self.client.post('/api/refresh/', '{}', content_type='application/json', HTTP_HOST='localhost').json()
+
+    def test_second_start_returns_the_running_job(self):
+        from api.models import Job
+
+        # Nothing runs: the job stays active until the test finishes it
+        with mock.patch('api.services.jobs._get_executor'):
+            first = self.start_refresh()
+            Job.objects.filter(pk=first['job_id']).update(status=Job.STATUS_RUNNING)
+            second = self.start_refresh()
+            self.assertEqual((first['deduplicated'], second['deduplicated']), (False, True))
+            self.assertEqual((second['job_id'], second['status']), (first['job_id'], 'running'))
+            self.assertEqual(Job.objects.count(), 1)
+
+            Job.objects.filter(pk=first['job_id']).update(status=Job.STATUS_SUCCEEDED)
+            third = self.start_refresh()
+        self.assertFalse(third['deduplicated'])
+        self.assertNotEqual(third['job_id'], first['job_id'])
+
+    def test_fetch_and_refresh_never_run_together(self):
+        from api.models import Job
+
+        with mock.patch('api.services.jobs._get_executor'):
+            fetch = self.client.post('/api/fetch-tracking/', HTTP_HOST='localhost').json()
+            refresh = self.start_refresh()
+            self.assertEqual((refresh['deduplicated'], refresh['job_id'], refresh['kind']),
+                             (True, fetch['job_id'], 'fetch_tracking'))
+
+            Job.objects.filter(pk=fetch['job_id']).update(status=Job.STATUS_FAILED)
+            refresh = self.start_refresh()
+            fetch = self.client.post('/api/fetch-tracking/', HTTP_HOST='localhost').json()
+        self.assertEqual((refresh['deduplicated'], refresh['kind']), (False, 'refresh'))
+        self.assertEqual((fetch['deduplicated'], fetch['job_id']), (True, refresh['job_id']))
+        self.assertEqual(Job.objects.filter(status__in=Job.ACTIVE_STATUSES).count(), 1)
+
+    def test_heartbeat_keeps_a_long_phase_alive(self):
+        import time
+        from datetime import timedelta
+        from django.utils import timezone
+
+        def handler(params, report):
+            self.backdate(report.job_id)
+            time.sleep(0.3)
+            return {'ok': True}
+
+        with mock.patch('api.services.jobs.HEARTBEAT_INTERVAL', 0.05):
+            job = self.run_handler(handler)
+        self.assertEqual(job.status, 'succeeded')
+        self.assertGreater(job.updated_at, timezone.now() - timedelta(minutes=1))
+
+    def test_job_failed_as_stale_stays_failed(self):
+        from api.services.jobs import fail_stale_jobs
+
+        def handler(params, report):
+            self.backdate(report.job_id)
+            self.assertEqual(fail_stale_jobs(), 1)
+            return {'ok': True}
+
+        with self.assertLogs('api.services.jobs', 'WARNING') as logs:
+            job = self.run_handler(handler)
+        self.assertIn('result discarded', logs.output[0])
+        self.assertEqual((job.status, job.result, job.error), ('failed', None, 'Worker stopped responding'))
+
+
+class FleetStatsTests(TestCase):
+    def setUp(self):
+        caches[RESPONSE_CACHE_ALIAS].clear()
+
+    def load(self, records):
+        from api.services.device_loader import bulk_load_device_data
+
+        with self.captureOnCommitCallbacks(execute=True):
+            return bulk_load_device_data(records)
+
+    def records(self):
+        records = [tracking_record(number, 1700000000 + number, datastatus=number % 3 + 2) for number in range(6)]
+        for record in records:
+            record['datastatus_description'] = ['Online', 'Expired', 'Offline'][record['datastatus'] - 2]
+        records[5].update(latitude=0, longitude=0, coordinates='0,0')
+        return records
+
+    def stats(self, **headers):
+        return self.client.get('/api/stats/', HTTP_HOST='localhost', **headers)
+
+    def test_stats_and_version_follow_loads(self):
+        from api.services.response_cache import get_snapshot
+
+        records = self.records()
+        self.load(records)
+        version, _ = get_snapshot()
+        stats = self.stats().json()['stats']
+        self.assertEqual((stats['total_devices'], stats['with_coordinates'], stats['without_coordinates']), (6, 5, 1))
+        self.assertEqual(stats['status_counts'], {'Online': 2, 'Expired': 2, 'Offline': 2})
+
+        # Nothing changed: no new version
+        self.load([dict(record) for record in records])
+        self.assertEqual(get_snapshot()[0], version)
+
+        records[0].update(datastatus=4, datastatus_description='Offline')
+        self.load([records[0], tracking_record(6, 1700000006)])
+        self.assertEqual(get_snapshot()[0], version + 1)
+        stats = self.stats().json()['stats']
+        self.assertEqual(stats['total_devices'], 7)
+        self.assertEqual(stats['status_counts'], {'Online': 2, 'Expired': 2, 'Offline': 3})
+
+    def test_etag_revalidation(self):
+        # The device list ETag also carries the minute of its relative-time labels
+        minute = mock.patch('api.services.response_cache.label_time', return_value=label_time())
+        minute.start()
+        self.addCleanup(minute.stop)
+        self.load(self.records())
+        response = self.stats()
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.stats(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        devices = self.client.get('/api/devices/', HTTP_HOST='localhost')
+        self.assertEqual(self.client.get('/api/devices/', HTTP_HOST='localhost',
+                                         HTTP_IF_NONE_MATCH=devices['ETag']).status_code, 304)
+
+        self.load([tracking_record(6, 1700000006)])
+        response = self.stats(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['stats']['total_devices'], 7)
+        response = self.client.get('/api/devices/', HTTP_HOST='localhost', HTTP_IF_NONE_MATCH=devices['ETag'])
+        self.assertEqual((response.status_code, response.json()['pagination']['total_records']), (200, 7))
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from datetime import date, time
+
+        cls.now = label_time()
+        devices = []
+        for number in range(130):
+            device = make_device(number, cls.now - number * 97 if number % 10 else 0,
+                                 latitude=round(11 + number * 0.001, 6), longitude=round(104.5 + number * 0.001, 6))
+            if number % 10:
+                device.hearttime_date = date(2025, 6, 1 + number % 28)
+                device.hearttime_time = time(number % 24, number % 60, 7)
+            devices.append(device)
+        DeviceData.objects.bulk_create(devices)
+
+    def setUp(self):
+        caches[RESPONSE_CACHE_ALIAS].clear()
+        # Several chunks (and Parquet row groups) out of a small table
+        chunk_rows = mock.patch('api.services.export.EXPORT_CHUNK_ROWS', 50)
+        chunk_rows.start()
+        self.addCleanup(chunk_rows.stop)
+        minute = mock.patch('api.services.response_cache.label_time', return_value=self.now)
+        minute.start()
+        self.addCleanup(minute.stop)
+
+    def export(self, **params):
+        response = self.client.get('/api/export-csv/', params, HTTP_HOST='localhost')
+        self.assertEqual(response.status_code, 200)
+        chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        return response, b''.join(chunks)
+
+    def expected(self):
+        return [
+            (imei, latitude, longitude, hearttime_unix, hearttime_date, hearttime_time)
+            for imei, latitude, longitude, hearttime_unix, hearttime_date, hearttime_time in
+            DeviceData.objects.order_by('ranking_id').values_list(
+                'imei', 'latitude', 'longitude', 'hearttime_unix', 'hearttime_date', 'hearttime_time')
+        ]
+
+    def read_csv(self, data):
+        import csv
+        import io
+
+        return [
+            (row['IMEI'], Decimal(row['Latitude']), Decimal(row['Longitude']), int(row['Heart Unix']),
+             row['Heart Date'] or None, row['Heart Time'] or None)
+            for row in csv.DictReader(io.StringIO(data.decode('utf-8')))
+        ]
+
+    def test_csv_round_trip(self):
+        response, data = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        expected = [(imei, latitude, longitude, unix, day and day.isoformat(), moment and moment.isoformat())
+                    for imei, latitude, longitude, unix, day, moment in self.expected()]
+        self.assertEqual(self.read_csv(data), expected)
+
+        response, compressed = self.export(compress='gzip')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(compressed), data)
+
+        # Filters run in SQL: heartbeats within the hour are devices 1 to 37, except 10, 20 and 30
+        response = self.client.get('/api/export-csv/', {'fresh_minutes': 60}, HTTP_HOST='localhost')
+        self.assertEqual(len(self.read_csv(b''.join(response.streaming_content))), 34)
+
+    def test_arrow_round_trip(self):
+        import io
+        from api.services import export
+
+        if export.pyarrow is None:
+            self.skipTest('pyarrow is not installed')
+        columns = ['IMEI', 'Latitude', 'Longitude', 'Heart Unix', 'Heart Date', 'Heart Time']
+        expected = self.expected()
+
+        response, data = self.export(format='parquet')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.parquet')
+        parquet = export.pyarrow.parquet.ParquetFile(io.BytesIO(data))
+        self.assertEqual(parquet.metadata.num_row_groups, 3)
+        table = parquet.read(columns=columns)
+        self.assertEqual(list(zip(*(table.column(name).to_pylist() for name in columns))), expected)
+
+        response, data = self.export(format='arrow')
+        table = export.pyarrow.ipc.open_stream(data).read_all().select(columns)
+        self.assertEqual(list(zip(*(table.column(name).to_pylist() for name in columns))), expected)
+
+
+def live_event(delta_id, devices=(), transitions=(), stats_delta=None, resync=False):
+    """A live-update event as the hub queues it"""
+    return {
+        'id': delta_id,
+        'version': delta_id + 100,
+        'resync': resync,
+        'devices': [{'imei': imei, 'datastatus': datastatus} for imei, datastatus in devices],
+        'transitions': [{'imei': imei, 'from': start, 'to': end} for imei, start, end in transitions],
+        'stats': {'total_devices': delta_id},
+        'stats_delta': stats_delta or {'total_devices': 0, 'with_coordinates': 0, 'status_counts': {}},
+        'coalesced': 1,
+    }
+
+
+class LiveUpdateTests(TestCase):
+    def test_merge_events(self):
+        from api.services.live_updates import merge_events
+
+        first = live_event(1, devices=[('a', 2), ('b', 4)], transitions=[('a', 4, 2), ('b', 2, 4)],
+                           stats_delta={'total_devices': 1, 'with_coordinates': 1,
+                                        'status_counts': {'Online': 1, 'Offline': 0}})
+        second = live_event(2, devices=[('b', 2), ('c', 4)], transitions=[('b', 4, 2), ('c', None, 4)],
+                            stats_delta={'total_devices': 1, 'with_coordinates': 0,
+                                         'status_counts': {'Online': -1, 'Offline': 1}})
+        merged = merge_events(first, second)
+        self.assertEqual((merged['id'], merged['version'], merged['stats'], merged['coalesced']),
+                         (2, 102, {'total_devices': 2}, 2))
+        # Last state per device; b went Offline and back, so only a and c transitioned
+        self.assertEqual(merged['devices'], [{'imei': 'a', 'datastatus': 2}, {'imei': 'b', 'datastatus': 2},
+                                             {'imei': 'c', 'datastatus': 4}])
+        self.assertEqual(merged['transitions'], [{'imei': 'a', 'from': 4, 'to': 2}, {'imei': 'c', 'from': None, 'to': 4}])
+        self.assertEqual(merged['stats_delta'], {'total_devices': 2, 'with_coordinates': 1,
+                                                 'status_counts': {'Offline': 1}})
+
+        resync = merge_events(merged, live_event(3, resync=True))
+        self.assertEqual((resync['resync'], resync['devices'], resync['transitions'], resync['coalesced']),
+                         (True, [], [], 3))
+        self.assertTrue(merge_events(resync, live_event(4, devices=[('d', 2)]))['resync'])
+
+    def test_merge_past_delta_limit_becomes_resync(self):
+        from api.services.live_updates import merge_events
+
+        with mock.patch('api.services.live_updates.MAX_DELTA_DEVICES', 2):
+            merged = merge_events(live_event(1, devices=[('a', 2), ('b', 2)]), live_event(2, devices=[('c', 2)]))
+        self.assertEqual((merged['resync'], merged['devices'], merged['transitions']), (True, [], []))
+
+    def test_full_queue_is_coalesced(self):
+        from api.services.live_updates import Subscriber
+
+        subscriber = Subscriber(maxsize=3)
+        for delta_id in range(1, 6):
+            subscriber.push(live_event(delta_id, devices=[(f'imei{delta_id % 2}', delta_id)]))
+        queued = [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+        # 1-3 filled the queue; 4 folded them into one event, 5 was queued behind it
+        self.assertEqual([(event['id'], event['coalesced']) for event in queued], [(4, 4), (5, 1)])
+        self.assertEqual(queued[0]['devices'], [{'imei': 'imei1', 'datastatus': 3}, {'imei': 'imei0', 'datastatus': 4}])
+
+    def test_delta_carries_heartbeat_date_and_time(self):
+        from django.utils import timezone
+        from api.models import SnapshotDelta
+        from api.services.device_loader import build_device_row
+        from api.services.live_updates import record_delta
+
+        row = build_device_row(tracking_record(1, 1748781045), timezone.now())
+        record_delta([row], {row['imei']: None})
+        device, = SnapshotDelta.objects.get().payload['devices']
+        self.assertEqual((device['hearttime_date'], device['hearttime_time'], device['hearttime_unix']),
+                         ('2025-06-01', '19:30:45', 1748781045))
+
+
+class LiveReplayTests(TransactionTestCase):
+    def store(self, delta_id, imei):
+        from api.models import SnapshotDelta
+
+        payload = live_event(delta_id, devices=[(imei, 2)])
+        del payload['id'], payload['version'], payload['coalesced']
+        SnapshotDelta.objects.create(id=delta_id, version=delta_id, payload=payload)
+
+    def reconnect(self, last_event_id):
+        """(id, event type, data) of what a client reconnecting with Last-Event-ID gets before live deltas"""
+        import json
+        from api.services.live_updates import event_stream
+
+        async def read():
+            stream = event_stream(last_event_id)
+            try:
+                retry, snapshot = await stream.__anext__(), await stream.__anext__()
+                self.assertTrue(retry.startswith(b'retry:') and snapshot.startswith(b'event: snapshot'))
+                # Nothing new arrives, so the first heartbeat ends the replay
+                messages = []
+                with mock.patch('api.services.live_updates.LIVE_HEARTBEAT_SECONDS', 0.01):
+                    while not (message := await stream.__anext__()).startswith(b': ping'):
+                        messages.append(message)
+                return messages
+            finally:
+                await stream.aclose()
+
+        events = []
+        for message in asyncio.run(read()):
+            fields = dict(line.split(': ', 1) for line in message.decode().strip().split('\n'))
+            events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+        return events
+
+    def test_missed_deltas_are_replayed_across_id_gaps(self):
+        for delta_id, imei in [(1, 'a'), (2, 'b'), (5, 'c'), (9, 'd')]:
+            self.store(delta_id, imei)
+        (event_id, event_type, data), = self.reconnect('2')
+        self.assertEqual((event_id, event_type, data['coalesced']), (9, 'delta', 2))
+        self.assertEqual([device['imei'] for device in data['devices']], ['c', 'd'])
+        self.assertEqual(self.reconnect('9'), [])
+
+    def test_pruned_deltas_force_a_resync(self):
+        from api.models import SnapshotDelta
+
+        for delta_id, imei in [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')]:
+            self.store(delta_id, imei)
+        SnapshotDelta.objects.filter(id__lte=2).delete()
+        (event_id, event_type, data), = self.reconnect('1')
+        self.assertEqual((event_id, event_type, data['resync'], data['devices']), (4, 'resync', True, []))
+        # Still holding the oldest kept delta: nothing was lost
+        (event_id, event_type, data), = self.reconnect('3')
+        self.assertEqual((event_id, event_type), (4, 'delta'))
+
+
+class TrackDaemonTests(TestCase):
+    interval = 60.0
+
+    def run_daemon(self, cycles, max_cycles=0, imei_lists=(['a', 'b'],)):
+        """Run the daemon against a fake clock; each of ``cycles`` is a duration in seconds,
+        an exception to raise or a callable run inside the cycle. Returns (starts, waits, cycle IMEIs, output)"""
+        import io
+        from api.management.commands.track_daemon import Command
+
+        now = [1000.0]
+        starts, waits, cycle_imeis = [], [], []
+        cycles = iter(cycles)
+
+        async def refresh(imeis, **kwargs):
+            starts.append(now[0])
+            cycle_imeis.append(imeis)
+            step = next(cycles)
+            if isinstance(step, Exception):
+                raise step
+            if callable(step):
+                step()
+            else:
+                now[0] += step
+            return {**dict.fromkeys(['records', 'changed', 'created', 'updated', 'unchanged', 'errors', 'appended'], 0),
+                    'elapsed': 0.0}
+
+        async def wait_for_tick(stop, timeout):
+            waits.append(timeout)
+            # Yield to the loop so pending signal handlers run
+            await asyncio.sleep(0.01)
+            if not stop.is_set():
+                now[0] += timeout
+
+        command = Command(stdout=io.StringIO())
+        command.clock = lambda: now[0]
+        command.wait_for_tick = wait_for_tick
+        command.load_imeis = mock.Mock(side_effect=list(imei_lists))
+        options = {'interval': self.interval, 'imei_file': 'MAIN.csv', 'max_cycles': max_cycles,
+                   'endpoint': None, 'archive': False}
+        with mock.patch('api.services.refresh_pipeline.refresh_tracking_data_async', side_effect=refresh):
+            asyncio.run(command.run_daemon(options))
+        return starts, waits, cycle_imeis, command.stdout.getvalue()
+
+    def test_cycles_start_on_absolute_ticks(self):
+        starts, waits, _, output = self.run_daemon([10, 20, 59], max_cycles=3)
+        # Cycle time is absorbed by the wait, so starts do not drift
+        self.assertEqual(starts, [1000, 1060, 1120])
+        self.assertEqual(waits, [50, 40])
+        self.assertIn('Cycle 3: 0 records', output)
+        self.assertNotIn('skipped', output)
+
+    def test_overrunning_cycle_skips_missed_ticks(self):
+        starts, waits, _, output = self.run_daemon([130, 10], max_cycles=2)
+        self.assertEqual(starts, [1000, 1180])
+        self.assertEqual(waits, [50])
+        self.assertIn('Cycle 1 took 130.0s (> 60s), skipped 2 tick(s)', output)
+
+    def test_failed_cycle_does_not_stop_the_daemon(self):
+        starts, _, _, output = self.run_daemon([RuntimeError('upstream down'), 5, 5], max_cycles=3)
+        self.assertEqual(starts, [1000, 1060, 1120])
+        self.assertIn('Cycle 1 failed: upstream down', output)
+        self.assertIn('Cycle 2: 0 records', output)
+        self.assertIn('stopped after 3 cycle(s)', output)
+
+    def test_sighup_reloads_imeis_and_sigterm_stops(self):
+        import os
+        import signal
+
+        def send(sig):
+            return lambda: os.kill(os.getpid(), sig)
+
+        starts, waits, cycle_imeis, output = self.run_daemon(
+            [send(signal.SIGHUP), send(signal.SIGTERM)], imei_lists=(['a', 'b'], ['c']),
+        )
+        self.assertEqual(cycle_imeis, [['a', 'b'], ['c']])
+        self.assertIn('Reloaded 1 IMEIs', output)
+        # The stop ends the wait after the running cycle instead of starting another
+        self.assertEqual(len(starts), 2)
+        self.assertIn('SIGTERM received', output)
+        self.assertIn('stopped after 2 cycle(s)', output)
@@ -5,9 +5,23 @@ app_name = 'api'
 
 urlpatterns = [
     path('devices/', views.get_device_data, name='get_device_data'),
+    path('devices/query/', views.query_devices, name='query_devices'),
+    path('devices/lookup/', views.lookup_devices, name='lookup_devices'),
+    path('devices/bbox/', views.get_devices_in_bbox, name='get_devices_in_bbox'),
+    path('devices/nearest/', views.get_nearest_devices, name='get_nearest_devices'),
+    path('devices/clusters/', views.get_device_clusters, name='get_device_clusters'),
+    path('tiles/', views.get_tilejson, name='get_tilejson'),
+    path('tiles/<int:zoom>/<int:x>/<int:y>.mvt', views.get_device_tile, name='get_device_tile'),
+    path('devices/<str:imei>/history/', views.get_device_history, name='get_device_history'),
     path('fetch-tracking/', views.fetch_tracking_data, name='fetch_tracking_data'),
     path('load-database/', views.load_to_database, name='load_to_database'),
+    path('refresh/', views.refresh_tracking_data, name='refresh_tracking_data'),
+    path('jobs/<uuid:job_id>/', views.get_job_status, name='get_job_status'),
     path('export-csv/', views.export_to_csv, name='export_to_csv'),
     path('stats/', views.get_stats, name='get_stats'),
+    path('geofences/', views.geofences, name='geofences'),
+    path('geofences/events/', views.get_geofence_events, name='get_geofence_events'),
+    path('geofences/<int:geofence_id>/', views.geofence_detail, name='geofence_detail'),
     path('logs/', views.get_recent_logs, name='get_recent_logs'),
+    path('live/', views.live_updates, name='live_updates'),
 ]
\ No newline at end of file
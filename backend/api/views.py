@@ -1,139 +1,449 @@
-from django.http import JsonResponse, HttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.core.paginator import Paginator
-from django.core.management import call_command
 from django.conf import settings
 import json
-import csv
 import os
 import subprocess
 from datetime import datetime
 from .models import DeviceData
-from datetime import timezone, timedelta
+from .services.response_cache import snapshot_conditional
+from .services.response_encoding import compress_response, fast_json_response
+from datetime import timezone
 import math
 
-def get_relative_short_label(unix_timestamp):
-    if not unix_timestamp or str(unix_timestamp) in ['', '0', 'None', 'null']:
-        return ''
-    try:
-        ts = int(unix_timestamp)
-        ts_dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-        mins = int((datetime.now(timezone.utc) - ts_dt).total_seconds() // 60)
-        mins_in_year = 365 * 24 * 60
-        mins_in_month = 30 * 24 * 60
-        mins_in_day = 24 * 60
-        if mins >= mins_in_year:
-            return f"{mins // mins_in_year}y ago"
-        if mins >= mins_in_month:
-            return f"{mins // mins_in_month}m ago"
-        if mins >= mins_in_day:
-            return f"{mins // mins_in_day}d ago"
-        if mins >= 60:
-            return f"{mins // 60}h ago"
-        return f"{mins}min ago"
-    except Exception:
-        return ''
-from datetime import timezone, timedelta
-
 
 @csrf_exempt
 @require_http_methods(["GET"])
+@compress_response
+@snapshot_conditional(time_labels=True)
 def get_device_data(request):
-    """Get paginated device data"""
+    """Get paginated device data.
+
+    ``?page=`` pages with OFFSET and an exact count. Passing ``?cursor=``
+    (empty for the first page, then the previous ``next_cursor``) switches to
+    keyset pagination on ranking_id with the loader-maintained total, which
+    keeps deep pages as cheap as the first. Pages are cached per snapshot;
+    the relative-time labels are filled in per request. ``?fields=`` and
+    ``?layout=columns`` trim the records (see device_list.parse_projection).
+    """
     try:
-        page = int(request.GET.get('page', 1))
+        from api.services.device_list import (
+            DEVICE_LIST_FIELDS, MAX_PER_PAGE, get_device_page_after, parse_cursor, parse_projection,
+            serialize_device_rows, shape_devices,
+        )
+        from api.services.response_cache import cached_payload, label_time
+
+        try:
+            fields, columnar = parse_projection(request.GET)
+        except ValueError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
         per_page = int(request.GET.get('per_page', 50))
-        
-        # Get all device data ordered by ranking_id
-        devices = DeviceData.objects.all().order_by('ranking_id')
-        
-        # Paginate
-        paginator = Paginator(devices, per_page)
-        page_obj = paginator.get_page(page)
-        
-        # Helper to format time since using hearttime_unix
-        def format_time_since(unix_timestamp):
-            if not unix_timestamp or unix_timestamp in ["", "0", 0, None]:
-                return ""
-            try:
-                ts_dt = datetime.fromtimestamp(int(unix_timestamp), tz=timezone.utc)
-                now = datetime.now(timezone.utc)
-                delta = now - ts_dt
-                days = delta.days
-                hours = delta.seconds // 3600
-                minutes = (delta.seconds % 3600) // 60
-                return f"{days}d{hours}h{minutes}min"
-            except Exception:
-                return ""
-
-        # Convert to list of dictionaries
-        data = []
-        for device in page_obj:
-            data.append({
-                'ranking_id': device.ranking_id,
-                'imei': device.imei,
-                'latitude': float(device.latitude),
-                'longitude': float(device.longitude),
-                'coordinates': device.coordinates,
-                'datastatus': device.datastatus,
-                'datastatus_description': device.datastatus_description,
-                'hearttime_date': device.hearttime_date.strftime('%Y-%m-%d') if device.hearttime_date else '',
-                'hearttime_time': device.hearttime_time.strftime('%H:%M:%S') if device.hearttime_time else '',
-                'hearttime_unix': device.hearttime_unix,
-                # New field: TimeSinceUpdate (detailed) and TimeAgo (compact)
-                'TimeSinceUpdate': format_time_since(device.hearttime_unix) or '',
-                'TimeAgo': get_relative_short_label(device.hearttime_unix) or '',
-                'status': device.status,
-                'created_at': device.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                'updated_at': device.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-            })
-        
-        return JsonResponse({
+
+        if 'cursor' in request.GET:
+            cursor = request.GET['cursor']
+            per_page = min(max(per_page, 1), MAX_PER_PAGE)
+            after = parse_cursor(cursor)
+
+            def build_cursor_page():
+                from api.services.fleet_stats import get_fleet_stats
+
+                data, next_cursor = get_device_page_after(after, per_page)
+                total_records = get_fleet_stats()['total_devices']
+                return {
+                    'data': data,
+                    'pagination': {
+                        # Keyset pages have no position to report
+                        'current_page': None,
+                        'total_pages': max(1, math.ceil(total_records / per_page)),
+                        'total_records': total_records,
+                        'per_page': per_page,
+                        'has_next': next_cursor is not None,
+                        'has_previous': bool(cursor),
+                        'next_cursor': next_cursor,
+                    }
+                }
+
+            payload = cached_payload('devices_cursor', (after, per_page), build_cursor_page)
+        else:
+            page = int(request.GET.get('page', 1))
+
+            def build_page():
+                # Get all device data ordered by ranking_id
+                devices = DeviceData.objects.order_by('ranking_id').values_list(*DEVICE_LIST_FIELDS)
+
+                # Paginate
+                paginator = Paginator(devices, per_page)
+                page_obj = paginator.get_page(page)
+                data = serialize_device_rows(page_obj)
+                return {
+                    'data': data,
+                    'pagination': {
+                        'current_page': page_obj.number,
+                        'total_pages': paginator.num_pages,
+                        'total_records': paginator.count,
+                        'per_page': per_page,
+                        'has_next': page_obj.has_next(),
+                        'has_previous': page_obj.has_previous(),
+                        'next_cursor': str(data[-1]['ranking_id']) if data and page_obj.has_next() else None,
+                    }
+                }
+
+            payload = cached_payload('devices_page', (page, per_page), build_page)
+
+        return fast_json_response({
             'success': True,
-            'data': data,
+            **shape_devices(payload['data'], fields, columnar, label_time()),
+            'pagination': payload['pagination'],
+        })
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'page, per_page and cursor must be integers'}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@compress_response
+@snapshot_conditional(time_labels=True)
+def query_devices(request):
+    """Devices matching filters, e.g. ``?stale_minutes=10080`` for those offline more than 7 days.
+
+    Filters: ``datastatus`` (codes), ``status`` (descriptions),
+    ``stale_minutes`` / ``fresh_minutes``, ``imei_prefix`` and
+    ``has_coordinates``; all are combined with AND and evaluated on indexes.
+    Devices come longest silent first, keyset-paginated with ``per_page``
+    and ``cursor`` (the previous ``next_cursor``); the first page also
+    carries the number of matches. Takes ``?fields=`` and ``?layout=`` like
+    ``/api/devices/``.
+    """
+    try:
+        from api.services.device_list import MAX_PER_PAGE, parse_projection, shape_devices
+        from api.services.device_query import (
+            count_devices, filter_cache_key, parse_device_filters, parse_query_cursor, query_device_page,
+        )
+        from api.services.response_cache import cached_payload, label_time
+
+        filters = parse_device_filters(request.GET)
+        fields, columnar = parse_projection(request.GET)
+        cursor = request.GET.get('cursor', '')
+        after = parse_query_cursor(cursor)
+        try:
+            per_page = min(max(int(request.GET.get('per_page', 50)), 1), MAX_PER_PAGE)
+        except ValueError:
+            raise ValueError('per_page must be an integer')
+        now = label_time()
+
+        def build_results():
+            data, next_cursor = query_device_page(filters, now, after, per_page)
+            return {
+                'data': data,
+                'count': count_devices(filters, now) if after is None else None,
+                'next_cursor': next_cursor,
+            }
+
+        payload = cached_payload('devices_query', (filter_cache_key(filters, now), after, per_page), build_results)
+        return fast_json_response({
+            'success': True,
+            **shape_devices(payload['data'], fields, columnar, now),
+            'count': payload['count'],
             'pagination': {
-                'current_page': page_obj.number,
-                'total_pages': paginator.num_pages,
-                'total_records': paginator.count,
                 'per_page': per_page,
-                'has_next': page_obj.has_next(),
-                'has_previous': page_obj.has_previous(),
-            }
+                'has_next': payload['next_cursor'] is not None,
+                'has_previous': bool(cursor),
+                'next_cursor': payload['next_cursor'],
+            },
+            'filters': filters,
+        })
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@compress_response
+@snapshot_conditional(time_labels=True)
+def get_devices_in_bbox(request):
+    """Devices inside a map viewport: ``?min_lat=&min_lon=&max_lat=&max_lon=`` (edges included).
+
+    Resolved through the indexed grid_cell column, then filtered exactly on
+    latitude/longitude. Devices without a position (0,0) are left out.
+    ``?limit=`` caps the result (``truncated`` says when it did);
+    ``?fields=`` and ``?layout=`` work as for ``/api/devices/``.
+    """
+    try:
+        from api.services.device_list import parse_projection, shape_devices
+        from api.services.response_cache import cached_payload, label_time
+        from api.services.spatial import MAX_BBOX_DEVICES, devices_in_bbox, parse_bbox
+
+        bbox = parse_bbox(request.GET)
+        fields, columnar = parse_projection(request.GET)
+        try:
+            limit = min(max(int(request.GET.get('limit', MAX_BBOX_DEVICES)), 1), MAX_BBOX_DEVICES)
+        except ValueError:
+            raise ValueError('limit must be an integer')
+
+        def build_results():
+            data, truncated = devices_in_bbox(bbox, limit)
+            return {'data': data, 'truncated': truncated}
+
+        payload = cached_payload('devices_bbox', (bbox, limit), build_results)
+        return fast_json_response({
+            'success': True,
+            'count': len(payload['data']),
+            **shape_devices(payload['data'], fields, columnar, label_time()),
+            'truncated': payload['truncated'],
+        })
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@compress_response
+@snapshot_conditional(time_labels=True)
+def get_nearest_devices(request):
+    """The ``k`` devices closest to ``?lat=&lon=`` by great-circle distance, closest first.
+
+    Answered from the per-process KD-tree of current positions (rebuilt when
+    the snapshot changes); ``?max_km=`` limits the search radius. Every
+    record carries ``distance_km``; ``?fields=`` and ``?layout=`` work as
+    for ``/api/devices/``.
+    """
+    try:
+        from api.services.device_list import DEVICE_RECORD_FIELDS, parse_projection, shape_devices
+        from api.services.nearest import get_position_index, parse_nearest_params
+        from api.services.response_cache import label_time
+
+        latitude, longitude, k, max_km = parse_nearest_params(request.GET)
+        fields, columnar = parse_projection(request.GET)
+
+        data = get_position_index().nearest(latitude, longitude, k, max_km)
+        return fast_json_response({
+            'success': True,
+            'count': len(data),
+            **shape_devices(data, (fields or DEVICE_RECORD_FIELDS) + ['distance_km'], columnar, label_time()),
         })
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@compress_response
+@snapshot_conditional()
+def get_device_clusters(request):
+    """Device clusters for a map view: ``?zoom=&bbox=west,south,east,north``.
+
+    Devices are grouped per grid cell of 64 screen pixels at ``zoom`` over
+    the map tiles covering ``bbox`` (the whole world without it). Each
+    cluster has its centroid, ``count`` and ``statuses`` (devices per
+    datastatus_description); single devices also carry their ``imei``. The
+    clusters of every tile are cached per snapshot, so panning only builds
+    the tiles that came into view.
+    """
+    try:
+        from api.services.clusters import cluster_tiles, cluster_zoom, get_cluster_index, parse_cluster_params
+        from api.services.response_cache import cached_payload
+
+        zoom, bbox = parse_cluster_params(request.GET)
+        level = cluster_zoom(zoom)
+        tiles = cluster_tiles(level, bbox)
+
+        index = get_cluster_index()
+        data = []
+        for x, y in tiles:
+            # Keyed by the index version too: a stale index still serving during a rebuild
+            # must not fill the entries of the new snapshot
+            data.extend(cached_payload('device_clusters', (index.version, level, x, y),
+                                       lambda: index.tile_clusters(level, x, y)))
+        return fast_json_response({
+            'success': True,
+            'zoom': zoom,
+            'cluster_zoom': level,
+            'tiles': len(tiles),
+            'count': len(data),
+            'devices': sum(cluster['count'] for cluster in data),
+            'data': data,
+        })
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def get_tilejson(request):
+    """TileJSON for the device vector tiles; its tile URL carries the pyramid version.
+
+    Map clients load this first and then request tiles through the
+    versioned URL, which can be cached forever: a load that changes any
+    tile moves the version on.
+    """
+    try:
+        from django.urls import reverse
+        from django.utils.cache import patch_cache_control
+        from api.services.vector_tiles import ATTRIBUTES, LAYER_NAME, MAX_TILE_ZOOM, MIN_TILE_ZOOM, get_tile_version
+
+        version = get_tile_version()
+        response = JsonResponse({
+            'tilejson': '3.0.0',
+            'name': 'GPS devices',
+            'version': f'1.0.{version}',
+            'scheme': 'xyz',
+            'tiles': [request.build_absolute_uri(reverse('api:get_tilejson')) + '{z}/{x}/{y}.mvt' + f'?v={version}'],
+            'minzoom': MIN_TILE_ZOOM,
+            'maxzoom': MAX_TILE_ZOOM,
+            'vector_layers': [{
+                'id': LAYER_NAME,
+                'fields': {name: 'Number' for name in ATTRIBUTES},
+                'minzoom': MIN_TILE_ZOOM,
+                'maxzoom': MAX_TILE_ZOOM,
+            }],
+        })
+        patch_cache_control(response, no_cache=True)
+        return response
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+@compress_response
+def get_device_tile(request, zoom, x, y):
+    """Mapbox Vector Tile of the device layer at ``zoom/x/y`` (see api.services.vector_tiles).
+
+    With ``?v=`` equal to the current pyramid version (as in the TileJSON
+    tile URL) the tile is served as public and immutable for a year.
+    Otherwise it is served with its ETag (the version it was last encoded
+    at) for revalidation, so unchanged tiles answer 304 across loads.
+    Tiles that never held a device are 204 No Content.
+    """
+    try:
+        from django.utils.cache import get_conditional_response, patch_cache_control
+        from api.services.vector_tiles import MVT_CONTENT_TYPE, get_tile, get_tile_version, parse_tile_address
+
+        parse_tile_address(zoom, x, y)
+        tile = get_tile(zoom, x, y)
+        immutable = 'v' in request.GET and request.GET['v'] == str(get_tile_version())
+
+        if tile is None:
+            response = HttpResponse(status=204)
+        else:
+            data, version = tile
+            etag = f'"t{version}"'
+            response = get_conditional_response(request, etag=etag) or HttpResponse(data, content_type=MVT_CONTENT_TYPE)
+            response.headers['ETag'] = etag
+        if immutable:
+            patch_cache_control(response, public=True, max_age=365 * 86400, immutable=True)
+        else:
+            patch_cache_control(response, public=True, no_cache=True)
+        return response
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=404)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def fetch_tracking_data(request):
-    """Fetch new GPS tracking data from API"""
+@compress_response
+def lookup_devices(request):
+    """Current records of many devices at once: POST ``{"imeis": [...]}`` (up to MAX_LOOKUP_IMEIS).
+
+    Answered from the per-process fleet index when it is current, otherwise
+    by chunked ``imei__in`` queries. Records come back in request order;
+    unknown IMEIs are listed under ``missing``. ``?fields=`` and ``?layout=``
+    in the URL work as for ``/api/devices/``.
+    """
     try:
-        # Run the management command
-        call_command('fetch_tracking_data')
-        
-        # Get the latest response log folder
-        response_logs_dir = os.path.join(settings.BASE_DIR, 'response_logs')
-        if os.path.exists(response_logs_dir):
-            folders = [f for f in os.listdir(response_logs_dir) if f.startswith('tracking_run_')]
-            if folders:
-                latest_folder = sorted(folders)[-1]
-                json_file = os.path.join(response_logs_dir, latest_folder, 'all_records.json')
-                
-                return JsonResponse({
-                    'success': True,
-                    'message': 'GPS tracking data fetched successfully',
-                    'json_file': json_file,
-                    'folder': latest_folder
-                })
-        
-        return JsonResponse({
+        from api.services.device_list import parse_projection, shape_devices
+        from api.services.fleet_index import MAX_LOOKUP_IMEIS, lookup_devices as lookup
+        from api.services.response_cache import label_time
+
+        try:
+            imeis = json.loads(request.body).get('imeis')
+        except (ValueError, AttributeError):
+            imeis = None
+        if not isinstance(imeis, list) or not all(isinstance(imei, str) for imei in imeis):
+            return JsonResponse({'success': False, 'error': 'Body must be {"imeis": [IMEI strings]}'}, status=400)
+        if len(imeis) > MAX_LOOKUP_IMEIS:
+            return JsonResponse(
+                {'success': False, 'error': f'At most {MAX_LOOKUP_IMEIS} IMEIs per request'}, status=400,
+            )
+
+        try:
+            fields, columnar = parse_projection(request.GET)
+        except ValueError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+        records, missing, source = lookup(imei.strip() for imei in imeis)
+        return fast_json_response({
             'success': True,
-            'message': 'GPS tracking data fetched successfully',
-            'json_file': None
+            'count': len(records),
+            **shape_devices(records, fields, columnar, label_time()),
+            'missing': missing,
+            'source': source,
         })
-        
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+def job_response(job, created):
+    """202 response for a queued (or already running, deduplicated) background job"""
+    return JsonResponse({
+        'success': True,
+        'message': 'Job queued' if created else 'A matching job is already running',
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'deduplicated': not created,
+        'status_url': f'/api/jobs/{job.id}/',
+    }, status=202)
+
+
+@require_http_methods(["GET"])
+def get_device_history(request, imei):
+    """Track history of one device from PositionHistory (?since=&until= unix seconds, ?limit=)"""
+    try:
+        from api.services.position_history import get_position_history
+
+        since = request.GET.get('since')
+        until = request.GET.get('until')
+        limit = min(int(request.GET.get('limit', 1000)), 10000)
+        positions = get_position_history(
+            imei,
+            since=int(since) if since else None,
+            until=int(until) if until else None,
+            limit=limit,
+        )
+        return JsonResponse({'success': True, 'imei': imei, 'count': len(positions), 'data': positions})
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'since, until and limit must be integers'}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def fetch_tracking_data(request):
+    """Start fetching new GPS tracking data from API in the background"""
+    try:
+        from api.services.jobs import UPSTREAM_FETCH_KEY, submit_job
+
+        job, created = submit_job('fetch_tracking', dedupe_key=UPSTREAM_FETCH_KEY)
+        return job_response(job, created)
+
     except Exception as e:
         import traceback
         error_details = {
@@ -146,32 +456,24 @@ def fetch_tracking_data(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def load_to_database(request):
-    """Load JSON data to database"""
+    """Start loading JSON data to database in the background"""
     try:
+        from api.services.jobs import submit_job
+
         data = json.loads(request.body)
         json_file = data.get('json_file')
         clear_existing = data.get('clear_existing', False)
         
         if not json_file or not os.path.exists(json_file):
             return JsonResponse({'success': False, 'error': 'JSON file not found'}, status=400)
+
+        job, created = submit_job(
+            'load_database',
+            params={'json_file': json_file, 'clear_existing': bool(clear_existing)},
+            dedupe_key=json_file,
+        )
+        return job_response(job, created)
         
-        # Build command arguments
-        cmd_args = ['load_device_data', json_file]
-        if clear_existing:
-            cmd_args.append('--clear-existing')
-        
-        # Run the management command
-        call_command(*cmd_args)
-        
-        # Get updated statistics
-        total_records = DeviceData.objects.count()
-        
-        return JsonResponse({
-            'success': True,
-            'message': f'Data loaded successfully. Total records: {total_records}',
-            'total_records': total_records
-        })
-        
     except Exception as e:
         import traceback
         error_details = {
@@ -181,131 +483,209 @@ def load_to_database(request):
         return JsonResponse({'success': False, 'error': error_details}, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def refresh_tracking_data(request):
+    """Start fetching GPS tracking data and loading it straight into the database"""
+    try:
+        from api.services.jobs import UPSTREAM_FETCH_KEY, submit_job
+
+        data = json.loads(request.body) if request.body else {}
+        job, created = submit_job('refresh', params={
+            'imei_file': data.get('imei_file', 'MAIN.csv'),
+            'archive': bool(data.get('archive', True)),
+        }, dedupe_key=UPSTREAM_FETCH_KEY)
+        return job_response(job, created)
+
+    except Exception as e:
+        import traceback
+        error_details = {
+            'error': str(e),
+            'traceback': traceback.format_exc()
+        }
+        return JsonResponse({'success': False, 'error': error_details}, status=500)
+
+
+@require_http_methods(["GET"])
+def get_job_status(request, job_id):
+    """Status and progress of a background job"""
+    try:
+        from api.models import Job
+        from api.services.jobs import job_to_dict
+
+        job = Job.objects.filter(pk=job_id).first()
+        if job is None:
+            return JsonResponse({'success': False, 'error': 'Job not found'}, status=404)
+        return JsonResponse({'success': True, 'job': job_to_dict(job)})
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
+@snapshot_conditional(time_labels=True)
 def export_to_csv(request):
-    """Export all device data to CSV"""
+    """Stream device data (or ``?dataset=history``) as CSV, gzip'd CSV, Parquet or Arrow.
+
+    Query parameters: ``format`` (csv, parquet, arrow), ``compress=gzip``,
+    and filters applied in SQL: ``status``, ``stale_minutes``,
+    ``fresh_minutes`` for devices; ``imei``, ``since``, ``until`` for history.
+    """
     try:
-        # Create CSV response
-        response = HttpResponse(content_type='text/csv')
+        from api.services.export import build_export, iterate_in_thread
+        from api.services.response_cache import label_time
+
+        chunks, content_type, extension = build_export(request.GET, label_time())
+        if isinstance(request, ASGIRequest):
+            # Django would otherwise read a sync iterator into memory before sending it
+            chunks = iterate_in_thread(chunks)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        response['Content-Disposition'] = f'attachment; filename="gps_tracking_data_{timestamp}.csv"'
-        
-        # Create CSV writer
-        writer = csv.writer(response)
-        
-        # Helpers to format relative/detailed strings from hearttime_unix
-        def format_time_since(unix_timestamp):
-            if not unix_timestamp or str(unix_timestamp) in ['', '0', 'None', 'null']:
-                return ''
-            try:
-                ts = int(unix_timestamp)
-                ts_dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-                now = datetime.now(timezone.utc)
-                delta = now - ts_dt
-                days = delta.days
-                hours = delta.seconds // 3600
-                minutes = (delta.seconds % 3600) // 60
-                return f"{days}d{hours}h{minutes}min"
-            except Exception:
-                return ''
-
-        def get_relative_short_label(unix_timestamp):
-            if not unix_timestamp or str(unix_timestamp) in ['', '0', 'None', 'null']:
-                return ''
-            try:
-                mins = None
-                ts = int(unix_timestamp)
-                ts_dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-                now = datetime.now(timezone.utc)
-                mins = int((now - ts_dt).total_seconds() // 60)
-                mins_in_year = 365 * 24 * 60
-                mins_in_month = 30 * 24 * 60
-                mins_in_day = 24 * 60
-                if mins >= mins_in_year:
-                    return f"{mins // mins_in_year}y ago"
-                if mins >= mins_in_month:
-                    return f"{mins // mins_in_month}m ago"
-                if mins >= mins_in_day:
-                    return f"{mins // mins_in_day}d ago"
-                if mins >= 60:
-                    return f"{mins // 60}h ago"
-                return f"{mins}min ago"
-            except Exception:
-                return ''
-
-        # Write header (added TimeSinceUpdate and TimeAgo)
-        writer.writerow([
-            'Ranking ID', 'IMEI', 'Latitude', 'Longitude', 'Coordinates',
-            'Data Status Code', 'Data Status', 'Heart Date', 'Heart Time',
-            'Heart Unix', 'TimeSinceUpdate', 'TimeAgo', 'Status', 'Created At', 'Updated At'
-        ])
-        
-        # Write data
-        devices = DeviceData.objects.all().order_by('ranking_id')
-        for device in devices:
-            relative_detailed = format_time_since(device.hearttime_unix)
-            relative_short = get_relative_short_label(device.hearttime_unix)
-            writer.writerow([
-                device.ranking_id,
-                device.imei,
-                device.latitude,
-                device.longitude,
-                device.coordinates,
-                device.datastatus,
-                device.datastatus_description,
-                device.hearttime_date.strftime('%Y-%m-%d') if device.hearttime_date else '',
-                device.hearttime_time.strftime('%H:%M:%S') if device.hearttime_time else '',
-                device.hearttime_unix,
-                relative_detailed,
-                relative_short,
-                device.status,
-                device.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                device.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-            ])
-        
+        response['Content-Disposition'] = f'attachment; filename="gps_tracking_data_{timestamp}.{extension}"'
         return response
-        
+
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def geofences(request):
+    """List geofences with their current member counts, or create one.
+
+    POST ``{"name", "kind": "polygon", "points": [[lat, lon], ...]}`` or
+    ``{"name", "kind": "circle", "center_latitude", "center_longitude",
+    "radius_m"}``. Fences are evaluated after every load; the first
+    evaluation records the devices already inside without events.
+    """
+    try:
+        from django.db.models import Count
+
+        from api.models import Geofence
+        from api.services.geofences import parse_geofence, serialize_geofence
+
+        if request.method == 'POST':
+            try:
+                data = json.loads(request.body)
+                fence = Geofence.objects.create(**parse_geofence(data if isinstance(data, dict) else {}))
+            except ValueError as e:
+                return JsonResponse({'success': False, 'error': str(e)}, status=400)
+            return JsonResponse({'success': True, 'data': serialize_geofence(fence)}, status=201)
+
+        fences = Geofence.objects.annotate(members=Count('memberships')).order_by('id')
+        return JsonResponse({
+            'success': True,
+            'data': [serialize_geofence(fence, fence.members) for fence in fences],
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET", "DELETE"])
+def geofence_detail(request, geofence_id):
+    """One geofence with the IMEIs currently inside it, or delete it (with its events)"""
+    try:
+        from api.models import Geofence
+        from api.services.geofences import serialize_geofence
+
+        fence = Geofence.objects.filter(id=geofence_id).first()
+        if fence is None:
+            return JsonResponse({'success': False, 'error': 'Geofence not found'}, status=404)
+        if request.method == 'DELETE':
+            fence.delete()
+            return JsonResponse({'success': True})
+
+        members = list(fence.memberships.order_by('imei').values_list('imei', flat=True))
+        return JsonResponse({'success': True, 'data': dict(serialize_geofence(fence, len(members)), imeis=members)})
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+
+@require_http_methods(["GET"])
+def get_geofence_events(request):
+    """Enter/exit events, newest first; ``?geofence=``, ``?imei=``, ``?since=`` (unix seconds), ``?limit=``"""
+    try:
+        from api.models import GeofenceEvent
+
+        events = GeofenceEvent.objects.order_by('-created_at', '-id')
+        if request.GET.get('geofence'):
+            events = events.filter(geofence_id=int(request.GET['geofence']))
+        if request.GET.get('imei'):
+            events = events.filter(imei=request.GET['imei'])
+        if request.GET.get('since'):
+            since = datetime.fromtimestamp(int(request.GET['since']), tz=timezone.utc)
+            events = events.filter(created_at__gte=since)
+        limit = min(int(request.GET.get('limit', 500)), 5000)
+
+        data = [
+            {
+                'id': event_id,
+                'geofence': geofence_id,
+                'geofence_name': name,
+                'imei': imei,
+                'event': event,
+                'latitude': float(latitude),
+                'longitude': float(longitude),
+                'hearttime_unix': hearttime_unix,
+                'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            for event_id, geofence_id, name, imei, event, latitude, longitude, hearttime_unix, created_at in
+            events.values_list('id', 'geofence_id', 'geofence__name', 'imei', 'event', 'latitude', 'longitude',
+                               'hearttime_unix', 'created_at')[:limit]
+        ]
+        return JsonResponse({'success': True, 'count': len(data), 'data': data})
+    except (ValueError, OverflowError, OSError):
+        return JsonResponse({'success': False, 'error': 'geofence, since and limit must be integers'}, status=400)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
 
 @csrf_exempt
 @require_http_methods(["GET"])
+@snapshot_conditional()
 def get_stats(request):
-    """Get dashboard statistics"""
+    """Get dashboard statistics (kept up to date by the loader, cached per snapshot)"""
     try:
-        total_devices = DeviceData.objects.count()
-        
-        # Status counts
-        status_counts = {}
-        for status in DeviceData.objects.values_list('datastatus_description', flat=True).distinct():
-            count = DeviceData.objects.filter(datastatus_description=status).count()
-            status_counts[status] = count
-        
-        # GPS coordinates availability
-        with_coordinates = DeviceData.objects.exclude(latitude=0, longitude=0).count()
-        without_coordinates = total_devices - with_coordinates
-        
+        from api.services.fleet_stats import get_fleet_stats
+        from api.services.response_cache import cached_payload
+
         return JsonResponse({
             'success': True,
-            'stats': {
-                'total_devices': total_devices,
-                'with_coordinates': with_coordinates,
-                'without_coordinates': without_coordinates,
-                'status_counts': status_counts
-            }
+            'stats': cached_payload('stats', None, get_fleet_stats)
         })
         
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["GET"])
+async def live_updates(request):
+    """Server-sent events with the changes of every load (served by the ASGI app only)"""
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'success': False, 'error': 'Live updates need the ASGI server'}, status=501)
+
+    from api.services.live_updates import event_stream
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    response = StreamingHttpResponse(event_stream(last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_recent_logs(request):
     """Get list of recent tracking runs"""
     try:
+        from api.services.archive_writer import find_run_archive
+        from api.services.snapshot_archive import read_header
+
         response_logs_dir = os.path.join(settings.BASE_DIR, 'response_logs')
         logs = []
         
@@ -315,19 +695,22 @@ def get_recent_logs(request):
             
             for folder in folders[:10]:  # Get last 10 runs
                 folder_path = os.path.join(response_logs_dir, folder)
-                json_file = os.path.join(folder_path, 'all_records.json')
+                archive_file = find_run_archive(folder_path)
                 
-                if os.path.exists(json_file):
+                if archive_file:
                     # Get file size and modification time
-                    stat = os.stat(json_file)
+                    stat = os.stat(archive_file)
                     size_mb = round(stat.st_size / (1024 * 1024), 2)
                     mod_time = datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+                    # Snapshots carry their record count in the header; no need to parse the records
+                    records = read_header(archive_file)['count'] if archive_file.endswith('.snap') else None
                     
                     logs.append({
                         'folder': folder,
-                        'json_file': json_file,
+                        'json_file': archive_file,
                         'size_mb': size_mb,
-                        'modified': mod_time
+                        'modified': mod_time,
+                        'records': records,
                     })
         
         return JsonResponse({
@@ -86,6 +86,26 @@ DATABASES = {
     )
 }
 
+# Cache
+# Local memory by default. Set CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache
+# and CACHE_LOCATION=django_cache (then run createcachetable) so gunicorn workers
+# share cached state such as the ProTrack365 access token.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'protrack-default'),
+    },
+    # Per-process cache of read endpoint payloads keyed by snapshot version
+    # (see api.services.response_cache); LRU culling plus a TTL bound its size
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'protrack-responses',
+        'TIMEOUT': int(os.getenv('RESPONSE_CACHE_TTL', '600')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '500'))},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -0,0 +1,84 @@
+import os
+import sys
+import random
+import time
+import argparse
+from datetime import datetime, timezone
+
+# Add the parent directory to Python path for imports
+current_dir = os.path.dirname(os.path.abspath(__file__))
+backend_dir = os.path.dirname(current_dir)
+sys.path.append(backend_dir)
+
+from api.services.protrack_service import process_batch, process_devices, process_tracking_data
+
+
+def make_raw_data(n, seed=42):
+    """Synthetic API batches shaped like /api/track responses (100 devices per batch)"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    imeis = [str(355139000000000 + i) for i in range(n)]
+    raw_data = []
+    for start in range(0, n, 100):
+        records = []
+        for imei in imeis[start:start + 100]:
+            roll = rng.random()
+            if roll < 0.05:
+                # Never online: no fix and no heartbeat
+                records.append({'imei': imei, 'latitude': 0, 'longitude': 0, 'datastatus': 1, 'hearttime': 0})
+                continue
+            records.append({
+                'imei': imei,
+                'latitude': round(rng.uniform(10.0, 14.5), 6),
+                'longitude': round(rng.uniform(102.3, 107.6), 6),
+                'datastatus': rng.choice([2, 3, 4, 4, 4, 5]),
+                'hearttime': now - rng.randint(0, 400 * 86400),
+            })
+        raw_data.append({'code': 0, 'record': records})
+    return raw_data, imeis
+
+
+def time_call(func, *args, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def process_scalar(raw_data, imeis, now):
+    """Per-record reference: process_devices over every batch"""
+    return [record for batch in raw_data for record in process_devices(batch['record'], now)]
+
+
+def process_per_batch(raw_data, imeis, now):
+    """What the streaming fetch and refresh do: one columnar pass per batch"""
+    returned_imeis = set()
+    return [record for batch in raw_data for record in process_batch(batch, returned_imeis, now)]
+
+
+def run(sizes, repeat):
+    print(f"{'records':>10} {'scalar (s)':>11} {'per batch (s)':>14} {'speedup':>8} "
+          f"{'whole run (s)':>14} {'speedup':>8}  identical")
+    for n in sizes:
+        raw_data, imeis = make_raw_data(n)
+        now = datetime.now(timezone.utc)
+        scalar_time, expected = time_call(process_scalar, raw_data, imeis, now, repeat=repeat)
+        batch_time, per_batch = time_call(process_per_batch, raw_data, imeis, now, repeat=repeat)
+        run_time, whole_run = time_call(process_tracking_data, raw_data, imeis, now, repeat=repeat)
+        identical = expected == per_batch == whole_run
+        print(f"{n:>10} {scalar_time:>11.3f} {batch_time:>14.3f} {scalar_time / batch_time:>7.1f}x "
+              f"{run_time:>14.3f} {scalar_time / run_time:>7.1f}x  {identical}")
+        if not identical:
+            raise SystemExit("❌ Columnar output differs from the per-record processing")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-record processing against the columnar paths")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
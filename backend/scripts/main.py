@@ -1,8 +1,6 @@
 import os
 import sys
 import django
-import csv
-import json
 from datetime import datetime
 from collections import defaultdict
 
@@ -26,25 +24,15 @@ def create_run_folder():
     return run_folder, timestamp
 
 def save_data_files(data, run_folder, fieldnames):
-    """Save data to various CSV and JSON files"""
-    # Save full JSON
-    json_filename = os.path.join(run_folder, "all_records.json")
-    with open(json_filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"JSON saved to {json_filename}")
-    
-    # Save full CSV
-    csv_filename = os.path.join(run_folder, "all_records.csv")
-    with open(csv_filename, "w", newline='', encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in data:
-            writer.writerow({
-                field: row.get(field, "") for field in fieldnames
-            })
-    print(f"CSV saved to {csv_filename}")
+    """Save data to the run archive files (snapshot, CSV and optionally JSON)"""
+    from api.services.archive_writer import TrackingRunWriter
+
+    with TrackingRunWriter(run_folder, fieldnames) as writer:
+        writer.write(data)
+    for filename in writer.filenames:
+        print(f"Saved {filename}")
     
-    return json_filename, csv_filename
+    return writer
 
 def main():
     """Main function to run the tracking data collection"""
@@ -52,6 +40,8 @@ def main():
         # Import here after Django setup
         from scripts.utils.load_imei import get_imeis_from_csv
         from api.services.protrack_service import get_token, get_track_info, process_tracking_data
+        from api.services.concurrency import AdaptiveConcurrencyLimiter
+        from api.services.quarantine import get_quarantined_imeis, quarantined_batch, update_quarantine
         
         print("=" * 50)
         print("🚀 Starting ProTrack365 Data Collection")
@@ -68,8 +58,21 @@ def main():
         # Step 2: Fetch tracking data from API
         print("\n🌐 Step 2: Fetching tracking data from API...")
         endpoint = "https://api.protrack365.com/api/track"
-        raw_data = get_track_info(imei_list=imeis, token=token, endpoint=endpoint)
+        quarantined = get_quarantined_imeis()
+        active_imeis = [imei for imei in imeis if imei not in quarantined]
+        if len(active_imeis) < len(imeis):
+            print(f"🚧 Skipping {len(imeis) - len(active_imeis)} quarantined IMEIs")
+
+        limiter = AdaptiveConcurrencyLimiter()
+        raw_data = get_track_info(imei_list=active_imeis, token=token, endpoint=endpoint, limiter=limiter)
         print(f"✅ Fetched {len(raw_data)} batches from API")
+        print(f"📶 Concurrency settled at {limiter.limit} ({limiter.snapshot()})")
+
+        quarantine_stats = update_quarantine(raw_data)
+        print(f"🚧 Quarantine: {quarantine_stats}")
+        skipped = [imei for imei in imeis if imei in quarantined]
+        if skipped:
+            raw_data.append(quarantined_batch(skipped))
         
         # Step 3: Process raw data
         print("\n⚙️ Step 3: Processing raw data...")
@@ -90,15 +93,16 @@ def main():
             "imei", "latitude", "longitude", "coordinates", 
             "datastatus", "datastatus_description", "hearttime_date", "hearttime_time", "hearttime_unix", "TimeSinceUpdate", "TimeAgo", "status"
         ]
-        json_filename, csv_filename = save_data_files(data, run_folder, fieldnames)
+        writer = save_data_files(data, run_folder, fieldnames)
         
         return {
             'success': True,
             'data': data,
             'run_folder': run_folder,
             'files': {
-                'json': json_filename,
-                'csv': csv_filename,
+                'snapshot': writer.snapshot_filename,
+                'json': writer.json_filename,
+                'csv': writer.csv_filename,
             }
         }
         